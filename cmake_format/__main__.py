@@ -1,30 +1,203 @@
 """Parse cmake listfiles and format them nicely."""
 
 import argparse
+import multiprocessing
 import os
 import json
 import shutil
+import StringIO
 import sys
 import tempfile
+import traceback
 
 import yaml
 
+from cmake_format import cache
 from cmake_format import commands
+from cmake_format import discover
 from cmake_format import formatter
-from cmake_format import lexer
 from cmake_format import parser
 
 
-def process_file(config, infile, outfile):
+# Listfiles up to this many bytes are read at once and tokenized into a
+# compact token store, which is fastest. Larger listfiles are read and
+# tokenized in chunks, so that memory doesn't grow with the size of the file.
+kStreamThreshold = 1 << 20
+
+
+class PrefixedFile(object):
   """
-  Parse the input cmake file, re-format it, and print to the output file.
+  A file-like object which reads ``prefix`` and then the rest of ``infile``.
+  """
+
+  def __init__(self, prefix, infile):
+    self.prefix = prefix
+    self.pos = 0
+    self.infile = infile
+
+  def read(self, size=-1):
+    """
+    Read up to ``size`` bytes, or everything that is left if ``size`` is
+    negative.
+    """
+    if self.pos < len(self.prefix):
+      end = len(self.prefix) if size < 0 else self.pos + size
+      data = self.prefix[self.pos:end]
+      self.pos += len(data)
+      if self.pos == len(self.prefix):
+        self.prefix = ''
+        self.pos = 0
+      return data
+    return self.infile.read(size)
+
+
+def process_file(config, infile, outfile, output_cache=None):
   """
+  Parse the input cmake file, re-format it, and print to the output file. If
+  an ``output_cache`` is given, the output is taken from it when it holds an
+  entry for this source and configuration, and stored in it otherwise.
+  """
+
+  if output_cache is not None:
+    # The key is a hash of the whole source, so the file is read at once
+    source = infile.read()
+    key = output_cache.get_key(source, config)
+    formatted = output_cache.get(key)
+    if formatted is None:
+      formatted = formatter.format_string(source, config)
+      output_cache.put(key, formatted)
+    outfile.write(formatted)
+    return
+
+  # The nodes are printed as they are parsed, so the syntax tree is never held
+  # in memory. A file larger than kStreamThreshold is also tokenized as it is
+  # read, so memory is bounded by kStreamThreshold plus the deepest open block
+  # and the longest statement or inactive region, rather than by the size of
+  # the file.
+  source = infile.read(kStreamThreshold)
+  if len(source) < kStreamThreshold:
+    pretty_printer = formatter.TreePrinter(config, outfile, source)
+    tokens = formatter.tokenize_source(config, source)
+  else:
+    pretty_printer = formatter.TreePrinter(config, outfile)
+    tokens = formatter.tokenize_file(config, PrefixedFile(source, infile))
+    source = None
+  pretty_printer.print_events(parser.parse_events(tokens, config.block_spec))
+
+
+# Names of the config files which are searched for in the ancestry of each
+# listfile, in order of preference
+kConfigFilenames = ['.cmake-format',
+                    'cmake-format.yaml',
+                    'cmake-format.json']
+
+
+def get_mtime(path):
+  """
+  Return the modification time of a file or directory, or None if it doesn't
+  exist.
+  """
+  try:
+    return os.stat(path).st_mtime
+  except OSError:
+    return None
+
+
+class ConfigResolver(object):
+  """
+  Finds and loads the configuration of listfiles, memoizing the config file
+  found for each directory and the configuration loaded from each config
+  file. Each directory is searched at most once, so resolving the
+  configuration of every listfile in a tree costs one search per unique
+  directory rather than one per ancestor of each file.
+
+  If ``check_mtime`` is true, memoized results are checked against the
+  modification time of the directory or config file they were read from, so
+  that a long-running process notices config files which are added, removed
+  or edited. This costs one stat per ancestor directory of each listfile.
+  """
+
+  def __init__(self, check_mtime=False):
+    self.check_mtime = check_mtime
+    # Maps a directory to (mtime, path of the config file in that directory
+    # itself or None)
+    self.directory_configs = {}
+    # Maps a directory to the path of the config file which applies to it,
+    # found in the directory or its ancestry (only if not check_mtime)
+    self.resolved_configs = {}
+    # Maps the path of a config file (None for the defaults) to (mtime,
+    # Configuration)
+    self.configs = {}
+
+  def find_in_directory(self, directory):
+    """
+    Return the path of the config file in ``directory`` itself, or None if
+    there isn't one.
+    """
+    mtime = get_mtime(directory) if self.check_mtime else None
+    entry = self.directory_configs.get(directory)
+    if entry is not None and entry[0] == mtime:
+      return entry[1]
+
+    configpath = None
+    for filename in kConfigFilenames:
+      candidate = os.path.join(directory, filename)
+      if os.path.exists(candidate):
+        configpath = candidate
+        break
+    self.directory_configs[directory] = (mtime, configpath)
+    return configpath
+
+  def find_config_file(self, infile_path):
+    """
+    Search parent directories of an infile path and find a config file if
+    one exists.
+    """
+    realpath = os.path.realpath(infile_path)
+    head, _ = os.path.split(realpath)
+    configpath = None
+    visited = []
+    while head:
+      if not self.check_mtime and head in self.resolved_configs:
+        configpath = self.resolved_configs[head]
+        break
+      visited.append(head)
+      configpath = self.find_in_directory(head)
+      if configpath is not None:
+        break
+      head2, _ = os.path.split(head)
+      if head == head2:
+        break
+      head = head2
 
-  pretty_printer = formatter.TreePrinter(config, outfile)
-  tokens = lexer.tokenize(infile.read())
-  tok_seqs = parser.digest_tokens(tokens)
-  fst = parser.construct_fst(tok_seqs)
-  pretty_printer.print_node(fst)
+    if not self.check_mtime:
+      for directory in visited:
+        self.resolved_configs[directory] = configpath
+    return configpath
+
+  def get_config(self, infile_path, configfile_path=None):
+    """
+    If configfile_path is not none, then load the configuration. Otherwise
+    search for a config file in the ancestry of the filesystem of infile_path
+    and find a config file to load. Each config file is loaded only once and
+    its configuration is shared by all the files which use it.
+    """
+    if configfile_path is None:
+      configfile_path = self.find_config_file(infile_path)
+
+    mtime = None
+    if self.check_mtime and configfile_path is not None:
+      mtime = get_mtime(configfile_path)
+    entry = self.configs.get(configfile_path)
+    if entry is None or entry[0] != mtime:
+      entry = (mtime, load_config(configfile_path))
+      self.configs[configfile_path] = entry
+    return entry[1]
+
+
+# The resolver used by the command line. Each worker process of a parallel
+# run keeps its own (see format_chunk()).
+kConfigResolver = ConfigResolver()
 
 
 def find_config_file(infile_path):
@@ -32,31 +205,35 @@ def find_config_file(infile_path):
   Search parent directories of an infile path and find a config file if
   one exists.
   """
-  realpath = os.path.realpath(infile_path)
-  head, _ = os.path.split(realpath)
-  while head:
-    for filename in ['.cmake-format',
-                     'cmake-format.yaml',
-                     'cmake-format.json']:
-      configpath = os.path.join(head, filename)
-      if os.path.exists(configpath):
-        return configpath
-    head2, _ = os.path.split(head)
-    if head == head2:
-      break
-    head = head2
-  return None
+  return kConfigResolver.find_config_file(infile_path)
+
+
+def resolve_config_file(infile_path, configfile_path):
+  """
+  Return the path of the config file which applies to ``infile_path``:
+  ``configfile_path`` if it is not None, otherwise the one found in its
+  ancestry, or None if there is none.
+  """
+  if configfile_path is not None:
+    return configfile_path
+  return find_config_file(infile_path)
 
 
 def get_config(infile_path, configfile_path):
   """
   If configfile_path is not none, then load the configuration. Otherwise search
   for a config file in the ancestry of the filesystem of infile_path and find
-  a config file to load.
+  a config file to load. Configurations are memoized for the whole process
+  (see ConfigResolver).
   """
-  if configfile_path is None:
-    configfile_path = find_config_file(infile_path)
+  return kConfigResolver.get_config(infile_path, configfile_path)
+
 
+def load_config(configfile_path):
+  """
+  Load the configuration from a yaml or json config file, or return the
+  default configuration if configfile_path is None.
+  """
   config = formatter.Configuration()
   if configfile_path:
     with open(configfile_path, 'r') as config_file:
@@ -64,13 +241,242 @@ def get_config(infile_path, configfile_path):
         config_dict = json.load(config_file)
       else:
         config_dict = yaml.load(config_file)
-    config.merge(config_dict)
+    try:
+      config.merge(config_dict)
+    except ValueError as err:
+      raise ValueError('Invalid config file {}: {}'.format(configfile_path,
+                                                            err))
     for command_name, spec in config_dict.get('additional_commands',
                                               {}).iteritems():
       commands.decl_command(config.fn_spec, command_name, **spec)
+    for block_name, spec in config_dict.get('additional_blocks',
+                                            {}).iteritems():
+      parser.decl_block(config.block_spec, block_name, block_name, **spec)
   return config
 
 
+def format_in_place(config, infile_path, output_cache=None):
+  """
+  Format a listfile and replace it with the result. The file is left
+  untouched if it fails to parse.
+  """
+  outfile = tempfile.NamedTemporaryFile(delete=False)
+  parse_ok = False
+  try:
+    with open(infile_path, 'r') as infile:
+      process_file(config, infile, outfile, output_cache)
+    parse_ok = True
+  finally:
+    outfile.close()
+    if parse_ok:
+      shutil.move(outfile.name, infile_path)
+
+
+# Maps (directory, max_size) to the OutputCache of each worker process, which
+# counts the bytes that the process has written to it across chunks
+kOutputCaches = {}
+
+
+def get_output_cache(output_cache_args):
+  """
+  Return the OutputCache for ``output_cache_args``, a tuple of (directory,
+  max_size), or None if ``output_cache_args`` is None.
+  """
+  if output_cache_args is None:
+    return None
+  output_cache = kOutputCaches.get(output_cache_args)
+  if output_cache is None:
+    output_cache = cache.OutputCache(*output_cache_args)
+    kOutputCaches[output_cache_args] = output_cache
+  return output_cache
+
+
+# Index of the first job of a parallel run which failed, shared by the worker
+# processes (see init_worker())
+kFirstError = None
+
+
+def init_worker(first_error):
+  """
+  Initialize a worker process of a parallel run with the shared index of the
+  first job which failed.
+  """
+  global kFirstError  # pylint: disable=global-statement
+  kFirstError = first_error
+
+
+def format_chunk(chunk):
+  """
+  Format a chunk of listfiles in a worker process of a parallel run. ``chunk``
+  is a list of (index, infile_path, configfile_path, in_place,
+  output_cache_args) jobs, where ``output_cache_args`` is None or the
+  (directory, max_size) of an output cache. Return a list of (index,
+  infile_path, formatted_text, error) results. ``formatted_text`` is None if
+  the file was formatted in place and ``error`` is None unless formatting
+  failed. Jobs after the first one which failed in any worker are skipped and
+  have no result, like the files after a failure when the files are
+  formatted one at a time.
+  """
+  results = []
+  for (index, infile_path, configfile_path, in_place,
+       output_cache_args) in chunk:
+    if kFirstError is not None and index > kFirstError.value:
+      continue
+    try:
+      config = get_config(infile_path, configfile_path)
+      output_cache = get_output_cache(output_cache_args)
+      if in_place:
+        format_in_place(config, infile_path, output_cache)
+        results.append((index, infile_path, None, None))
+      else:
+        outfile = StringIO.StringIO()
+        with open(infile_path, 'r') as infile:
+          process_file(config, infile, outfile, output_cache)
+        results.append((index, infile_path, outfile.getvalue(), None))
+    except Exception:  # pylint: disable=broad-except
+      results.append((index, infile_path, None, traceback.format_exc()))
+      if kFirstError is not None:
+        with kFirstError.get_lock():
+          kFirstError.value = min(kFirstError.value, index)
+  return results
+
+
+# Number of chunks of work per worker process. More chunks balance the load
+# better at the cost of more messages between processes.
+kChunksPerJob = 8
+
+
+def get_chunks(jobs, infile_sizes, num_chunks):
+  """
+  Split a list of jobs into at most about ``num_chunks`` chunks of roughly
+  equal total input size, largest files first, so that the longest jobs start
+  early and the small files at the end keep all of the workers busy.
+  """
+  order = sorted(range(len(jobs)), key=lambda index: -infile_sizes[index])
+  chunk_size = max(1, sum(infile_sizes) // max(1, num_chunks))
+  chunks = []
+  chunk = []
+  chunk_bytes = 0
+  for index in order:
+    chunk.append(jobs[index])
+    chunk_bytes += infile_sizes[index]
+    if chunk_bytes >= chunk_size:
+      chunks.append(chunk)
+      chunk = []
+      chunk_bytes = 0
+  if chunk:
+    chunks.append(chunk)
+  return chunks
+
+
+# Total input size of the chunks of work of a parallel run over files which are
+# discovered as they are formatted (see iter_chunks())
+kStreamChunkSize = 1 << 16
+
+
+def iter_chunks(jobs_and_sizes, chunk_size):
+  """
+  Group an iterable of (job, infile_size) into chunks of jobs of at least
+  ``chunk_size`` total input size (but the last), in order, as the jobs
+  arrive.
+  """
+  chunk = []
+  chunk_bytes = 0
+  for job, infile_size in jobs_and_sizes:
+    chunk.append(job)
+    chunk_bytes += infile_size
+    if chunk_bytes >= chunk_size:
+      yield chunk
+      chunk = []
+      chunk_bytes = 0
+  if chunk:
+    yield chunk
+
+
+def get_parallel_chunks(args, num_jobs, skip=None, output_cache=None):
+  """
+  Return an iterable over the chunks of work of a parallel run over the input
+  files of the command line, leaving out the files for which ``skip``
+  returns true. The jobs use the directory of ``output_cache``, if given.
+  Files that are discovered in directories (with ``--recursive``) are chunked
+  as they are found, otherwise the files are chunked by size, largest first
+  (see get_chunks()).
+  """
+  if args.recursive:
+    infiles = discover.iter_listfiles(args.infilepaths, args.exclude)
+  else:
+    infiles = ((infile_path, discover.get_file_size(infile_path))
+               for infile_path in args.infilepaths)
+  if skip is not None:
+    infiles = ((infile_path, infile_size) for infile_path, infile_size
+               in infiles if not skip(infile_path))
+  output_cache_args = None
+  if output_cache is not None:
+    output_cache_args = (output_cache.directory, output_cache.max_size)
+  jobs_and_sizes = (
+      ((index, infile_path, args.config_file, args.in_place,
+        output_cache_args), infile_size)
+      for index, (infile_path, infile_size) in enumerate(infiles))
+
+  if args.recursive:
+    return iter_chunks(jobs_and_sizes, kStreamChunkSize)
+  jobs, infile_sizes = zip(*jobs_and_sizes) or ([], [])
+  return get_chunks(jobs, infile_sizes, num_jobs * kChunksPerJob)
+
+
+def format_files_parallel(chunks, num_jobs, in_place, on_formatted=None):
+  """
+  Format the listfiles of an iterable of chunks of jobs (see format_chunk())
+  with a pool of ``num_jobs`` worker processes, either in place or to stdout.
+  Output to stdout is written in the order of the job indices, as soon as all
+  of the files before it are done. ``on_formatted`` is called with the path
+  of each file which was formatted successfully. No file after the first one
+  which failed is started. Return the number of files which failed to format.
+  """
+  first_error = multiprocessing.Value('l', sys.maxint)
+  pool = multiprocessing.Pool(num_jobs, initializer=init_worker,
+                              initargs=(first_error,))
+  pending = {}
+  next_index = 0
+  failed = False
+  num_errors = 0
+  try:
+    for results in pool.imap_unordered(format_chunk, chunks):
+      for index, infile_path, formatted_text, error in results:
+        if error is not None:
+          num_errors += 1
+          sys.stderr.write('Error while processing {}\n{}'.format(
+              infile_path, error))
+        elif on_formatted is not None:
+          on_formatted(infile_path)
+        pending[index] = formatted_text
+      # Output stops at the first file which failed, like it does when the
+      # files are formatted one at a time.
+      while not failed and next_index in pending:
+        formatted_text = pending.pop(next_index)
+        if formatted_text is None and not in_place:
+          failed = True
+        elif formatted_text is not None:
+          sys.stdout.write(formatted_text)
+        next_index += 1
+    pool.close()
+  finally:
+    pool.terminate()
+    pool.join()
+  return num_errors
+
+
+def num_jobs_type(value):
+  """
+  Parse the value of ``--jobs``, which must not be negative.
+  """
+  num_jobs = int(value)
+  if num_jobs < 0:
+    raise argparse.ArgumentTypeError(
+        'must be zero or more, not {}'.format(num_jobs))
+  return num_jobs
+
+
 def main():
   """Parse arguments, open files, start work."""
 
@@ -82,6 +488,40 @@ def main():
                           'Default is stdout.')
   arg_parser.add_argument('-c', '--config-file',
                           help='path to yaml config')
+  arg_parser.add_argument('-j', '--jobs', type=num_jobs_type, default=1,
+                          help='Number of files to format in parallel when '
+                               'formatting in-place or to stdout. Zero means '
+                               'one per cpu. Default is 1. After a file fails, '
+                               'no new files are started, but files already '
+                               'being formatted are finished.')
+  arg_parser.add_argument('-r', '--recursive', action='store_true',
+                          help='Format the CMakeLists.txt and *.cmake files '
+                               'found in the directories among infilepaths, '
+                               'except those ignored by .gitignore or '
+                               '.cmake-format-ignore files')
+  arg_parser.add_argument('--exclude', action='append', default=[],
+                          metavar='GLOB',
+                          help='With --recursive, skip files and directories '
+                               'whose name or path matches this glob. May be '
+                               'given more than once.')
+  arg_parser.add_argument('--cache', nargs='?', const=cache.kDefaultCachePath,
+                          metavar='CACHE_FILE',
+                          help='With --in-place, skip the files which are '
+                               'unchanged since they were formatted with the '
+                               'same configuration, as recorded in this file. '
+                               'Default is {}.'.format(cache.kDefaultCachePath))
+  arg_parser.add_argument('--output-cache', metavar='DIR',
+                          help='Directory of formatted outputs keyed by the '
+                               'content of each file and its configuration, '
+                               'which may be shared between checkouts. Files '
+                               'with an entry in it are not formatted again.')
+  arg_parser.add_argument('--output-cache-size', type=int,
+                          default=cache.kDefaultOutputCacheSize // (1 << 20),
+                          metavar='MB',
+                          help='Size in megabytes above which the least '
+                               'recently used entries of the output cache are '
+                               'removed. Default is {}.'.format(
+                                   cache.kDefaultOutputCacheSize // (1 << 20)))
   arg_parser.add_argument('infilepaths', nargs='+')
   args = arg_parser.parse_args()
 
@@ -91,40 +531,109 @@ def main():
           or (args.in_place is True or args.outfile_path == '-')), \
       ("if more than one input file is specified, then formatting must be done"
        " in-place or written to stdout")
+  assert (not args.recursive
+          or (args.in_place is True or args.outfile_path in (None, '-'))), \
+      "recursive formatting must be done in-place or written to stdout"
+  assert args.cache is None or args.in_place is True, \
+      "the cache can only be used when formatting in-place"
   if args.outfile_path is None:
     args.outfile_path = '-'
 
-  for infile_path in args.infilepaths:
+  output_cache = None
+  if args.output_cache is not None:
+    output_cache = cache.OutputCache(args.output_cache,
+                                     args.output_cache_size << 20)
+  file_cache = None
+  if args.cache is not None:
+    file_cache = cache.FileCache(args.cache)
+  try:
+    format_files(args, file_cache, output_cache)
+  finally:
+    if file_cache is not None:
+      file_cache.close()
+    if output_cache is not None:
+      output_cache.close()
+
+
+def mark_dirty(output_cache, on_formatted):
+  """
+  Return a callback for format_files_parallel() which marks ``output_cache``
+  as dirty and then calls ``on_formatted``, if given. The entries which the
+  worker processes add are then evicted when the output cache is closed.
+  """
+  def on_parallel_formatted(infile_path):
+    output_cache.dirty = True
+    if on_formatted is not None:
+      on_formatted(infile_path)
+  return on_parallel_formatted
+
+
+def format_files(args, file_cache=None, output_cache=None):
+  """
+  Format the input files of the command line, serially or in parallel. If a
+  ``file_cache`` is given, files which it records as up to date are skipped
+  and the files which are formatted are recorded in it. If an
+  ``output_cache`` is given, outputs are looked up in it before formatting.
+  """
+  skip = on_formatted = None
+  if file_cache is not None:
+    skip = lambda infile_path: file_cache.is_current(
+        infile_path, resolve_config_file(infile_path, args.config_file))
+    on_formatted = lambda infile_path: file_cache.update(
+        infile_path, resolve_config_file(infile_path, args.config_file))
+
+  num_jobs = args.jobs if args.jobs > 0 else multiprocessing.cpu_count()
+  if not args.recursive:
+    num_jobs = min(num_jobs, len(args.infilepaths))
+  if num_jobs > 1 and (args.in_place or args.outfile_path == '-'):
+    if output_cache is not None:
+      on_formatted = mark_dirty(output_cache, on_formatted)
+    if format_files_parallel(
+        get_parallel_chunks(args, num_jobs, skip, output_cache), num_jobs,
+        args.in_place, on_formatted):
+      sys.exit(1)
+    return
+
+  if args.recursive:
+    # Files are formatted as they are found
+    infilepaths = (infile_path for infile_path, _ in
+                   discover.iter_listfiles(args.infilepaths, args.exclude))
+  else:
+    infilepaths = args.infilepaths
+
+  for infile_path in infilepaths:
+    if skip is not None and skip(infile_path):
+      continue
     config = get_config(infile_path, args.config_file)
     if args.in_place:
-      outfile = tempfile.NamedTemporaryFile(delete=False)
+      try:
+        format_in_place(config, infile_path, output_cache)
+      except:
+        sys.stderr.write('Error while processing {}\n'.format(infile_path))
+        raise
+      if on_formatted is not None:
+        on_formatted(infile_path)
+      continue
+
+    if args.outfile_path == '-':
+      outfile = sys.stdout
     else:
-      if args.outfile_path == '-':
-        outfile = sys.stdout
-      else:
-        outfile = open(args.outfile_path, 'w')
+      outfile = open(args.outfile_path, 'w')
 
-    parse_ok = True
     try:
       with open(infile_path, 'r') as infile:
         try:
-          process_file(config, infile, outfile)
+          process_file(config, infile, outfile, output_cache)
         except:
           sys.stderr.write('Error while processing {}\n'.format(infile_path))
           raise
 
     except:
-      parse_ok = False
       sys.stderr.write('While processing {}\n'.format(infile_path))
       raise
     finally:
-      if args.in_place:
+      if args.outfile_path != '-':
         outfile.close()
-        if parse_ok:
-          shutil.move(outfile.name, infile_path)
-      else:
-        if args.outfile_path != '-':
-          outfile.close()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,482 @@
+"""
+Benchmarks for the stages of the cmake-format pipeline. Each subcommand times
+one stage over the listfiles given on the command line or, if none are given,
+over a synthetic corpus.
+"""
+
+import argparse
+import collections
+import StringIO
+import sys
+import tempfile
+import timeit
+
+from cmake_format import __main__
+from cmake_format import formatter
+from cmake_format import lexer
+from cmake_format import parser
+
+
+def make_synthetic_listfile(num_statements):
+  """
+  Return the text of a synthetic listfile with roughly ``num_statements``
+  statements, mixing comments, nested blocks, quoted strings and long
+  argument lists the way generated ``*Targets.cmake`` files do.
+  """
+  chunks = []
+  for idx in range(num_statements // 4):
+    chunks.append(
+        '# Create imported target foo_{0}\n'
+        'add_library(foo_{0} SHARED IMPORTED)\n'
+        'set_target_properties(foo_{0} PROPERTIES\n'
+        '  INTERFACE_INCLUDE_DIRECTORIES "${{_IMPORT_PREFIX}}/include"\n'
+        '  INTERFACE_LINK_LIBRARIES "bar_{0};baz_{0}")\n'
+        '\n'
+        'if(NOT TARGET foo_{0})\n'
+        '  message(FATAL_ERROR "missing foo_{0}") # should not happen\n'
+        'endif()\n'
+        '\n'.format(idx))
+  return ''.join(chunks)
+
+
+def make_nested_listfile(num_statements, depth):
+  """
+  Return the text of a synthetic listfile with roughly ``num_statements``
+  statements, in chains of ``depth`` nested if() and foreach() blocks the way
+  some generated listfiles nest their conditions.
+  """
+  chain = []
+  for level in range(depth):
+    if level % 2:
+      chain.append('foreach(item_{0} ${{ITEMS_{0}}})\n'.format(level))
+    else:
+      chain.append('if(OPTION_{0})\n'.format(level))
+  chain.append('message(STATUS "leaf")\n')
+  for level in reversed(range(depth)):
+    chain.append('endforeach()\n' if level % 2 else 'endif()\n')
+  return ''.join(chain) * max(1, num_statements // (2 * depth + 1))
+
+
+def get_corpus(infilepaths, num_statements):
+  """
+  Return a list of listfile contents to benchmark against: the contents of
+  each of ``infilepaths`` if any are given, otherwise one synthetic listfile.
+  """
+  if not infilepaths:
+    return [make_synthetic_listfile(num_statements)]
+
+  corpus = []
+  for infile_path in infilepaths:
+    with open(infile_path, 'r') as infile:
+      corpus.append(infile.read())
+  return corpus
+
+
+def time_best_of(repeat, fun, *args, **kwargs):
+  """
+  Call fun(*args, **kwargs) ``repeat`` times and return the best wall-clock
+  time along with the result of the last call.
+  """
+  timer = timeit.default_timer
+  best = None
+  result = None
+  for _ in range(repeat):
+    start = timer()
+    result = fun(*args, **kwargs)
+    duration = timer() - start
+    if best is None or duration < best:
+      best = duration
+  return best, result
+
+
+def get_token_list_size(tokens):
+  """
+  Return the number of bytes held by a list of lexer.Token objects, including
+  their attribute dictionaries and content strings.
+  """
+  size = sys.getsizeof(tokens)
+  for token in tokens:
+    size += (sys.getsizeof(token) + sys.getsizeof(token.__dict__)
+             + sys.getsizeof(token.content))
+  return size
+
+
+def get_token_store_size(store):
+  """
+  Return the number of bytes held by the arrays of a lexer.TokenStore,
+  including its line index but not the source string that it shares.
+  """
+  return sum(sys.getsizeof(values) for values in
+             [store.types, store.starts, store.ends,
+              store.line_index.line_starts])
+
+
+def bench_lex(args, corpus):
+  """
+  Report lexer throughput in tokens and bytes per second, and the memory held
+  by the lexed tokens, for both the list-of-Token and TokenStore
+  representations.
+  """
+  for name, tokenize, get_size in [
+      ('tokenize', lexer.tokenize, get_token_list_size),
+      ('tokenize_compact', lexer.tokenize_compact, get_token_store_size)]:
+    total_time = 0.0
+    total_tokens = 0
+    total_bytes = 0
+    total_size = 0
+    for contents in corpus:
+      duration, tokens = time_best_of(args.repeat, tokenize, contents)
+      total_time += duration
+      total_tokens += len(tokens)
+      total_bytes += len(contents)
+      total_size += get_size(tokens)
+      del tokens
+
+    print '{}: {} tokens, {} bytes in {:.3f}s'.format(
+        name, total_tokens, total_bytes, total_time)
+    print '  {:.0f} tokens/s, {:.2f} MB/s'.format(
+        total_tokens / total_time, total_bytes / total_time / 1e6)
+    print '  {:.1f} MB of tokens, {:.1f} bytes/token'.format(
+        total_size / 1e6, float(total_size) / total_tokens)
+
+
+def iter_statements(root):
+  """
+  Yield every Statement node in the syntax tree rooted at ``root``.
+  """
+  stack = [root]
+  while stack:
+    node = stack.pop()
+    if node.node_type == parser.STATEMENT_NODE:
+      yield node
+    stack.extend(getattr(node, 'children', []))
+
+
+def get_statement_names(root):
+  """
+  Return the name of every statement in the tree, the way an indexer would.
+  """
+  return [statement.name for statement in iter_statements(root)]
+
+
+def get_statement_args(root):
+  """
+  Return the number of arguments of all statements in the tree, which
+  requires each statement to be split into arguments.
+  """
+  return sum(len(statement.body) for statement in iter_statements(root))
+
+
+def bench_parse(args, corpus):
+  """
+  Report the time to parse the lexed corpus, and then the time to visit the
+  names of all statements versus the time to visit their arguments.
+  """
+  total_parse = 0.0
+  total_names = 0.0
+  total_args = 0.0
+  total_statements = 0
+  for contents in corpus:
+    tokens = lexer.tokenize_compact(contents)
+    duration, fst = time_best_of(args.repeat, parser.parse, tokens)
+    total_parse += duration
+    duration, names = time_best_of(args.repeat, get_statement_names, fst)
+    total_names += duration
+    total_statements += len(names)
+    # NOTE: only the first pass materializes arguments, so don't take the best
+    # of several.
+    duration, _ = time_best_of(1, get_statement_args, fst)
+    total_args += duration
+    del fst
+
+  print 'parse: {} statements in {:.3f}s'.format(total_statements, total_parse)
+  print '  visit names: {:.3f}s'.format(total_names)
+  print '  visit arguments: {:.3f}s'.format(total_args)
+
+
+def format_contents(contents, **kwargs):
+  """
+  Format listfile ``contents`` with a configuration constructed from
+  ``kwargs``. Return the configuration that was used and the formatted text.
+  """
+  config = formatter.Configuration(**kwargs)
+  outfile = StringIO.StringIO()
+  __main__.process_file(config, StringIO.StringIO(contents), outfile)
+  return config, outfile.getvalue()
+
+
+def bench_format(args, corpus):
+  """
+  Report the time to format the corpus from source text to formatted text, and
+  the effectiveness of the layout cache.
+  """
+  total_time = 0.0
+  total_bytes = 0
+  hits = 0
+  misses = 0
+  for contents in corpus:
+    duration, (config, _) = time_best_of(args.repeat, format_contents,
+                                         contents)
+    total_time += duration
+    total_bytes += len(contents)
+    hits += config.layout_cache.hits
+    misses += config.layout_cache.misses
+
+  print 'format: {} bytes in {:.3f}s, {:.2f} MB/s'.format(
+      total_bytes, total_time, total_bytes / total_time / 1e6)
+  print '  layout cache: {} hits, {} misses'.format(hits, misses)
+
+
+def get_statement_blocks(corpus):
+  """
+  Format every statement of the corpus and return a list of (indent_str,
+  lines) blocks, in the form that TreePrinter writes them out.
+  """
+  config = formatter.Configuration()
+  blocks = []
+  for contents in corpus:
+    depth = 0
+    for event_type, node in parser.parse_events(
+        lexer.tokenize_compact(contents)):
+      if event_type == parser.STATEMENT_EVENT:
+        indent_size = config.tab_size * depth
+        blocks.append((' ' * indent_size, formatter.format_command(
+            config, node, config.line_width - indent_size)))
+      elif event_type == parser.START_BODY_EVENT:
+        depth += 1
+      elif event_type == parser.END_BODY_EVENT:
+        depth -= 1
+  return blocks
+
+
+def write_unbuffered(outfile, blocks):
+  """
+  Write blocks of lines to outfile with a write() per indentation, line and
+  newline.
+  """
+  for indent_str, lines in blocks:
+    for line in lines:
+      outfile.write(indent_str)
+      outfile.write(line.rstrip())
+      outfile.write('\n')
+
+
+def write_buffered(outfile, blocks):
+  """
+  Write blocks of lines to outfile through a formatter.OutputBuffer.
+  """
+  output = formatter.OutputBuffer(outfile)
+  for indent_str, lines in blocks:
+    output.write_lines(indent_str, lines)
+    output.write('\n')
+  output.flush()
+
+
+def bench_write(args, corpus):
+  """
+  Report the time to write out the formatted statements of the corpus to a
+  file, one write() per piece of text or through an OutputBuffer, and the time
+  to format the corpus into a string through StringIO or with
+  formatter.format_string().
+  """
+  blocks = get_statement_blocks(corpus)
+  num_bytes = sum(len(indent_str) * len(lines) + sum(len(line) + 1
+                                                      for line in lines)
+                  for indent_str, lines in blocks)
+  print 'write: {} statements, {:.1f} MB'.format(len(blocks), num_bytes / 1e6)
+  for name, write_fun in [('unbuffered', write_unbuffered),
+                          ('buffered', write_buffered)]:
+    with tempfile.TemporaryFile() as outfile:
+      duration, _ = time_best_of(args.repeat, write_fun, outfile, blocks)
+    print '  {}: {:.3f}s, {:.2f} MB/s'.format(
+        name, duration, num_bytes / duration / 1e6)
+
+  for name, format_fun in [
+      ('process_file', format_contents),
+      ('format_string', formatter.format_string)]:
+    total_time = 0.0
+    for contents in corpus:
+      duration, _ = time_best_of(args.repeat, format_fun, contents)
+      total_time += duration
+    print '  {}: {:.3f}s'.format(name, total_time)
+
+
+def bench_nesting(args, corpus):  # pylint: disable=unused-argument
+  """
+  Report the time to print and to dump deeply nested syntax trees, which are
+  traversed with an explicit stack (see parser.iter_fst_events()), and to
+  print the same listfile as a stream of parse events.
+  """
+  contents = make_nested_listfile(args.num_statements, args.depth)
+  config = formatter.Configuration(line_width=2 * args.depth + 80)
+  fst = parser.parse(lexer.tokenize_compact(contents))
+  print 'nesting: depth {}, {} statements'.format(
+      args.depth, len(get_statement_names(fst)))
+
+  def print_tree():
+    formatter.TreePrinter(config, StringIO.StringIO()).print_node(fst)
+
+  def print_stream():
+    formatter.TreePrinter(config, StringIO.StringIO()).print_events(
+        parser.parse_events(lexer.tokenize_compact(contents)))
+
+  def dump_tree():
+    stdout = sys.stdout
+    sys.stdout = StringIO.StringIO()
+    try:
+      parser.dump_fst(fst)
+    finally:
+      sys.stdout = stdout
+
+  for name, fun in [('print_node', print_tree),
+                    ('print_events', print_stream),
+                    ('dump_fst', dump_tree)]:
+    duration, _ = time_best_of(args.repeat, fun)
+    print '  {}: {:.3f}s'.format(name, duration)
+
+
+def bench_layout(args, corpus):
+  """
+  Compare the layout engines: report the time to format the corpus with each,
+  the number of lines of output, and the number of lines which exceed the
+  line width.
+  """
+  for layout_engine in ['heuristic', 'optimal']:
+    total_time = 0.0
+    total_lines = 0
+    total_overflows = 0
+    for contents in corpus:
+      duration, (config, formatted) = time_best_of(
+          args.repeat, format_contents, contents, layout_engine=layout_engine)
+      total_time += duration
+      lines = formatted.split('\n')
+      total_lines += len(lines)
+      total_overflows += sum(1 for line in lines
+                             if len(line) > config.line_width)
+
+    print '{}: {:.3f}s, {} lines, {} lines too long'.format(
+        layout_engine, total_time, total_lines, total_overflows)
+
+
+def get_object_size(obj, attrs, seen):
+  """
+  Return the number of bytes held by ``obj``, its instance dictionary (if it
+  has one) and the containers referenced by the attributes named in ``attrs``.
+  Objects whose id is in ``seen`` are counted only once. Attributes that are
+  computed properties are skipped.
+  """
+  size = 0
+  objs = [obj]
+  for attr in attrs:
+    if not isinstance(getattr(type(obj), attr, None), property):
+      objs.append(getattr(obj, attr, None))
+  for member in objs:
+    if member is None or id(member) in seen:
+      continue
+    seen.add(id(member))
+    size += sys.getsizeof(member)
+    instance_dict = getattr(member, '__dict__', None)
+    if instance_dict is not None:
+      size += sys.getsizeof(instance_dict)
+  return size
+
+
+def get_tree_memory(root):
+  """
+  Walk the syntax tree rooted at ``root`` and return a dictionary mapping the
+  class name of each kind of node (and of statement arguments) to a
+  ``[count, bytes]`` pair. Bytes include each node's own storage and the
+  containers that it owns, but not the tokens themselves.
+  """
+  node_attrs = ['children', 'prefix_tokens', 'postfix_tokens', 'body',
+                '_prefix_tokens', '_postfix_tokens', '_body', 'content']
+  arg_attrs = ['tokens', 'trailing_tokens', 'comments']
+  seen = set()
+  stats = collections.defaultdict(lambda: [0, 0])
+  stack = [root]
+  while stack:
+    node = stack.pop()
+    # NOTE: accessing body materializes the arguments of a lazy statement
+    body = getattr(node, 'body', [])
+    size = get_object_size(node, node_attrs, seen)
+    content = getattr(node, 'content', None)
+    if content is not None:
+      size += get_object_size(content.tokens, [], seen)
+    node_stats = stats[type(node).__name__]
+    node_stats[0] += 1
+    node_stats[1] += size
+
+    for arg in body:
+      arg_stats = stats[type(arg).__name__]
+      arg_stats[0] += 1
+      arg_stats[1] += get_object_size(arg, arg_attrs, seen)
+    stack.extend(getattr(node, 'children', []))
+  return stats
+
+
+def bench_tree_memory(args, corpus):  # pylint: disable=unused-argument
+  """
+  Report the memory held by the nodes of the full-syntax-tree, per class of
+  node.
+  """
+  total_stats = collections.defaultdict(lambda: [0, 0])
+  for contents in corpus:
+    fst = parser.parse(lexer.tokenize_compact(contents))
+    for name, (count, size) in get_tree_memory(fst).iteritems():
+      total_stats[name][0] += count
+      total_stats[name][1] += size
+    del fst
+
+  total_count = 0
+  total_size = 0
+  print '{:>12} {:>10} {:>10} {:>10}'.format('class', 'count', 'MB',
+                                              'bytes/obj')
+  for name, (count, size) in sorted(total_stats.iteritems()):
+    print '{:>12} {:>10} {:>10.1f} {:>10.1f}'.format(
+        name, count, size / 1e6, float(size) / count)
+    total_count += count
+    total_size += size
+  print '{:>12} {:>10} {:>10.1f} {:>10.1f}'.format(
+      'total', total_count, total_size / 1e6, float(total_size) / total_count)
+
+
+def main():
+  """
+  Parse arguments, build the corpus and run the requested benchmark.
+  """
+  arg_parser = argparse.ArgumentParser(description=__doc__)
+  arg_parser.add_argument('-n', '--num-statements', type=int, default=100000,
+                          help='Size of the synthetic listfile used when no '
+                               'infiles are given')
+  arg_parser.add_argument('-r', '--repeat', type=int, default=3,
+                          help='Report the best of this many runs')
+  subparsers = arg_parser.add_subparsers(dest='command')
+  for command in ['lex', 'parse', 'format', 'layout', 'tree-memory', 'write']:
+    subparser = subparsers.add_parser(command)
+    subparser.add_argument('infilepaths', nargs='*')
+  subparser = subparsers.add_parser('nesting')
+  subparser.add_argument('-d', '--depth', type=int, default=2000,
+                         help='Depth of the nested blocks')
+  args = arg_parser.parse_args()
+
+  corpus = get_corpus(getattr(args, 'infilepaths', []), args.num_statements)
+  if args.command == 'lex':
+    bench_lex(args, corpus)
+  elif args.command == 'format':
+    bench_format(args, corpus)
+  elif args.command == 'layout':
+    bench_layout(args, corpus)
+  elif args.command == 'parse':
+    bench_parse(args, corpus)
+  elif args.command == 'tree-memory':
+    bench_tree_memory(args, corpus)
+  elif args.command == 'write':
+    bench_write(args, corpus)
+  elif args.command == 'nesting':
+    bench_nesting(args, corpus)
+  else:
+    assert False, "Unkown command {}".format(args.command)
+
+
+if __name__ == '__main__':
+  main()
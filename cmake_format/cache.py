@@ -0,0 +1,298 @@
+"""
+A persistent record of the listfiles which are already formatted, so that
+later runs can skip unchanged files after a single stat (see ``--cache``), and
+a directory of formatted outputs keyed by content, which may be shared by
+many checkouts (see ``--output-cache``).
+"""
+
+import errno
+import hashlib
+import os
+import sqlite3
+import tempfile
+import time
+
+import cmake_format
+
+# Name of the cache file used when ``--cache`` is given without a path
+kDefaultCachePath = '.cmake-format-cache'
+
+# Default limit, in bytes, of the total size of an output cache directory
+kDefaultOutputCacheSize = 256 * 1024 * 1024
+
+# Prefix of the temporary files which entries of an output cache are written
+# to before they are renamed into place
+kOutputCacheTempPrefix = '.tmp-'
+
+# Temporary files of an output cache older than this many seconds were left
+# by an interrupted writer, and are removed on eviction
+kOutputCacheTempAge = 3600
+
+
+def hash_file(path):
+  """
+  Return the hex digest of the contents of a file.
+  """
+  with open(path, 'rb') as infile:
+    return hashlib.sha1(infile.read()).hexdigest()
+
+
+class FileCache(object):
+  """
+  An sqlite database with one row per formatted listfile, holding the size,
+  mtime and content hash of the file after it was formatted, a hash of the
+  config file it was formatted with and the version of cmake-format which
+  formatted it. The rows are read when the cache is opened and changes are
+  written when it is closed.
+
+  A file is up to date if it was formatted with the same configuration and
+  version and its size and mtime are unchanged. If only its mtime changed
+  (e.g. it was touched), its content hash is compared instead.
+  """
+
+  def __init__(self, path):
+    self.connection = sqlite3.connect(path)
+    # paths are byte strings, which may not be valid utf-8
+    self.connection.text_factory = str
+    self.connection.execute(
+        'CREATE TABLE IF NOT EXISTS files ('
+        ' path TEXT PRIMARY KEY, size INTEGER, mtime REAL,'
+        ' content_hash TEXT, config_hash TEXT, version TEXT)')
+    # Maps an absolute path to (size, mtime, content_hash, config_hash,
+    # version)
+    self.entries = {row[0]: tuple(row[1:]) for row in self.connection.execute(
+        'SELECT path, size, mtime, content_hash, config_hash, version'
+        ' FROM files')}
+    # Rows which changed since the cache was opened, by absolute path
+    self.updates = {}
+    # Maps the path of a config file (None for the defaults) to its hash
+    self.config_hashes = {}
+
+  def get_config_hash(self, configfile_path):
+    """
+    Return a hash of the contents of a config file, or of the empty string for
+    the default configuration. Each config file is read only once.
+    """
+    config_hash = self.config_hashes.get(configfile_path)
+    if config_hash is None:
+      if configfile_path is None:
+        config_hash = hashlib.sha1('').hexdigest()
+      else:
+        config_hash = hash_file(configfile_path)
+      self.config_hashes[configfile_path] = config_hash
+    return config_hash
+
+  def is_current(self, infile_path, configfile_path):
+    """
+    Return true if the listfile at ``infile_path`` was already formatted with
+    the config file at ``configfile_path`` and hasn't changed since.
+    """
+    abspath = os.path.abspath(infile_path)
+    entry = self.entries.get(abspath)
+    if entry is None:
+      return False
+    size, mtime, content_hash, config_hash, version = entry
+    if (version != cmake_format.__version__
+        or config_hash != self.get_config_hash(configfile_path)):
+      return False
+
+    try:
+      stat = os.stat(abspath)
+    except OSError:
+      return False
+    if stat.st_size != size:
+      return False
+    if stat.st_mtime == mtime:
+      return True
+    if hash_file(abspath) != content_hash:
+      return False
+    self.set_entry(abspath, (size, stat.st_mtime, content_hash, config_hash,
+                             version))
+    return True
+
+  def update(self, infile_path, configfile_path):
+    """
+    Record that the listfile at ``infile_path`` was just formatted with the
+    config file at ``configfile_path``.
+    """
+    abspath = os.path.abspath(infile_path)
+    stat = os.stat(abspath)
+    self.set_entry(abspath, (stat.st_size, stat.st_mtime, hash_file(abspath),
+                             self.get_config_hash(configfile_path),
+                             cmake_format.__version__))
+
+  def set_entry(self, abspath, entry):
+    """
+    Set the row of a file, to be written when the cache is closed.
+    """
+    self.entries[abspath] = entry
+    self.updates[abspath] = entry
+
+  def close(self):
+    """
+    Write the rows which changed and close the database.
+    """
+    with self.connection:
+      self.connection.executemany(
+          'INSERT OR REPLACE INTO files'
+          ' (path, size, mtime, content_hash, config_hash, version)'
+          ' VALUES (?, ?, ?, ?, ?, ?)',
+          [(abspath,) + entry for abspath, entry in self.updates.iteritems()])
+    self.updates = {}
+    self.connection.close()
+
+
+def get_umask():
+  """
+  Return the umask of this process. It can only be read by setting it, so it
+  is restored straight away.
+  """
+  umask = os.umask(0)
+  os.umask(umask)
+  return umask
+
+
+class OutputCache(object):
+  """
+  A directory of formatted outputs, with one file per entry. The key of an
+  entry is a hash of the source text, of the digest of the configuration (see
+  ``Configuration.get_digest()``) and of the version of cmake-format, so the
+  directory may be shared by any number of checkouts and processes.
+
+  Entries are written to a temporary file next to their final path and then
+  renamed into place, so readers and concurrent writers never see a partial
+  entry. The mtime of an entry is updated when it is read, and when the total
+  size of the entries exceeds ``max_size`` the least recently used ones are
+  removed (see ``evict()``).
+  """
+
+  def __init__(self, directory, max_size=kDefaultOutputCacheSize):
+    self.directory = directory
+    self.max_size = max_size
+    # Bytes written by this process since the last eviction. The directory is
+    # scanned for eviction whenever this exceeds a sixteenth of max_size.
+    self.bytes_written = 0
+    # True if entries may have been added since the last eviction
+    self.dirty = False
+    # mkstemp() creates files which only their owner can read, so entries are
+    # given the mode of any other new file, to share the directory with other
+    # users
+    self.file_mode = 0o666 & ~get_umask()
+
+  def get_key(self, source, config):
+    """
+    Return the key of the entry for ``source`` formatted with ``config``.
+    """
+    hasher = hashlib.sha1()
+    for part in [cmake_format.__version__, config.get_digest(), source]:
+      hasher.update(part)
+      hasher.update('\0')
+    return hasher.hexdigest()
+
+  def get_path(self, key):
+    """
+    Return the path of the entry for ``key``. Entries are spread among
+    subdirectories named by the first two characters of their key.
+    """
+    return os.path.join(self.directory, key[:2], key[2:])
+
+  def get(self, key):
+    """
+    Return the formatted output stored for ``key``, or None if there is none.
+    """
+    path = self.get_path(key)
+    try:
+      with open(path, 'rb') as entry_file:
+        output = entry_file.read()
+    except IOError:
+      return None
+    try:
+      os.utime(path, None)
+    except OSError:
+      # another process evicted it since we read it
+      pass
+    return output
+
+  def put(self, key, output):
+    """
+    Store the formatted output for ``key``.
+    """
+    path = self.get_path(key)
+    subdir = os.path.dirname(path)
+    try:
+      os.makedirs(subdir)
+    except OSError as ex:
+      if ex.errno != errno.EEXIST:
+        raise
+
+    fd, temp_path = tempfile.mkstemp(dir=subdir,
+                                     prefix=kOutputCacheTempPrefix)
+    try:
+      with os.fdopen(fd, 'wb') as entry_file:
+        entry_file.write(output)
+      os.chmod(temp_path, self.file_mode)
+      os.rename(temp_path, path)
+    except:
+      os.remove(temp_path)
+      raise
+
+    self.dirty = True
+    self.bytes_written += len(output)
+    if self.bytes_written > self.max_size // 16:
+      self.evict()
+
+  def evict(self):
+    """
+    Remove the least recently used entries until the total size of the
+    directory is within ``max_size``, along with temporary files left by
+    interrupted writers. Entries removed concurrently by another process are
+    ignored.
+    """
+    self.bytes_written = 0
+    self.dirty = False
+    now = time.time()
+    entries = []
+    total_size = 0
+    for subdir in os.listdir(self.directory):
+      subdir_path = os.path.join(self.directory, subdir)
+      if not os.path.isdir(subdir_path):
+        continue
+      for name in os.listdir(subdir_path):
+        path = os.path.join(subdir_path, name)
+        try:
+          stat = os.stat(path)
+        except OSError:
+          continue
+        if name.startswith(kOutputCacheTempPrefix):
+          if now - stat.st_mtime > kOutputCacheTempAge:
+            remove_file(path)
+          continue
+        entries.append((stat.st_mtime, stat.st_size, path))
+        total_size += stat.st_size
+
+    if total_size <= self.max_size:
+      return
+    entries.sort()
+    for _, size, path in entries:
+      remove_file(path)
+      total_size -= size
+      if total_size <= self.max_size:
+        break
+
+  def close(self):
+    """
+    Evict entries if any were added since the last eviction.
+    """
+    if self.dirty:
+      self.evict()
+
+
+def remove_file(path):
+  """
+  Remove a file, unless it was already removed.
+  """
+  try:
+    os.remove(path)
+  except OSError as ex:
+    if ex.errno != errno.ENOENT:
+      raise
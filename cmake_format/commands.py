@@ -5,6 +5,11 @@ Command specifications for cmake built-in commands.
 ZERO_OR_MORE = '*'
 ONE_OR_MORE = '+'
 
+# Roles of the arguments of a command
+PARG = 0
+FLAG = 1
+KWARG = 2
+
 
 def decl_command(fn_spec, command_name, pargs=None, flags=None, kwargs=None):
   if pargs is None:
@@ -21,10 +26,136 @@ def decl_command(fn_spec, command_name, pargs=None, flags=None, kwargs=None):
   fn_spec[command_name] = decl
 
 
+class FrozenDict(dict):
+  """
+  A dictionary which can't be modified once it is constructed.
+  """
+
+  def readonly(self, *args, **kwargs):
+    raise TypeError('{} is read-only'.format(type(self).__name__))
+
+  __setitem__ = __delitem__ = readonly
+  clear = pop = popitem = setdefault = update = readonly
+
+  def __reduce__(self):
+    return (type(self), (dict(self),))
+
+
+class ArgClassifier(object):
+  """
+  The kwarg specification of one command compiled into frozen lookup tables:
+  the set of its flags, a map of its kwargs to their number of arguments, its
+  number of positional arguments, and a map of each of its keywords to its
+  role.
+  """
+
+  __slots__ = ('pargs', 'flags', 'kwargs', 'roles')
+
+  def __init__(self, spec):
+    self.pargs = spec.get('pargs', 0)
+    keywords = [(keyword, nargs) for keyword, nargs in spec.iteritems()
+                if keyword != 'pargs']
+    self.flags = frozenset(keyword for keyword, nargs in keywords
+                           if nargs == 0)
+    self.kwargs = FrozenDict((keyword, nargs) for keyword, nargs in keywords
+                             if nargs != 0)
+    roles = dict.fromkeys(self.flags, FLAG)
+    roles.update(dict.fromkeys(self.kwargs, KWARG))
+    self.roles = FrozenDict(roles)
+
+  def classify(self, contents):
+    """
+    Return the role of an argument of this command: PARG, FLAG or KWARG.
+    """
+    return self.roles.get(contents, PARG)
+
+
+class FnSpecOverlay(object):
+  """
+  A mapping of cmake function names to kwarg specifications, which holds the
+  commands declared on it and looks up all others in a read-only ``parent``
+  mapping. The parent can therefore be shared by any number of overlays, and
+  copying an overlay only copies the commands declared on it.
+  ``parent_classifiers`` maps the commands of the parent to their
+  ArgClassifier. Classifiers of the commands declared on the overlay are
+  compiled when they are first needed.
+  """
+
+  __slots__ = ('parent', 'parent_classifiers', 'overrides', 'classifiers')
+
+  def __init__(self, parent, parent_classifiers, overrides=None):
+    self.parent = parent
+    self.parent_classifiers = parent_classifiers
+    if overrides is None:
+      overrides = {}
+    self.overrides = overrides
+    self.classifiers = {}
+
+  def get(self, command_name, default=None):
+    spec = self.overrides.get(command_name)
+    if spec is None:
+      return self.parent.get(command_name, default)
+    return spec
+
+  def __getitem__(self, command_name):
+    spec = self.get(command_name)
+    if spec is None:
+      raise KeyError(command_name)
+    return spec
+
+  def __setitem__(self, command_name, spec):
+    self.overrides[command_name] = spec
+    self.classifiers.pop(command_name, None)
+
+  def __contains__(self, command_name):
+    return command_name in self.overrides or command_name in self.parent
+
+  def __iter__(self):
+    for command_name in self.overrides:
+      yield command_name
+    for command_name in self.parent:
+      if command_name not in self.overrides:
+        yield command_name
+
+  def __len__(self):
+    return sum(1 for _ in self)
+
+  def copy(self):
+    """
+    Return a new overlay of the same parent, with a copy of the commands
+    declared on this one.
+    """
+    return FnSpecOverlay(self.parent, self.parent_classifiers,
+                         dict(self.overrides))
+
+  def get_classifier(self, command_name):
+    """
+    Return the ArgClassifier of a command. Commands without a specification
+    have only positional arguments.
+    """
+    if command_name not in self.overrides:
+      return self.parent_classifiers.get(command_name, kEmptyClassifier)
+
+    classifier = self.classifiers.get(command_name)
+    if classifier is None:
+      classifier = ArgClassifier(self.overrides[command_name])
+      self.classifiers[command_name] = classifier
+    return classifier
+
+
 def get_fn_spec():
   """
-  Return a dictionary mapping cmake function names to a dictionary containing
-  kwarg specifications.
+  Return a mapping of cmake function names to a dictionary containing kwarg
+  specifications. The specifications of built-in commands are shared and
+  read-only, commands declared on the returned mapping override them.
+  """
+  return FnSpecOverlay(kBuiltinFnSpec, kBuiltinClassifiers)
+
+
+def make_builtin_fn_spec():
+  """
+  Return a dictionary mapping cmake built-in function names to a dictionary
+  containing kwarg specifications.
   """
 
   fn_spec = {}
@@ -362,3 +493,16 @@ def get_fn_spec():
   })
 
   return fn_spec
+
+
+# built once per process and shared by every configuration. Each
+# specification is frozen too, since their id()s key the layout cache.
+kBuiltinFnSpec = FrozenDict(
+    (command_name, FrozenDict(spec))
+    for command_name, spec in make_builtin_fn_spec().iteritems())
+
+kBuiltinClassifiers = FrozenDict(
+    (command_name, ArgClassifier(spec))
+    for command_name, spec in kBuiltinFnSpec.iteritems())
+
+kEmptyClassifier = ArgClassifier({})
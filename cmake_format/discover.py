@@ -0,0 +1,247 @@
+"""
+Discovery of the listfiles within directory trees, for formatting whole trees
+with ``--recursive``.
+"""
+
+import fnmatch
+import os
+import re
+import sys
+
+try:
+  from os import scandir
+except ImportError:
+  try:
+    from scandir import scandir
+  except ImportError:
+    scandir = None
+
+# Names of the ignore files which are read in each directory that is
+# searched. Both use the syntax of ``.gitignore``.
+kIgnoreFilenames = ['.gitignore', '.cmake-format-ignore']
+
+# Names of version control directories, which are never searched
+kSkipDirnames = ['.git', '.hg', '.svn']
+
+
+def is_listfile(name):
+  """
+  Return true if a file with this name is a cmake listfile.
+  """
+  return name == 'CMakeLists.txt' or name.endswith('.cmake')
+
+
+def get_file_size(infile_path):
+  """
+  Return the size of a file, or zero if it can't be read. Errors are
+  reported when the file is formatted.
+  """
+  try:
+    return os.path.getsize(infile_path)
+  except OSError:
+    return 0
+
+
+def translate_glob(pattern):
+  """
+  Translate a ``.gitignore`` glob into a regular expression. ``*`` and ``?``
+  don't match a slash, ``**/`` matches any number of leading directories and
+  ``/**`` matches everything within a directory.
+  """
+  parts = []
+  idx = 0
+  while idx < len(pattern):
+    if pattern.startswith('**/', idx):
+      parts.append('(?:.*/)?')
+      idx += 3
+    elif pattern.startswith('/**', idx) and idx + 3 == len(pattern):
+      parts.append('/.*')
+      idx += 3
+    elif pattern.startswith('**', idx):
+      parts.append('.*')
+      idx += 2
+    elif pattern[idx] == '*':
+      parts.append('[^/]*')
+      idx += 1
+    elif pattern[idx] == '?':
+      parts.append('[^/]')
+      idx += 1
+    elif pattern[idx] == '[' and pattern.find(']', idx + 2) != -1:
+      end = pattern.find(']', idx + 2)
+      char_class = pattern[idx + 1:end].replace('\\', '\\\\')
+      if char_class.startswith('!'):
+        char_class = '^' + char_class[1:]
+      parts.append('[' + char_class + ']')
+      idx = end + 1
+    elif pattern[idx] == '\\' and idx + 1 < len(pattern):
+      parts.append(re.escape(pattern[idx + 1]))
+      idx += 2
+    else:
+      parts.append(re.escape(pattern[idx]))
+      idx += 1
+  return ''.join(parts) + r'\Z'
+
+
+class IgnoreRule(object):
+  """
+  One pattern of an ignore file. ``regex`` matches the path of a file or
+  directory relative to the directory of the ignore file if the pattern is
+  ``anchored`` (it contains a slash), and its name otherwise. A ``negated``
+  rule re-includes what earlier rules ignored. A ``dir_only`` rule applies
+  only to directories.
+  """
+
+  __slots__ = ('regex', 'anchored', 'negated', 'dir_only')
+
+  def __init__(self, pattern):
+    self.negated = pattern.startswith('!')
+    if self.negated:
+      pattern = pattern[1:]
+    self.dir_only = pattern.endswith('/')
+    pattern = pattern.rstrip('/')
+    self.anchored = '/' in pattern
+    self.regex = re.compile(translate_glob(pattern.lstrip('/')))
+
+  def matches(self, relpath, name, is_dir):
+    """
+    Return true if this rule applies to the file or directory at ``relpath``
+    relative to the directory of the ignore file.
+    """
+    if self.dir_only and not is_dir:
+      return False
+    return bool(self.regex.match(relpath if self.anchored else name))
+
+
+def read_ignore_rules(directory):
+  """
+  Return the list of IgnoreRules of the ignore files in ``directory``, in
+  order of increasing precedence.
+  """
+  rules = []
+  for filename in kIgnoreFilenames:
+    try:
+      with open(os.path.join(directory, filename), 'r') as ignore_file:
+        lines = ignore_file.read().splitlines()
+    except IOError:
+      continue
+    for line in lines:
+      if line.endswith(' ') and not line.endswith('\\ '):
+        line = line.rstrip(' ')
+      if not line or line.startswith('#'):
+        continue
+      rules.append(IgnoreRule(line))
+  return rules
+
+
+def is_ignored(rule_stack, path, name, is_dir):
+  """
+  Return true if the file or directory at ``path`` is ignored by the rules
+  of ``rule_stack``, a list of (directory_prefix, rules) from the outermost
+  directory to the innermost, where ``directory_prefix`` is the path of the
+  directory of the ignore file with a trailing separator. The last rule which
+  matches wins.
+  """
+  ignored = False
+  for directory_prefix, rules in rule_stack:
+    relpath = path[len(directory_prefix):]
+    for rule in rules:
+      if rule.matches(relpath, name, is_dir):
+        ignored = not rule.negated
+  return ignored
+
+
+def is_excluded(excludes, relpath, name):
+  """
+  Return true if the name of a file or directory, or its path relative to the
+  directory being searched, matches any of the ``excludes`` globs.
+  """
+  for pattern in excludes:
+    if fnmatch.fnmatch(relpath, pattern) or fnmatch.fnmatch(name, pattern):
+      return True
+  return False
+
+
+def warn_skipped(path, err):
+  """
+  Report on stderr that ``path`` is skipped because it couldn't be read.
+  """
+  sys.stderr.write('Skipping {}: {}\n'.format(path, err.strerror or err))
+
+
+def list_directory(directory):
+  """
+  Return a sorted list of (name, is_dir, size) for the subdirectories and
+  listfiles in a directory. Symbolic links to directories are not followed.
+  ``size`` is zero for directories. Like ``find``, a directory or entry which
+  can't be read (e.g. it was removed while searching) is reported on stderr
+  and skipped.
+  """
+  entries = []
+  try:
+    if scandir is not None:
+      listing = list(scandir(directory))
+    else:
+      listing = os.listdir(directory)
+  except OSError as err:
+    warn_skipped(directory, err)
+    return entries
+
+  if scandir is not None:
+    for entry in listing:
+      try:
+        if entry.is_dir(follow_symlinks=False):
+          entries.append((entry.name, True, 0))
+        elif is_listfile(entry.name) and entry.is_file():
+          entries.append((entry.name, False, entry.stat().st_size))
+      except OSError as err:
+        warn_skipped(entry.path, err)
+  else:
+    for name in listing:
+      path = os.path.join(directory, name)
+      if os.path.isdir(path) and not os.path.islink(path):
+        entries.append((name, True, 0))
+      elif is_listfile(name) and os.path.isfile(path):
+        entries.append((name, False, get_file_size(path)))
+  entries.sort()
+  return entries
+
+
+def iter_listfiles(paths, excludes=None):
+  """
+  Generate (path, size) for each listfile (``CMakeLists.txt`` or
+  ``*.cmake``) in the directory trees rooted at ``paths``, as it is found.
+  Paths which are files are generated as they are. Files and directories
+  which match one of the ``excludes`` globs, or a rule of an ignore file (see
+  kIgnoreFilenames) in their directory or above it, are skipped.
+  """
+  if excludes is None:
+    excludes = []
+
+  for root in paths:
+    if not os.path.isdir(root):
+      yield root, get_file_size(root)
+      continue
+
+    root_prefix = os.path.join(root, '')
+    # Each entry is (directory, rule_stack), where rule_stack holds the ignore
+    # rules which apply to the directory. Directories are visited depth-first
+    # in sorted order.
+    stack = [(root, [])]
+    while stack:
+      directory, rule_stack = stack.pop(-1)
+      rules = read_ignore_rules(directory)
+      if rules:
+        rule_stack = rule_stack + [(os.path.join(directory, ''), rules)]
+
+      subdirs = []
+      for name, is_dir, size in list_directory(directory):
+        path = os.path.join(directory, name)
+        if (is_excluded(excludes, path[len(root_prefix):], name)
+            or is_ignored(rule_stack, path, name, is_dir)):
+          continue
+        if is_dir:
+          if name not in kSkipDirnames:
+            subdirs.append((path, rule_stack))
+        else:
+          yield path, size
+      stack.extend(reversed(subdirs))
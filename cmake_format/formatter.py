@@ -1,6 +1,15 @@
+import bisect
+import functools
+import hashlib
+import json
 import re
 import textwrap
 
+try:
+  import numpy
+except ImportError:
+  numpy = None
+
 from cmake_format import commands
 from cmake_format import lexer
 from cmake_format import parser
@@ -9,12 +18,23 @@ from cmake_format import parser
 NOTE_REGEX = re.compile(r'^[A-Z_]+\([^)]+\):.*')
 
 
+# Names of the attributes of a Configuration which are options that a config
+# file may set. The other attributes hold state which is built from the config
+# file (e.g. ``additional_commands``) or while formatting.
+kConfigOptions = ['line_width', 'tab_size', 'max_subargs_per_line',
+                  'linear_lexer', 'layout_engine']
+
+# Values accepted for Configuration.layout_engine
+kLayoutEngines = ['heuristic', 'optimal']
+
+
 class Configuration(object):
   """
   Encapsulates various configuration options/parameters for formatting
   """
 
-  def __init__(self, line_width=80, tab_size=2, max_subargs_per_line=3):
+  def __init__(self, line_width=80, tab_size=2, max_subargs_per_line=3,
+               linear_lexer=False, layout_engine='heuristic'):
     self.line_width = line_width
     self.tab_size = tab_size
     # TODO(josh): make this conditioned on certain commands / kwargs
@@ -22,7 +42,18 @@ class Configuration(object):
     # formatted as a single list. In fact... special case COMMAND to break on
     # flags the way we do kwargs.
     self.max_subargs_per_line = max_subargs_per_line
+    # If true, lex with rules that are guaranteed to run in linear time (see
+    # lexer.LINEAR_LEXER_RULES)
+    self.linear_lexer = linear_lexer
+    # Either 'heuristic', to lay out statements with format_command(), or
+    # 'optimal', to choose the layout of least cost with
+    # layout.format_command()
+    self.layout_engine = layout_engine
     self.fn_spec = commands.get_fn_spec()
+    self.block_spec = parser.get_block_spec()
+    # Layouts of argument lists computed while formatting (see
+    # memoize_layout())
+    self.layout_cache = LRUCache(kLayoutCacheSize)
 
   def merge(self, config_dict):
     """
@@ -32,16 +63,143 @@ class Configuration(object):
     """
 
     for key, value in config_dict.iteritems():
-      if hasattr(self, key):
+      if key in kConfigOptions:
         setattr(self, key, value)
+    self.validate()
+
+  def validate(self):
+    """
+    Raise a ValueError if any option has a value that the formatter can't
+    use.
+    """
+    if self.layout_engine not in kLayoutEngines:
+      raise ValueError('Unknown layout_engine {!r}, expected one of {}'.format(
+          self.layout_engine, ', '.join(kLayoutEngines)))
 
   def clone(self):
     """
     Return a copy of self.
     """
-    kwargs = {key: getattr(self, key)
-              for key in ['line_width', 'tab_size', 'max_subargs_per_line']}
-    return Configuration(**kwargs)
+    kwargs = {key: getattr(self, key) for key in kConfigOptions}
+    config = Configuration(**kwargs)
+    # only the commands and blocks declared on top of the
+    # built-in ones are copied, the built-in command specifications are
+    # shared.
+    config.fn_spec = self.fn_spec.copy()
+    config.block_spec = dict(self.block_spec)
+    # the layout cache is keyed on every value that the layout
+    # depends on, so clones can share it.
+    config.layout_cache = self.layout_cache
+    return config
+
+  def get_digest(self):
+    """
+    Return a hex digest of every value of this configuration which affects
+    the formatted output. Of the command specifications, only those added by
+    the configuration are included, the built-in ones only change with the
+    version of cmake-format.
+    """
+    state = {key: getattr(self, key) for key in kConfigOptions}
+    state['fn_spec'] = self.fn_spec.overrides
+    state['block_spec'] = self.block_spec
+    return hashlib.sha1(json.dumps(state, sort_keys=True)).hexdigest()
+
+
+# Maximum number of argument-list layouts remembered per configuration
+kLayoutCacheSize = 1024
+
+
+class LRUCache(object):
+  """
+  A mapping of bounded size which evicts its least recently used entries when
+  full. Counts cache hits and misses.
+
+  Recency is tracked in two generations: entries are inserted into the
+  current generation and, when it is full, the current generation becomes the
+  previous one and the old previous generation is dropped. An entry found in
+  the previous generation is moved back into the current one. This
+  approximates LRU order with plain dictionary operations.
+  """
+
+  def __init__(self, max_size):
+    self.max_size = max_size
+    self.current = {}
+    self.previous = {}
+    self.hits = 0
+    self.misses = 0
+
+  def get(self, key, default=None):
+    """
+    Return the value stored for ``key`` and mark it as recently used, or return
+    ``default`` if there is no such entry.
+    """
+    value = self.current.get(key, default)
+    if value is default:
+      value = self.previous.pop(key, default)
+      if value is default:
+        self.misses += 1
+        return default
+      self.put(key, value)
+    self.hits += 1
+    return value
+
+  def put(self, key, value):
+    """
+    Store ``value`` for ``key``, evicting the least recently used generation
+    of entries if the cache is full.
+    """
+    if len(self.current) * 2 >= self.max_size:
+      self.previous = self.current
+      self.current = {}
+    self.current[key] = value
+
+  def clear(self):
+    """
+    Remove all entries and reset the counters.
+    """
+    self.current = {}
+    self.previous = {}
+    self.hits = 0
+    self.misses = 0
+
+  def __len__(self):
+    return len(self.current) + len(self.previous)
+
+
+def get_args_key(args):
+  """
+  Return a hashable key for a list of arguments, composed of the only parts
+  of them which affect their layout: their contents and comments.
+  """
+  if arg_exists_with_comment(args):
+    return tuple((arg.contents,) + tuple(arg.comments) for arg in args)
+  return tuple([arg.contents for arg in args])
+
+
+def memoize_layout(layout_fun):
+  """
+  Decorate a function ``layout_fun(config, line_width, command_name, args)``
+  which returns a list of lines, so that its results are remembered in
+  ``config.layout_cache``. The key is composed of everything that the layout
+  depends on: the line width, the command and its spec, the configuration
+  values that affect layout, and the arguments. Lines returned from the cache
+  are shared, so callers must not modify them.
+  """
+
+  @functools.wraps(layout_fun)
+  def memoized_layout_fun(config, line_width, command_name, args):
+    # the command spec is stored along with the lines so that its
+    # id() can't be reused while the entry exists.
+    cmd_spec = config.fn_spec.get(command_name)
+    key = (layout_fun, line_width, command_name, id(cmd_spec),
+           config.tab_size, config.max_subargs_per_line, get_args_key(args))
+    entry = config.layout_cache.get(key)
+    if entry is None:
+      entry = (layout_fun(config, line_width, command_name, args), cmd_spec)
+      config.layout_cache.put(key, entry)
+    return entry[0]
+
+  return memoized_layout_fun
 
 
 def indent_list(indent_str, lines):
@@ -50,25 +208,108 @@ def indent_list(indent_str, lines):
   """
   return [indent_str + line for line in lines]
 
-def stable_wrap(wrapper, paragraph_text):
+
+# Splits text into the chunks that textwrap breaks lines between: runs of
+# whitespace, words, and the parts of hyphenated words
+kWordSepRegex = textwrap.TextWrapper.wordsep_re
+
+# Matches the whitespace characters which textwrap replaces with a space
+kWhitespaceRegex = re.compile(r'[\t\n\x0b\x0c\r]')
+
+# Maximum number of reflowed comment paragraphs remembered across files
+kReflowCacheSize = 4096
+
+# Reflowed comment paragraphs, keyed by (paragraph text, line width)
+kReflowCache = LRUCache(kReflowCacheSize)
+
+
+def paragraph_conforms(paragraph_text, width):
+  """
+  Return true if the lines of ``paragraph_text`` are already wrapped the way
+  wrap_paragraph() would wrap them within ``width`` chars (not counting the
+  comment prefix): each line is non-empty, fits, has no whitespace to drop at
+  either end, and the first chunk of each line would not fit at the end of
+  the line before it.
   """
-  textwrap doesn't appear to be stable. We run it multiple times until it
-  converges
+  prev_len = None
+  for line in paragraph_text.split('\n'):
+    if (not line or len(line) > width or line[:1].isspace()
+        or line[-1:].isspace() or kWhitespaceRegex.search(line)):
+      return False
+    if prev_len is not None:
+      first_chunk = next(chunk for chunk in kWordSepRegex.split(line, 1)
+                         if chunk)
+      if prev_len + 1 + len(first_chunk) <= width:
+        return False
+    prev_len = len(line)
+  return True
+
+
+def wrap_paragraph(paragraph_text, line_width):
   """
+  Wrap the text of a comment paragraph into lines of at most line_width chars,
+  each starting with ``# ``. Lines are filled greedily with the chunks that
+  textwrap would use, and whitespace at line breaks is dropped.
+
+  textwrap alone is not stable: a run of spaces at a line break becomes a
+  single newline, so wrapping its output again may fit one more word on a
+  line. Here, a run of whitespace after which the next chunk would not fit
+  but would fit after a single space is collapsed into a single space first,
+  so that wrapping the output again returns the same lines.
+  """
+  width = max(line_width - 2, 1)
+  if paragraph_conforms(paragraph_text, width):
+    return ['# ' + line for line in paragraph_text.split('\n')]
+
+  text = kWhitespaceRegex.sub(' ', paragraph_text.expandtabs())
+  chunks = [chunk for chunk in kWordSepRegex.split(text) if chunk]
+  chunks.reverse()
 
-  history = [paragraph_text]
-  prev_text = paragraph_text
-  for _ in range(8):
-    lines = wrapper.wrap(prev_text)
-    next_text = '\n'.join(line[2:] for line in lines)
-    if next_text == prev_text:
-      return lines
-    prev_text = next_text
-    history.append(next_text)
+  lines = []
+  while chunks:
+    if lines and not chunks[-1].strip():
+      chunks.pop()
+      continue
 
+    cur_line = []
+    cur_len = 0
+    while chunks:
+      chunk = chunks[-1]
+      if not chunk.strip() and cur_line and len(chunks) > 1:
+        next_len = len(chunks[-2])
+        if (cur_len + len(chunk) + next_len > width
+            and cur_len + 1 + next_len <= width):
+          chunk = chunks[-1] = ' '
+      if cur_len + len(chunk) > width:
+        break
+      cur_line.append(chunks.pop())
+      cur_len += len(chunk)
+
+    # Break chunks that are wider than a line across lines
+    if chunks and len(chunks[-1]) > width and cur_len < width:
+      space_left = width - cur_len
+      cur_line.append(chunks[-1][:space_left])
+      chunks[-1] = chunks[-1][space_left:]
+
+    while cur_line and not cur_line[-1].strip():
+      cur_line.pop()
+    if cur_line:
+      lines.append('# ' + ''.join(cur_line))
+  return lines
+
+
+def reflow_paragraph(paragraph_text, line_width):
+  """
+  Return wrap_paragraph(paragraph_text, line_width), remembering the result
+  in kReflowCache. The returned list is shared, so callers must not modify it.
+  """
+  key = (paragraph_text, line_width)
+  lines = kReflowCache.get(key)
+  if lines is None:
+    lines = wrap_paragraph(paragraph_text, line_width)
+    kReflowCache.put(key, lines)
+  return lines
 
-  assert False, ("textwrap failed to converge on:\n\n {}"
-                 .format('\n\n'.join(history)))
 
 def format_comment_block(config, line_width,  # pylint: disable=unused-argument
                          comment_lines):
@@ -102,25 +343,31 @@ def format_comment_block(config, line_width,  # pylint: disable=unused-argument
     if not paragraph_text:
       lines.append('#')
       continue
-    wrapper = textwrap.TextWrapper(width=line_width,
-                                   expand_tabs=True,
-                                   replace_whitespace=True,
-                                   drop_whitespace=True,
-                                   initial_indent='# ',
-                                   subsequent_indent='# ')
-
-    lines.extend(stable_wrap(wrapper, paragraph_text))
+    lines.extend(reflow_paragraph(paragraph_text, line_width))
   return lines
 
 
-def is_flag(fn_spec, command_name, arg):
-  """Return true if the given argument is a flag."""
-  return fn_spec.get(command_name, {}).get(arg, 1) == 0
+def classify_args(fn_spec, command_name, args):
+  """
+  Tag each of the arguments of a command which is not yet tagged with its
+  role (see commands.ArgClassifier). The tags are kept on the arguments, so
+  every layout of the same statement reuses them.
+  """
+  classifier = None
+  for arg in args:
+    if arg.role is None:
+      if classifier is None:
+        classifier = fn_spec.get_classifier(command_name)
+      arg.role = classifier.roles.get(arg.contents, commands.PARG)
 
 
-def is_kwarg(fn_spec, command_name, arg):
-  """Return true if the given argument is a kwarg."""
-  return fn_spec.get(command_name, {}).get(arg, 0) != 0
+def get_arg_role(fn_spec, command_name, arg):
+  """
+  Return the role of an argument of a command, tagging it if it isn't yet.
+  """
+  if arg.role is None:
+    classify_args(fn_spec, command_name, [arg])
+  return arg.role
 
 
 def split_args_by_kwargs(fn_spec, command_name, args):
@@ -130,13 +377,14 @@ def split_args_by_kwargs(fn_spec, command_name, args):
   followed by it's sub arguments, or a list containing a consecutive
   sequence of flags.
   """
+  classify_args(fn_spec, command_name, args)
   arg_split = [[]]
   for arg in args:
-    if is_flag(fn_spec, command_name, arg.contents):
+    if arg.role == commands.FLAG:
       if arg_split[-1]:
-        if not is_flag(fn_spec, command_name, arg_split[-1][-1].contents):
+        if arg_split[-1][-1].role != commands.FLAG:
           arg_split.append([])
-    elif is_kwarg(fn_spec, command_name, arg.contents):
+    elif arg.role == commands.KWARG:
       if arg_split[-1]:
         arg_split.append([])
     arg_split[-1].append(arg)
@@ -191,9 +439,9 @@ def format_shell_command(config, line_width, command_name, args):
   """Format arguments into a block with at most line_width chars."""
 
   if not arg_exists_with_comment(args):
-    single_line = ' '.join([arg.contents for arg in args])
-    if len(single_line) < line_width:
-      return [single_line]
+    contents = [arg.contents for arg in args]
+    if sum(len(arg) for arg in contents) + len(contents) - 1 < line_width:
+      return [' '.join(contents)]
 
   lines = []
   arg_multilist = split_shell_command(args)
@@ -232,6 +480,67 @@ def join_parens(args):
   return out
 
 
+# Argument lists at least this long are packed with numpy, if available
+kNumpyMinArgs = 256
+
+
+def get_packing_offsets(widths):
+  """
+  Return the cumulative widths of arguments, each followed by a single space:
+  ``offsets[i]`` is the width of the first ``i`` arguments.
+  """
+  if numpy is not None and len(widths) >= kNumpyMinArgs:
+    offsets = numpy.empty(len(widths) + 1, dtype=numpy.int64)
+    offsets[0] = 0
+    numpy.cumsum(numpy.array(widths, dtype=numpy.int64) + 1, out=offsets[1:])
+    return offsets
+
+  offsets = [0]
+  total = 0
+  for width in widths:
+    total += width + 1
+    offsets.append(total)
+  return offsets
+
+
+def pack_arg_contents(contents, line_width):
+  """
+  Return the same lines as pack_args() for arguments without comments, but
+  decide where to break lines from the cumulative widths of the arguments
+  and only build the strings of the final lines.
+
+  An argument is appended to a line if the line, a space, the argument and
+  one more column fit within line_width. A line starting at argument ``i``
+  therefore extends up to the last argument ``k - 1`` for which
+  ``offsets[k] - offsets[i] < line_width``.
+  """
+  offsets = get_packing_offsets([len(arg) for arg in contents])
+  if numpy is not None and not isinstance(offsets, list):
+    # Find the break for every possible start of a line in one vectorized
+    # search, since a search per line would mostly pay numpy's call overhead.
+    breaks = (numpy.searchsorted(offsets, offsets[:-1] + line_width)
+              - 1).tolist()
+    find_break = breaks.__getitem__
+  else:
+    def find_break(start):
+      return bisect.bisect_left(offsets, offsets[start] + line_width) - 1
+
+  # pack_args() starts with an empty line and only appends the
+  # first argument to it if it fits. Otherwise that empty line is kept.
+  lines = []
+  if len(contents[0]) + 2 >= line_width:
+    lines.append('')
+
+  start = 0
+  num_args = len(contents)
+  while start < num_args:
+    end = max(find_break(start), start + 1)
+    lines.append(' '.join(contents[start:end]))
+    start = end
+  return lines
+
+
+@memoize_layout
 def format_arglist(config, line_width, command_name, args):
   """
   Given a list arguments containing at most one KWARG (in position [0]
@@ -240,7 +549,7 @@ def format_arglist(config, line_width, command_name, args):
   if len(args) < 1:
     return []
 
-  if is_kwarg(config.fn_spec, command_name, args[0].contents):
+  if get_arg_role(config.fn_spec, command_name, args[0]) == commands.KWARG:
     kwarg = args[0].contents
 
     if len(args) == 1:
@@ -315,6 +624,20 @@ def format_arglist(config, line_width, command_name, args):
         lines.append(indent_str + line)
     return lines
 
+  if not arg_exists_with_comment(args):
+    return pack_arg_contents([arg.contents for arg in args], line_width)
+
+  return pack_args(config, line_width, args)
+
+
+def pack_args(config, line_width, args):
+  """
+  Greedily pack arguments into lines of at most line_width chars, moving an
+  argument to a new line if it doesn't fit at the end of the current one (or
+  if that would take many more lines, because of its comments).
+  """
+  indent_str = ''
+  lines = ['']
   for arg in args:
     # Lines to add if we were to put the arg at the end of the current
     # line.
@@ -348,17 +671,12 @@ def format_arglist(config, line_width, command_name, args):
   return lines
 
 
-def format_args(config, line_width, command_name, args):
-  """Format arguments into a block with at most line_width chars."""
-
-  # If there are no arguments that contain a comment, then attempt to
-  # pack all of the arguments onto a single line
-  if not arg_exists_with_comment(args):
-    single_line = ' '.join(join_parens([arg.contents for arg in args]))
-    if len(single_line) < line_width:
-      return [single_line]
-
-  lines = []
+def group_args(config, command_name, args):
+  """
+  Split arguments into a list of sublists at each KWARG and each run of flags
+  (see split_args_by_kwargs()), then join strings of single arguments
+  together, up to max_subargs_per_line per sublist.
+  """
   arg_multilist = split_args_by_kwargs(config.fn_spec, command_name, args)
 
   # Look for strings of single arguments that can be joined together
@@ -372,7 +690,35 @@ def format_args(config, line_width, command_name, args):
     else:
       arg_multilist_filtered.append(arg_sublist)
 
-  for arg_sublist in arg_multilist_filtered:
+  return arg_multilist_filtered
+
+
+def format_args(config, line_width, command_name, args):
+  """Format arguments into a block with at most line_width chars."""
+
+  # If there are no arguments that contain a comment, then attempt to
+  # pack all of the arguments onto a single line
+  if not arg_exists_with_comment(args):
+    contents = [arg.contents for arg in args]
+    # Joining parenthesis only removes spaces, so the line can't be shorter
+    # than the contents of the arguments.
+    if sum(len(arg) for arg in contents) < line_width:
+      single_line = ' '.join(join_parens(contents))
+      if len(single_line) < line_width:
+        return [single_line]
+
+  return format_args_by_kwargs(config, line_width, command_name, args)
+
+
+@memoize_layout
+def format_args_by_kwargs(config, line_width, command_name, args):
+  """
+  Format arguments which don't fit on a single line into a block with at most
+  line_width chars, by splitting them into groups at each KWARG.
+  """
+
+  lines = []
+  for arg_sublist in group_args(config, command_name, args):
     sublist_lines = format_arglist(config, line_width, command_name,
                                    arg_sublist)
     lines.extend(sublist_lines)
@@ -464,17 +810,90 @@ def write_indented(outfile, indent_str, lines):
     outfile.write('\n')
 
 
+# Number of characters of output buffered before they are written out
+kOutputBufferSize = 1 << 20
+
+
+class OutputBuffer(object):
+  """
+  Accumulates output text in a list of strings. The text is written to
+  ``outfile`` in a single call when the buffer is flushed, or once more than
+  kOutputBufferSize characters are pending. If ``outfile`` is None the text
+  is only accumulated, see getvalue().
+  """
+
+  __slots__ = ('outfile', 'parts', 'size')
+
+  def __init__(self, outfile=None):
+    self.outfile = outfile
+    self.parts = []
+    self.size = 0
+
+  def write(self, text):
+    """
+    Append text to the buffer.
+    """
+    self.parts.append(text)
+    self.size += len(text)
+    if self.size > kOutputBufferSize and self.outfile is not None:
+      self.flush()
+
+  def write_lines(self, indent_str, lines):
+    """
+    Append lines prefixed with indent_str and stripped of trailing whitespace,
+    separated by newlines. No newline is appended after the last line.
+    """
+    self.write(indent_str + ('\n' + indent_str).join(
+        [line.rstrip() for line in lines]))
+
+  def flush(self):
+    """
+    Write the pending text to ``outfile``, if there is one.
+    """
+    if self.outfile is not None and self.parts:
+      self.outfile.write(''.join(self.parts))
+      self.parts = []
+      self.size = 0
+
+  def getvalue(self):
+    """
+    Return the text which is pending in the buffer.
+    """
+    return ''.join(self.parts)
+
+
 class TreePrinter(object):
   """
   Maintains printing state and implements node printers for various types of
-  nodes in the full-syntax-tree.
+  nodes in the full-syntax-tree. Output is buffered (see OutputBuffer) and
+  written to ``outfile`` when printing of a stream of events or of a whole
+  tree is done. If ``outfile`` is None the output is kept in ``self.outfile``.
+
+  If the ``source`` text of the listfile is given, regions where the
+  formatter is inactive are printed as a single slice of it, and the nodes
+  within them are never looked at. Otherwise their tokens are printed one by
+  one.
   """
 
-  def __init__(self, config, outfile):
+  def __init__(self, config, outfile=None, source=None):
     self.config = config
-    self.outfile = outfile
+    self.outfile = OutputBuffer(outfile)
+    self.source = source
     self.scope_depth = 0
     self.active = True
+    # Offset in source at which the current inactive region starts
+    self.passthrough_start = None
+    # Indentation strings, indexed by scope depth
+    self.indent_strs = ['']
+
+    if config.layout_engine == 'optimal':
+      # imported here because the layout module depends on this
+      # one.
+      from cmake_format import layout
+      self.format_command = layout.format_command
+    else:
+      config.validate()
+      self.format_command = format_command
 
   def get_indent_size(self):
     """
@@ -486,7 +905,10 @@ class TreePrinter(object):
     """
     Return an indentation string appropriate for the current scope depth.
     """
-    return ' ' * self.get_indent_size()
+    while self.scope_depth >= len(self.indent_strs):
+      self.indent_strs.append(
+          ' ' * (self.config.tab_size * len(self.indent_strs)))
+    return self.indent_strs[self.scope_depth]
 
   def get_line_width(self):
     """
@@ -497,11 +919,10 @@ class TreePrinter(object):
 
   def print_block(self, node):
     """
-    Print a block node. Block nodes don't have content, so we just recurse and
-    print all children.
+    Print a block node. Block nodes don't have content, so we just print all
+    of the nodes nested within it.
     """
-    for child in node.children:
-      self.print_node(child)
+    self.print_nodes(parser.iter_fst_events(node))
 
   def print_comment_tokens(self, tokens):
     """
@@ -524,16 +945,44 @@ class TreePrinter(object):
       if not lines:
         return
 
-      for line in lines[:-1]:
-        self.outfile.write(self.get_indent())
-        self.outfile.write(line.rstrip())
-        self.outfile.write('\n')
-      self.outfile.write(self.get_indent())
-      self.outfile.write(lines[-1].rstrip())
+      self.outfile.write_lines(self.get_indent(), lines)
     else:
+      self.print_passthrough(tokens)
+
+  def print_passthrough(self, tokens):
+    """
+    Print tokens of an inactive region the same way they were in the input
+    file. If the source is known they are printed with the rest of the region
+    by end_passthrough() instead.
+    """
+    if self.source is None:
       for token in tokens:
         self.outfile.write(token.content)
 
+  def start_passthrough(self, token):
+    """
+    Deactivate the formatter, starting an inactive region at ``token``.
+    """
+    self.active = False
+    self.passthrough_start = token.offset
+
+  def end_passthrough(self, tokens):
+    """
+    Print the inactive region which ends with ``tokens`` and activate the
+    formatter again. If ``tokens`` is None the region extends to the end of
+    the source.
+    """
+    if self.source is None:
+      if tokens:
+        self.print_passthrough(tokens)
+    elif tokens is None:
+      self.outfile.write(self.source[self.passthrough_start:])
+    else:
+      end = tokens[-1].offset + len(tokens[-1].content)
+      self.outfile.write(self.source[self.passthrough_start:end])
+    self.active = True
+    self.passthrough_start = None
+
   def print_comment(self, node):
     """
     Print a comment node. A comment node is composed of a continuous sequence
@@ -548,18 +997,20 @@ class TreePrinter(object):
     tokens = list(node.content.tokens)
     while tokens:
       token = tokens.pop(0)
-      if token.type == lexer.FORMAT_OFF:
+      if token.type == lexer.FORMAT_OFF and self.active:
         self.print_comment_tokens(cache)
         if cache:
           self.outfile.write('\n')
         cache = [token]
-        self.active = False
+        self.start_passthrough(token)
       elif token.type == lexer.FORMAT_ON:
         cache.append(token)
         if tokens and tokens[0].type == lexer.NEWLINE:
           cache.append(tokens.pop(0))
-        self.print_comment_tokens(cache)
-        self.active = True
+        if self.active:
+          self.print_comment_tokens(cache)
+        else:
+          self.end_passthrough(cache)
         cache = []
       else:
         if self.active:
@@ -583,53 +1034,101 @@ class TreePrinter(object):
         self.outfile.write('\n\n')
       else:
         self.outfile.write('\n')
-    else:
-      for token in node.content.tokens:
-        self.outfile.write(token.content)
+    elif self.source is None:
+      self.print_passthrough(node.content.tokens)
 
   def print_statement(self, node):
     """
     Print a cmake statement. The format function will return a list of formatted
     lines so if the formatter is active we just print those lines out with an
     appropriate indentation. If the formatter is inactive we just print out
-    all the tokens in the same way they were in the infile.
+    all the tokens in the same way they were in the infile. The statements in
+    the body of a block statement are not printed (see print_nodes()).
     """
 
     if self.active:
-      lines = format_command(self.config, node, self.get_line_width())
-      for line in lines[:-1]:
-        self.outfile.write(self.get_indent())
-        self.outfile.write(line.rstrip())
-        self.outfile.write('\n')
-      self.outfile.write(self.get_indent())
-      self.outfile.write(lines[-1].rstrip())
-    else:
-      for token in node.prefix_tokens:
-        self.outfile.write(token.content)
-      for arg in node.body:
-        for token in arg.tokens:
-          self.outfile.write(token.content)
-      for token in node.postfix_tokens:
-        self.outfile.write(token.content)
+      lines = self.format_command(self.config, node, self.get_line_width())
+      self.outfile.write_lines(self.get_indent(), lines)
+    elif self.source is None:
+      self.print_passthrough(node.content.tokens)
 
-    self.scope_depth += 1
-    self.print_block(node)
-    self.scope_depth -= 1
+  def print_nodes(self, events):
+    """
+    Print the nodes of a stream of parse events (see parser.iter_events() and
+    parser.iter_fst_events()), indenting the body of each block statement by
+    one more level than the statement.
+    """
+    for event_type, node in events:
+      if event_type == parser.STATEMENT_EVENT:
+        self.print_statement(node)
+      elif event_type == parser.COMMENT_EVENT:
+        self.print_comment(node)
+      elif event_type == parser.WHITESPACE_EVENT:
+        self.print_whitespace(node)
+      elif event_type == parser.START_BODY_EVENT:
+        self.scope_depth += 1
+      elif event_type == parser.END_BODY_EVENT:
+        self.scope_depth -= 1
+
+  def print_events(self, events):
+    """
+    Print the nodes of a stream of parse events (see parser.iter_events()) as
+    they arrive. Produces the same output as print_node() on the
+    corresponding tree, but without the tree ever being built.
+    """
+    self.print_nodes(events)
+    if not self.active:
+      self.end_passthrough(None)
+    self.outfile.flush()
 
   def print_node(self, node):
     """
-    Print dispatch: will call the correct print function depending on the type
-    of node.
-    """
-    if node.node_type == parser.BLOCK_NODE:
-      self.print_block(node)
-    elif node.node_type == parser.COMMENT_NODE:
-      self.print_comment(node)
-    elif node.node_type == parser.WHITESPACE_NODE:
-      self.print_whitespace(node)
-    elif node.node_type == parser.STATEMENT_NODE:
-      self.print_statement(node)
+    Print a node and everything nested within it. The tree is traversed with
+    an explicit stack (see parser.iter_fst_events()), so deeply nested blocks
+    don't exhaust the python stack. The output is written to ``outfile`` when
+    the node is done, except for an inactive region which continues past the
+    end of a node other than the root.
+    """
+    if (node.node_type == parser.BLOCK_NODE
+        and node.block_type == parser.ROOT):
+      self.print_events(parser.iter_fst_events(node))
     else:
-      assert False, ("Unrecognized node type: {} ({})"
-                     .format(parser.kNodeTypeToStr(node.node_type),
-                             node.node_type))
+      self.print_nodes(parser.iter_fst_events(node))
+      self.outfile.flush()
+
+
+def tokenize_source(config, source):
+  """
+  Tokenize the text of a listfile for printing by a TreePrinter which is given
+  the same ``source``. The interior of each region where formatting is turned
+  off is kept as a single token, unless it opens or closes a block which
+  extends beyond the region.
+  """
+  return lexer.tokenize_compact(
+      source, linear=config.linear_lexer,
+      collapse_inactive=functools.partial(parser.blocks_are_balanced,
+                                          config.block_spec))
+
+
+def tokenize_file(config, infile):
+  """
+  Tokenize a listfile as it is read from ``infile``, for printing by a
+  TreePrinter which is not given the source. Inactive regions are kept as
+  single tokens, as by tokenize_source().
+  """
+  return lexer.tokenize_stream(
+      infile, linear=config.linear_lexer,
+      collapse_inactive=functools.partial(parser.blocks_are_balanced,
+                                          config.block_spec))
+
+
+def format_string(source, config=None):
+  """
+  Format the text of a cmake listfile and return the formatted text.
+  """
+  if config is None:
+    config = Configuration()
+  printer = TreePrinter(config, source=source)
+  tokens = tokenize_source(config, source)
+  printer.print_events(parser.parse_events(tokens, config.block_spec))
+  return printer.outfile.getvalue()
@@ -0,0 +1,474 @@
+"""
+An alternative layout engine for cmake statements, selected with
+``layout_engine: optimal``.
+
+A statement is first converted into a document, in the spirit of Wadler's "A
+prettier printer": a tree of text, line breaks, indentation, and alternative
+layouts. solve() then chooses the layout of least cost by dynamic programming
+over (document node, start column, indentation). The cost of a layout is the
+number of characters beyond the line width, then the number of lines. Only
+the few best candidate layouts of each subdocument are kept (see
+kMaxCandidates), which bounds the lookahead of the solver, so the time spent
+is linear in the size of the document for a given line width.
+"""
+
+from cmake_format import commands
+from cmake_format import formatter
+
+# Maximum number of candidate layouts kept for each subdocument at each
+# (start column, indentation)
+kMaxCandidates = 8
+
+# Comments are never reflowed narrower than this, even if they start close to
+# the end of the line.
+kMinCommentWidth = 20
+
+
+class Doc(object):
+  """
+  A node in a layout document. Documents are immutable and may share
+  subdocuments.
+  """
+
+  __slots__ = ()
+
+  def get_candidates(self, col, indent, width, memo):
+    """
+    Return the candidate layouts of this node (see solve()).
+    """
+    raise NotImplementedError()
+
+
+class Text(Doc):
+  """
+  A fragment of text which doesn't contain a newline.
+  """
+
+  __slots__ = ('text',)
+
+  def __init__(self, text):
+    self.text = text
+
+  def get_candidates(self, col, indent, width, memo):
+    return [(0, 1, col + len(self.text), (self.text,))]
+
+
+class Line(Doc):
+  """
+  A line break, followed by indentation to the current indentation level. A
+  ``hard`` line break is mandatory, a soft one becomes a space when its
+  enclosing group is laid out on one line (see flatten()).
+  """
+
+  __slots__ = ('hard',)
+
+  def __init__(self, hard=False):
+    self.hard = hard
+
+  def get_candidates(self, col, indent, width, memo):
+    return [(max(0, col - width), 2, indent, ('', ' ' * indent))]
+
+
+LINE = Line()
+HARDLINE = Line(hard=True)
+SPACE = Text(' ')
+
+
+class Nest(Doc):
+  """
+  Increase the indentation of ``doc`` by ``indent`` columns.
+  """
+
+  __slots__ = ('indent', 'doc')
+
+  def __init__(self, indent, doc):
+    self.indent = indent
+    self.doc = doc
+
+  def get_candidates(self, col, indent, width, memo):
+    return solve(self.doc, col, indent + self.indent, width, memo)
+
+
+class Align(Doc):
+  """
+  Set the indentation of ``doc`` to the column at which it starts.
+  """
+
+  __slots__ = ('doc',)
+
+  def __init__(self, doc):
+    self.doc = doc
+
+  def get_candidates(self, col, indent, width, memo):
+    return solve(self.doc, col, col, width, memo)
+
+
+class Concat(Doc):
+  """
+  The concatenation of ``docs``.
+  """
+
+  __slots__ = ('docs',)
+
+  def __init__(self, docs):
+    self.docs = docs
+
+  def get_candidates(self, col, indent, width, memo):
+    candidates = [(0, 1, col, ('',))]
+    for child in self.docs:
+      joined = []
+      for candidate in candidates:
+        for child_candidate in solve(child, candidate[2], indent, width, memo):
+          joined.append(join(candidate, child_candidate))
+      candidates = prune(joined, width)
+    return candidates
+
+
+class Fill(Doc):
+  """
+  The sequence of ``docs``, each separated from the next by a space or a line
+  break, whichever is cheaper. The separator after ``docs[idx]`` is always a
+  line break if ``hard[idx]`` is true. The sequence is solved left to right
+  in a single loop, so it may be arbitrarily long.
+  """
+
+  __slots__ = ('docs', 'hard')
+
+  def __init__(self, docs, hard):
+    self.docs = docs
+    self.hard = hard
+
+  def get_candidates(self, col, indent, width, memo):
+    candidates = solve(self.docs[0], col, indent, width, memo)
+    for hard, child in zip(self.hard, self.docs[1:]):
+      separators = [HARDLINE] if hard else [SPACE, LINE]
+      joined = []
+      for candidate in candidates:
+        for separator in separators:
+          separated = join(candidate, solve(separator, candidate[2], indent,
+                                            width, memo)[0])
+          for child_candidate in solve(child, separated[2], indent, width,
+                                       memo):
+            joined.append(join(separated, child_candidate))
+      candidates = prune(joined, width)
+    return candidates
+
+
+class Union(Doc):
+  """
+  Any one of ``docs``, which are alternative layouts of the same content in
+  order of preference.
+  """
+
+  __slots__ = ('docs',)
+
+  def __init__(self, docs):
+    self.docs = docs
+
+  def get_candidates(self, col, indent, width, memo):
+    candidates = []
+    for child in self.docs:
+      candidates.extend(solve(child, col, indent, width, memo))
+    return prune(candidates, width)
+
+
+class CommentText(Doc):
+  """
+  A list of comment strings, reflowed to fit between the column at which they
+  start and the end of the line. Reflowed lines are aligned with the first.
+  """
+
+  __slots__ = ('config', 'comments')
+
+  def __init__(self, config, comments):
+    self.config = config
+    self.comments = comments
+
+  def get_candidates(self, col, indent, width, memo):
+    comment_width = max(width - col, kMinCommentWidth)
+    comment_lines = formatter.format_comment_block(self.config, comment_width,
+                                                   self.comments)
+    lines = (tuple(comment_lines[:1])
+             + tuple(' ' * col + line for line in comment_lines[1:]))
+    overflow = sum(max(0, col + len(line) - width)
+                   for line in comment_lines[:-1])
+    return [(overflow, len(lines), col + len(comment_lines[-1]), lines)]
+
+
+def flatten(doc):
+  """
+  Return ``doc`` laid out on a single line, with each soft line break replaced
+  by a space, or None if ``doc`` contains a hard line break. Alternatives are
+  flattened using the first (preferred) one.
+  """
+  if isinstance(doc, Text):
+    return doc
+  elif isinstance(doc, Line):
+    return None if doc.hard else Text(' ')
+  elif isinstance(doc, (Nest, Align)):
+    return flatten(doc.doc)
+  elif isinstance(doc, Concat):
+    parts = []
+    for child in doc.docs:
+      flat_child = flatten(child)
+      if flat_child is None:
+        return None
+      parts.append(flat_child.text)
+    return Text(''.join(parts))
+  elif isinstance(doc, Fill):
+    if any(doc.hard):
+      return None
+    parts = []
+    for child in doc.docs:
+      flat_child = flatten(child)
+      if flat_child is None:
+        return None
+      parts.append(flat_child.text)
+    return Text(' '.join(parts))
+  elif isinstance(doc, Union):
+    return flatten(doc.docs[0])
+  return None
+
+
+def group(doc):
+  """
+  Return a document which is laid out on a single line if it fits, otherwise
+  as ``doc``.
+  """
+  flat_doc = flatten(doc)
+  if flat_doc is None:
+    return doc
+  return Union([flat_doc, doc])
+
+
+class JoinedLines(object):
+  """
+  The lines of two layouts placed one after the other, where the first line
+  of ``second`` continues the last line of ``first``. Joining layouts this
+  way doesn't copy their lines (see get_lines()).
+  """
+
+  __slots__ = ('first', 'second')
+
+  def __init__(self, first, second):
+    self.first = first
+    self.second = second
+
+
+def join(candidate, next_candidate):
+  """
+  Return the candidate layout of ``next_candidate`` placed after
+  ``candidate``.
+  """
+  overflow, num_lines, _, lines = candidate
+  next_overflow, next_num_lines, next_end_col, next_lines = next_candidate
+  return (overflow + next_overflow, num_lines + next_num_lines - 1,
+          next_end_col, JoinedLines(lines, next_lines))
+
+
+def get_lines(lines):
+  """
+  Return the list of strings of the ``lines`` of a candidate layout, which is
+  either a tuple of strings or JoinedLines.
+  """
+  result = ['']
+  stack = [lines]
+  while stack:
+    lines = stack.pop(-1)
+    if isinstance(lines, JoinedLines):
+      stack.append(lines.second)
+      stack.append(lines.first)
+    else:
+      result[-1] += lines[0]
+      result.extend(lines[1:])
+  return result
+
+
+def prune(candidates, width):
+  """
+  Sort candidate layouts by cost, drop those which are dominated by another
+  candidate and keep at most kMaxCandidates. The cost includes the characters
+  of the last line which are already beyond ``width``. Ties keep their
+  original order, which is the order of preference.
+  """
+  if len(candidates) < 2:
+    return candidates
+  candidates.sort(key=lambda candidate: (
+      candidate[0] + max(0, candidate[2] - width),) + candidate[1:3])
+  kept = []
+  for candidate in candidates:
+    overflow, num_lines, end_col, _ = candidate
+    dominated = False
+    for other_overflow, other_num_lines, other_end_col, _ in kept:
+      if (other_overflow <= overflow and other_num_lines <= num_lines
+          and other_end_col <= end_col):
+        dominated = True
+        break
+    if not dominated:
+      kept.append(candidate)
+      if len(kept) >= kMaxCandidates:
+        break
+  return kept
+
+
+def solve(doc, col, indent, width, memo):
+  """
+  Return a list of candidate layouts for ``doc`` when it starts at column
+  ``col`` with indentation ``indent``. Each candidate is a tuple of
+  (overflow, num_lines, end_col, lines). ``overflow`` is the number of
+  characters beyond ``width`` on all but the last line, ``end_col`` is the
+  column after the last character, and ``lines`` is a tuple of strings (or
+  JoinedLines, see get_lines()) of which the first continues the line at
+  ``col``. ``memo`` maps
+  (id(doc), col, indent) to the candidates that have already been computed.
+  """
+  key = (id(doc), col, indent)
+  candidates = memo.get(key)
+  if candidates is None:
+    candidates = doc.get_candidates(col, indent, width, memo)
+    memo[key] = candidates
+  return candidates
+
+
+def layout_doc(doc, width):
+  """
+  Return the list of lines of the least-cost layout of ``doc`` starting at
+  column zero.
+  """
+  candidates = solve(doc, 0, 0, width, {})
+  best = min(candidates, key=lambda candidate: (
+      candidate[0] + max(0, candidate[2] - width), candidate[1]))
+  return get_lines(best[3])
+
+
+def get_atoms(args):
+  """
+  Return a list of (text, comments) for a list of arguments, with parenthesis
+  joined to the argument which they are nearest (see formatter.join_parens()).
+  """
+  atoms = []
+  prefix = ''
+  for arg in args:
+    if arg.contents == '(' and not arg.comments:
+      prefix += arg.contents
+    elif arg.contents == ')' and atoms and not atoms[-1][1]:
+      atoms[-1] = (atoms[-1][0] + arg.contents, arg.comments)
+    else:
+      atoms.append((prefix + arg.contents, arg.comments))
+      prefix = ''
+  if prefix:
+    atoms.append((prefix, []))
+  return atoms
+
+
+def get_atom_doc(config, atom):
+  """
+  Return the document for a single (text, comments) atom. An atom with
+  comments must be followed by a hard line break.
+  """
+  text, comments = atom
+  if not comments:
+    return Text(text)
+  return Concat([Text(text + ' '), CommentText(config, comments)])
+
+
+def get_sequence_doc(config, atoms, fill):
+  """
+  Return the document for a sequence of atoms. If ``fill`` is true, each
+  atom goes on the current line if that is cheaper, otherwise the atoms go
+  one per line.
+  """
+  docs = [get_atom_doc(config, atom) for atom in atoms]
+  if not fill:
+    parts = [docs[0]]
+    for atom, doc in zip(atoms[:-1], docs[1:]):
+      parts.append(HARDLINE if atom[1] else LINE)
+      parts.append(doc)
+    return Concat(parts)
+
+  if len(docs) == 1:
+    return docs[0]
+  return Fill(docs, [bool(atom[1]) for atom in atoms[:-1]])
+
+
+def get_sublist_doc(config, command_name, args):
+  """
+  Return the document for one group of arguments of a statement (see
+  formatter.group_args()). A group led by a KWARG has its subarguments either
+  aligned after the KWARG or on the following lines, indented.
+  """
+  max_subargs = config.max_subargs_per_line
+  if (len(args) > 1 and formatter.get_arg_role(
+      config.fn_spec, command_name, args[0]) == commands.KWARG):
+    kwarg_atom = get_atoms(args[:1])[0]
+    atoms = get_atoms(args[1:])
+    fill = kwarg_atom[0] == 'COMMAND' or len(atoms) <= max_subargs
+    subargs_doc = get_sequence_doc(config, atoms, fill)
+    kwarg_doc = get_atom_doc(config, kwarg_atom)
+    tabbed_doc = Concat([kwarg_doc, Nest(config.tab_size, Concat(
+        [HARDLINE if kwarg_atom[1] else LINE, subargs_doc]))])
+    if kwarg_atom[1]:
+      return tabbed_doc
+    return Union([Concat([kwarg_doc, Text(' '), Align(subargs_doc)]),
+                  tabbed_doc])
+
+  atoms = get_atoms(args)
+  return get_sequence_doc(config, atoms, len(atoms) <= max_subargs)
+
+
+def get_statement_doc(config, command):
+  """
+  Return the layout document for a Statement.
+  """
+  command_start = command.name + '('
+  body = command.body
+  if not body:
+    doc = Text(command_start + ')')
+  else:
+    parts = []
+    sublists = formatter.group_args(config, command.name, body)
+    for idx, args in enumerate(sublists):
+      if idx > 0:
+        parts.append(HARDLINE if sublists[idx - 1][-1].comments else LINE)
+      parts.append(get_sublist_doc(config, command.name, args))
+    args_doc = Concat(parts)
+
+    if body[-1].comments:
+      close_aligned = Nest(len(command_start) - 1,
+                           Concat([HARDLINE, Text(')')]))
+      close_tabbed = Nest(config.tab_size - 1, Concat([HARDLINE, Text(')')]))
+    else:
+      close_aligned = close_tabbed = Text(')')
+
+    # Arguments aligned after the opening parenthesis (or all on one line if
+    # they fit), or else on the following lines, indented.
+    aligned_doc = Concat([Text(command_start), Align(args_doc), close_aligned])
+    tabbed_doc = Concat([Text(command_start),
+                         Nest(config.tab_size, Concat([LINE, args_doc])),
+                         close_tabbed])
+    doc = Union([group(aligned_doc), tabbed_doc])
+
+  # A comment on the lines following a statement is parsed as part
+  # of the statement, so moving the comment to its own line would not be
+  # stable. It is always kept after the closing parenthesis.
+  if command.comment:
+    doc = Concat([doc, Text(' '), CommentText(config, [command.comment])])
+  return doc
+
+
+def format_command(config, command, line_width):
+  """
+  Formats a cmake command call into a block with at most line_width chars,
+  choosing the layout of least cost. Returns a list of lines. This is a
+  drop-in replacement for formatter.format_command().
+  """
+  # A statement that fits on one line has no better layout, so don't bother
+  # building its document.
+  if not command.comment and not formatter.arg_exists_with_comment(
+      command.body):
+    single_line = '{}({})'.format(command.name, ' '.join(formatter.join_parens(
+        [arg.contents for arg in command.body])))
+    if len(single_line) <= line_width:
+      return [single_line]
+
+  return layout_doc(get_statement_doc(config, command), line_width)
@@ -1,5 +1,12 @@
+import array
+import bisect
 import re
 
+try:
+  import numpy
+except ImportError:
+  numpy = None
+
 # NOTE(josh): inspiration and some bits taken from cmakeast_ and
 # cmakelistparsing_
 #
@@ -20,6 +27,9 @@ COMMENT = 8
 UNQUOTED_LITERAL = 9
 FORMAT_OFF = 10
 FORMAT_ON = 11
+# The interior of a region where formatting is off, kept as a single token
+# (see tokenize_compact())
+VERBATIM = 12
 
 
 def token_type_to_str(query):
@@ -32,17 +42,370 @@ def token_type_to_str(query):
   return None
 
 
+class LineIndex(object):
+  """
+  The offset of the start of every line of a listfile, built once per file.
+  Converts character offsets into (line, col) by bisection, so that tokens need
+  only remember their offset. Note that line numbers are 1-indexed to match up
+  with editors but column numbers are zero indexed because its fun to be
+  inconsistent.
+  """
+
+  def __init__(self, source=''):
+    self.line_starts = array.array('i', [0])
+    self.extend(source, 0)
+
+  def extend(self, text, offset):
+    """
+    Add the lines which start within ``text``, a chunk of the source that
+    begins at ``offset``. Chunks must be added in order.
+    """
+    if numpy is not None and isinstance(text, str):
+      newlines = numpy.flatnonzero(
+          numpy.frombuffer(text, dtype=numpy.uint8) == ord('\n'))
+      self.line_starts.extend((newlines + (offset + 1)).tolist())
+    else:
+      line_starts = self.line_starts
+      newline_idx = text.find('\n')
+      while newline_idx != -1:
+        line_starts.append(offset + newline_idx + 1)
+        newline_idx = text.find('\n', newline_idx + 1)
+
+  def get_line(self, offset):
+    """
+    Return the (1-indexed) line number containing ``offset``.
+    """
+    return bisect.bisect_right(self.line_starts, offset)
+
+  def get_col(self, offset):
+    """
+    Return the (0-indexed) column of ``offset`` within its line.
+    """
+    return offset - self.line_starts[bisect.bisect_right(self.line_starts,
+                                                         offset) - 1]
+
+  def get_location(self, offset):
+    """
+    Return the (line, col) of ``offset``.
+    """
+    line = bisect.bisect_right(self.line_starts, offset)
+    return line, offset - self.line_starts[line - 1]
+
+
 class Token(object):
   """
-  Lexical unit of a listfile.
+  Lexical unit of a listfile. ``offset`` is the position of the token in the
+  source and ``line_index`` is the LineIndex of that source, from which the
+  line and column are computed on demand.
   """
 
-  def __init__(self, tok_type, content, line, col, index):
+  def __init__(self, tok_type, content, offset, index, line_index):
     self.type = tok_type
     self.content = content
-    self.line = line
-    self.col = col
+    self.offset = offset
+    self.index = index
+    self.line_index = line_index
+
+  @property
+  def line(self):
+    return self.line_index.get_line(self.offset)
+
+  @property
+  def col(self):
+    return self.line_index.get_col(self.offset)
+
+  def __repr__(self):
+    """A string representation of this token."""
+    return ("Token(type={0}, "
+            "content={1}, "
+            "line={2}, "
+            "col={3})").format(token_type_to_str(self.type),
+                               self.content,
+                               self.line,
+                               self.col)
+
+
+# Lexer rules as (group name, token type, regex), in priority order. Changing
+# the order may alter the behavior of the lexer. All of the rules are combined
+# into a single regex (one named group per rule) which is compiled once, at
+# import time.
+LEXER_RULES = [
+    # double quoted string
+    ('dquote', QUOTED_LITERAL,
+     r'(?<![^\s\(])"(?:[^\"]|\\[\"])*[^\\]?"(?![^\s\)])'),
+    # single quoted string
+    ('squote', QUOTED_LITERAL,
+     r"(?<![^\s\(])'(?:[^\']|\\[\'])*[^\\]?'(?![^\s\)])"),
+    ('number', NUMBER, r"(?<![^\s\(])-?[0-9]+(?![^\s\)\(])"),
+    ('lparen', LEFT_PAREN, r"\("),
+    ('rparen', RIGHT_PAREN, r"\)"),
+    # Either a valid function name or variable name.
+    ('word', WORD, r"(?<![^\s\(])[a-zA-z_][a-zA-Z0-9_]*(?![^\s\)\(])"),
+    # Variable dereference. Borrowed from cmakeast.
+    # NOTE(josh): I don't think works for nested derefs.
+    ('deref', DEREF, r"(?<![^\s\(])\${[a-zA-z_][a-zA-Z0-9_]*}(?![^\s\)])"),
+    ('newline', NEWLINE, r"\n"),
+    ('whitespace', WHITESPACE, r"\s+"),
+    ('format_off', FORMAT_OFF, r"#\s*cmake-format: off[^\n]*"),
+    ('format_on', FORMAT_ON, r"#\s*cmake-format: on[^\n]*"),
+    ('comment', COMMENT, r"#[^\n]*"),
+    # Catch-all for literals which are compound statements.
+    ('unquoted', UNQUOTED_LITERAL,
+     r"(?:[^\s\(\)]+|[^\s\(]*[^\)]|[^\(][^\s\)]*)"),
+]
+
+# Lexer rules with worst-case linear running time, used by
+# ``tokenize(contents, linear=True)``. They differ from LEXER_RULES in two
+# ways:
+#
+# 1. Quoted strings use CMake's own escape grammar. The body is written as an
+#    "unrolled loop" in which every character can be consumed by exactly one
+#    branch. A failed match therefore never re-examines a prefix in a
+#    different way. The scan from an opening quote stops at the first
+#    unescaped quote, and an opening quote must follow whitespace. So no two
+#    opening quotes scan over the same characters.
+# 2. The catch-all is just a run of characters that are not whitespace or a
+#    paren. This is the only branch of the LEXER_RULES catch-all that can
+#    actually match, because parens and whitespace are claimed by earlier
+#    rules.
+#
+# Every other rule either matches a fixed prefix or scans a single run of
+# characters that ends at whitespace, a paren or a newline. A failed rule costs
+# at most the length of the token that is eventually produced at that
+# position. So the total work is linear in the input length. The two rule
+# sets produce the same tokens except for quoted strings that contain escaped
+# quotes or end in a backslash. LEXER_RULES will end the string ``"a \"b\" c"``
+# at the escaped quote after ``b``. The linear rules keep it as one string, as
+# cmake does.
+LINEAR_LEXER_RULES = [
+    ('dquote', QUOTED_LITERAL,
+     r'(?<![^\s\(])"[^"\\]*(?:\\[\s\S][^"\\]*)*"(?![^\s\)])'),
+    ('squote', QUOTED_LITERAL,
+     r"(?<![^\s\(])'[^'\\]*(?:\\[\s\S][^'\\]*)*'(?![^\s\)])"),
+] + [rule for rule in LEXER_RULES
+     if rule[0] not in ('dquote', 'squote', 'unquoted')] + [
+         ('unquoted', UNQUOTED_LITERAL, r"[^\s\(\)]+"),
+     ]
+
+
+def compile_rules(rules):
+  """
+  Combine a list of lexer rules into a single regex with one named group per
+  rule.
+  """
+  return re.compile('|'.join('(?P<{}>{})'.format(name, pattern)
+                             for name, _, pattern in rules))
+
+
+LEXER_REGEX = compile_rules(LEXER_RULES)
+LINEAR_LEXER_REGEX = compile_rules(LINEAR_LEXER_RULES)
+kGroupToType = {name: tok_type for name, tok_type, _ in LEXER_RULES}
+
+
+def get_rule_regex(rules, rule_name):
+  """
+  Return the compiled regex of a single lexer rule.
+  """
+  for name, _, pattern in rules:
+    if name == rule_name:
+      return re.compile(pattern)
+  raise KeyError(rule_name)
+
+
+# The rules which may match at a comment character, in priority order. They
+# are the same in both rule sets.
+kCommentRegexes = [get_rule_regex(LEXER_RULES, name)
+                   for name in ['format_off', 'format_on', 'comment']]
+FORMAT_ON_REGEX = kCommentRegexes[1]
+
+# The quoted string rules of each rule set, by ``linear`` and quote character
+kQuoteRegexes = {
+    linear: {'"': get_rule_regex(rules, 'dquote'),
+             "'": get_rule_regex(rules, 'squote')}
+    for linear, rules in [(False, LEXER_RULES), (True, LINEAR_LEXER_RULES)]}
+
+# Matches the next character of an inactive region which scan_inactive_region()
+# must look at: a comment character or a quote which starts a token, or a
+# parenthesis. Tokens which start with any other character extend to the next
+# whitespace or parenthesis.
+INACTIVE_SCAN_REGEX = re.compile(r'(?<![^\s()])#|(?<![^\s(])["\']|[()]')
+
+# Matches a token which extends to the next whitespace or parenthesis
+RUN_REGEX = re.compile(r'[^\s()]+')
+
+# Matches the name of a statement (a word token) and the whitespace around it,
+# up to its opening parenthesis
+STATEMENT_NAME_REGEX = re.compile(
+    r'\s*(?<![^\s(])([a-zA-z_][a-zA-Z0-9_]*)\s*\Z')
+
+# Matches whitespace up to the end of the text
+BLANK_REGEX = re.compile(r'\s*\Z')
+
+# Returned by scan_inactive_region() for a partial input which doesn't yet
+# show where the region ends
+INCOMPLETE_REGION = 'incomplete'
+
+
+def is_match_complete(buf, pos):
+  """
+  Return true if ``buf`` extends far enough to know how any lexer rule
+  matches at ``pos`` (see get_match_horizon()).
+  """
+  horizon = get_match_horizon(buf, pos)
+  return horizon is not None and horizon < len(buf)
+
+
+def scan_inactive_region(contents, pos, linear=False, partial=False):
+  """
+  Find the end of a region where formatting is turned off, whose interior
+  starts at ``pos`` just after the ``cmake-format: off`` comment. Return
+  ``(end, names)``. ``end`` is the offset of the ``cmake-format: on`` comment
+  which ends the region, or the length of ``contents`` if there is none.
+  ``names`` is the list of names of the statements in the interior.
+
+  Only the characters which may start a comment or a quoted string, and
+  parentheses, are examined, with the same rules as the lexer. Return None if
+  the interior doesn't consist of complete statements, comments and
+  whitespace, in which case it must be tokenized to fail the same way.
+
+  If ``partial`` is true, ``contents`` is only the start of the input, and
+  INCOMPLETE_REGION is returned if the result depends on what follows it.
+  """
+  quote_regexes = kQuoteRegexes[linear]
+  end = len(contents)
+  names = []
+  depth = 0
+  # Start of the text at depth zero which hasn't been accounted for yet
+  boundary = pos
+  while True:
+    match = INACTIVE_SCAN_REGEX.search(contents, pos)
+    if match is None:
+      break
+    pos = match.start()
+    char = contents[pos]
+    if partial and char != '(' and char != ')' and not is_match_complete(
+        contents, pos):
+      return INCOMPLETE_REGION
+    if char == '#':
+      for comment_regex in kCommentRegexes:
+        token_match = comment_regex.match(contents, pos)
+        if token_match is not None:
+          break
+      if depth == 0:
+        if not BLANK_REGEX.match(contents, boundary, pos):
+          return None
+        if comment_regex is FORMAT_ON_REGEX:
+          end = pos
+          break
+        boundary = token_match.end()
+      pos = token_match.end()
+    elif char == '(':
+      if depth == 0:
+        name_match = STATEMENT_NAME_REGEX.match(contents, boundary, pos)
+        if name_match is None:
+          return None
+        names.append(name_match.group(1))
+      depth += 1
+      pos += 1
+    elif char == ')':
+      if depth == 0:
+        return None
+      depth -= 1
+      pos += 1
+      if depth == 0:
+        boundary = pos
+    else:
+      if depth == 0:
+        return None
+      token_match = (quote_regexes[char].match(contents, pos)
+                     or RUN_REGEX.match(contents, pos))
+      pos = token_match.end()
+
+  if partial and end == len(contents):
+    return INCOMPLETE_REGION
+  if depth != 0 or not BLANK_REGEX.match(contents, boundary, end):
+    return None
+  return end, names
+
+
+class TokenStore(object):
+  """
+  Compact storage for the tokens of one listfile. Token attributes are stored
+  as parallel arrays of machine integers (struct-of-arrays) and refer back into
+  the shared ``source`` string by offset, so no per-token object or content
+  string exists until one is requested. Indexing or iterating the store
+  yields lightweight TokenView objects which can be used anywhere a Token is
+  expected.
+  """
+
+  def __init__(self, source):
+    self.source = source
+    self.line_index = LineIndex(source)
+    self.types = array.array('b')
+    self.starts = array.array('i')
+    self.ends = array.array('i')
+
+  def append(self, tok_type, start, end):
+    """
+    Add a token spanning ``source[start:end]`` to the store.
+    """
+    self.types.append(tok_type)
+    self.starts.append(start)
+    self.ends.append(end)
+
+  def get_buffer(self, index):
+    """
+    Return a zero-copy memoryview of the content of the token at ``index``.
+    Requires the source to be a byte string.
+    """
+    return memoryview(self.source)[self.starts[index]:self.ends[index]]
+
+  def __len__(self):
+    return len(self.types)
+
+  def __getitem__(self, index):
+    if index < 0:
+      index += len(self.types)
+    if not 0 <= index < len(self.types):
+      raise IndexError('token index out of range')
+    return TokenView(self, index)
+
+  def __iter__(self):
+    for index in xrange(len(self.types)):
+      yield TokenView(self, index)
+
+
+class TokenView(object):
+  """
+  A Token-like view of one token in a TokenStore. Content, line and column are
+  computed from the store on access.
+  """
+
+  __slots__ = ('store', 'index', 'type')
+
+  def __init__(self, store, index):
+    self.store = store
     self.index = index
+    # type is read for every token by the parser, so it is copied
+    # out of the store rather than looked up each time.
+    self.type = store.types[index]
+
+  @property
+  def content(self):
+    store = self.store
+    return store.source[store.starts[self.index]:store.ends[self.index]]
+
+  @property
+  def offset(self):
+    return self.store.starts[self.index]
+
+  @property
+  def line(self):
+    return self.store.line_index.get_line(self.store.starts[self.index])
+
+  @property
+  def col(self):
+    return self.store.line_index.get_col(self.store.starts[self.index])
 
   def __repr__(self):
     """A string representation of this token."""
@@ -55,69 +418,213 @@ class Token(object):
                                self.col)
 
 
-def tokenize(contents):
+def tokenize(contents, linear=False):
   """
   Scan a string and return a list of Token objects representing the contents
-  of the cmake listfile.
-  """
-  # Regexes are in priority order. Changing the order may alter the
-  # behavior of the lexer
-  scanner = re.Scanner([
-      # double quoted string
-      (r'(?<![^\s\(])"([^\"]|\\[\"])*[^\\]?"(?![^\s\)])',
-       lambda s, t: (QUOTED_LITERAL, t)),
-      # single quoted string
-      (r"(?<![^\s\(])'([^\']|\\[\'])*[^\\]?'(?![^\s\)])",
-       lambda s, t: (QUOTED_LITERAL, t)),
-      (r"(?<![^\s\(])-?[0-9]+(?![^\s\)\(])",
-       lambda s, t: (NUMBER, t)),
-      (r"\(", lambda s, t: (LEFT_PAREN, t)),
-      (r"\)", lambda s, t: (RIGHT_PAREN, t)),
-      # Either a valid function name or variable name.
-      (r"(?<![^\s\(])[a-zA-z_][a-zA-Z0-9_]*(?![^\s\)\(])",
-       lambda s, t: (WORD, t)),
-      # Variable dereference. Borrowed from cmakeast.
-      # NOTE(josh): I don't think works for nested derefs.
-      (r"(?<![^\s\(])\${[a-zA-z_][a-zA-Z0-9_]*}(?![^\s\)])",
-       lambda s, t: (DEREF, t)),
-      (r"\n", lambda s, t: (NEWLINE, t)),
-      (r"\s+", lambda s, t: (WHITESPACE, t)),
-      (r"#\s*cmake-format: off[^\n]*", lambda s, t: (FORMAT_OFF, t)),
-      (r"#\s*cmake-format: on[^\n]*", lambda s, t: (FORMAT_ON, t)),
-      (r"#[^\n]*", lambda s, t: (COMMENT, t)),
-      # Catch-all for literals which are compound statements.
-      (r"([^\s\(\)]+|[^\s\(]*[^\)]|[^\(][^\s\)]*)",
-       lambda s, t: (UNQUOTED_LITERAL, t))
-  ])
-
-  tokens, remainder = scanner.scan(contents)
-  assert not remainder, "Unparsed tokens: {}".format(remainder)
-
-  # Now add line, column, and serial number to token objects. We get lineno
-  # by maintaining a running count of newline characters encountered among
-  # tokens so far, and column count by splitting the most recent token on
-  # it's right most newline. Note that line and numbers are 1-indexed to match
-  # up with editors but column numbers are zero indexed because its fun to be
-  # inconsistent.
+  of the cmake listfile. If ``linear`` is true then use the rules in
+  LINEAR_LEXER_RULES, which are guaranteed to run in linear time even on
+  adversarial input.
+  """
+
+  # Tokens record only their offset and serial number. Line and column are
+  # resolved on demand through a LineIndex shared by all tokens of the file.
+  group_to_type = kGroupToType
+  line_index = LineIndex(contents)
   tokens_return = []
-  lineno = 1
-  col = 0
-  for token_index, (token_type, token_contents) in enumerate(tokens):
-    tokens_return.append(Token(tok_type=token_type,
-                               content=token_contents,
-                               line=lineno,
-                               col=col,
-                               index=token_index))
-    newlines = token_contents.count('\n')
-    lineno += newlines
-    if newlines:
-      col = len(token_contents.rsplit('\n', 1)[1])
-    else:
-      col += len(token_contents)
+  append = tokens_return.append
+  pos = 0
+  lexer_regex = LINEAR_LEXER_REGEX if linear else LEXER_REGEX
+  for match in lexer_regex.finditer(contents):
+    start, end = match.span()
+    if start != pos or end == pos:
+      break
+    pos = end
+    append(Token(group_to_type[match.lastgroup], match.group(), start,
+                 len(tokens_return), line_index))
 
+  assert pos == len(contents), "Unparsed tokens: {}".format(contents[pos:])
   return tokens_return
 
 
+def tokenize_compact(contents, linear=False, collapse_inactive=None):
+  """
+  Scan a string and return a TokenStore of its tokens. Produces the same
+  tokens as ``tokenize(contents, linear)`` but without creating any per-token
+  objects.
+
+  If ``collapse_inactive`` is given, it is called with the names of the
+  statements in the interior of each region where formatting is turned off
+  (see scan_inactive_region()), outside of any statement. If it returns true,
+  the interior is stored as a single VERBATIM token instead of being
+  tokenized.
+  """
+
+  group_to_type = kGroupToType
+  store = TokenStore(contents)
+  pos = 0
+  lexer_regex = LINEAR_LEXER_REGEX if linear else LEXER_REGEX
+  # Parenthesis depth at the end of the first ``num_counted`` tokens
+  paren_depth = 0
+  num_counted = 0
+  resume = True
+  while resume:
+    resume = False
+    for match in lexer_regex.finditer(contents, pos):
+      start, end = match.span()
+      if start != pos or end == pos:
+        break
+      pos = end
+      tok_type = group_to_type[match.lastgroup]
+      store.append(tok_type, start, end)
+      if tok_type != FORMAT_OFF or collapse_inactive is None:
+        continue
+
+      new_types = store.types[num_counted:]
+      paren_depth += new_types.count(LEFT_PAREN) - new_types.count(RIGHT_PAREN)
+      num_counted = len(store.types)
+      if paren_depth != 0:
+        continue
+      region = scan_inactive_region(contents, pos, linear)
+      if region is None or region[0] == pos or not collapse_inactive(region[1]):
+        continue
+      store.append(VERBATIM, pos, region[0])
+      num_counted += 1
+      pos = region[0]
+      # finditer() can't skip ahead, so start a new one
+      resume = True
+      break
+
+  assert pos == len(contents), "Unparsed tokens: {}".format(contents[pos:])
+  return store
+
+
+# Matches the comment character and any whitespace after it, which the
+# format-on/format-off rules may skip over, even across newlines
+COMMENT_PREFIX_REGEX = re.compile(r'#\s*')
+
+
+def get_match_horizon(buf, pos):
+  """
+  Return the index of the last character in ``buf`` that any lexer rule
+  starting at ``pos`` may need to examine, beyond those that the match itself
+  spans. Return None if ``buf`` ends before that horizon is known.
+  """
+  char = buf[pos]
+  if char == '"' or char == "'":
+    # A quoted string cannot extend past the first closing quote which is not
+    # preceded by a backslash, and the rules look at most two characters
+    # beyond it.
+    quote_idx = buf.find(char, pos + 1)
+    while quote_idx != -1 and buf[quote_idx - 1] == '\\':
+      quote_idx = buf.find(char, quote_idx + 1)
+    if quote_idx == -1:
+      return None
+    return quote_idx + 2
+  elif char == '#':
+    # The format-on/format-off rules may skip whitespace after the comment
+    # character but stop at the end of the line after that.
+    prefix_end = COMMENT_PREFIX_REGEX.match(buf, pos).end()
+    newline_idx = buf.find('\n', prefix_end)
+    if newline_idx == -1:
+      return None
+    return newline_idx
+
+  # Any other rule stops at the end of a single run of characters, which
+  # is no longer than the match
+  return pos
+
+
+def tokenize_stream(infile, linear=False, chunk_size=64 * 1024,
+                    collapse_inactive=None):
+  """
+  Generate the same Token objects as ``tokenize(infile.read(), linear)`` but
+  read ``infile`` in chunks of about ``chunk_size`` characters. Tokens are
+  yielded as soon as they are known to be complete. Only the unconsumed tail
+  of the input is buffered, plus as much as is needed to complete the current
+  token, e.g. the rest of a long quoted string.
+
+  ``collapse_inactive`` works as for tokenize_compact(). The interior of a
+  region where formatting is turned off is buffered until its end is found,
+  and yielded as a single VERBATIM token.
+  """
+
+  lexer_regex = LINEAR_LEXER_REGEX if linear else LEXER_REGEX
+  group_to_type = kGroupToType
+  line_index = LineIndex()
+  buf = ''
+  # Offset of buf[0] within the whole input
+  buf_offset = 0
+  pos = 0
+  eof = False
+  read_size = chunk_size
+  index = 0
+  paren_depth = 0
+  # True if the interior of an inactive region starts at pos and may be
+  # collapsed
+  scan_region = False
+
+  while True:
+    if scan_region:
+      region = scan_inactive_region(buf, pos, linear, partial=not eof)
+      complete = region is not INCOMPLETE_REGION
+    else:
+      match = None
+      if pos < len(buf):
+        match = lexer_regex.match(buf, pos)
+      complete = False
+      if match is not None:
+        horizon = get_match_horizon(buf, pos)
+        complete = (horizon is not None
+                    and max(horizon, match.end()) < len(buf))
+
+    if not eof:
+      if not complete:
+        chunk = infile.read(read_size)
+        if chunk:
+          # Drop the consumed input, but keep one character of it as context
+          # for the lookbehind assertions of the lexer rules. Reads grow
+          # geometrically while a single token spans them.
+          if pos > 1:
+            buf = buf[pos - 1:]
+            buf_offset += pos - 1
+            pos = 1
+          line_index.extend(chunk, buf_offset + len(buf))
+          buf += chunk
+          read_size *= 2
+        else:
+          eof = True
+        continue
+
+    if scan_region:
+      scan_region = False
+      if (region is not None and region[0] != pos
+          and collapse_inactive(region[1])):
+        yield Token(VERBATIM, buf[pos:region[0]], buf_offset + pos, index,
+                    line_index)
+        pos = region[0]
+        read_size = chunk_size
+        index += 1
+      continue
+
+    if match is None or match.end() == pos:
+      break
+
+    tok_type = group_to_type[match.lastgroup]
+    yield Token(tok_type, match.group(), buf_offset + pos, index, line_index)
+    pos = match.end()
+    read_size = chunk_size
+    index += 1
+    if collapse_inactive is not None:
+      if tok_type == LEFT_PAREN:
+        paren_depth += 1
+      elif tok_type == RIGHT_PAREN:
+        paren_depth -= 1
+      elif tok_type == FORMAT_OFF and paren_depth == 0:
+        scan_region = True
+
+  assert pos == len(buf), "Unparsed tokens: {}".format(buf[pos:])
+
+
 def main():
   """
   Dump tokenized listfile to stdout for debugging.
@@ -1,3 +1,5 @@
+import collections
+
 from cmake_format import lexer
 
 
@@ -20,7 +22,8 @@ WHITESPACE_TOKENS = [lexer.WHITESPACE,
 
 COMMENT_TOKENS = [lexer.COMMENT,
                   lexer.FORMAT_OFF,
-                  lexer.FORMAT_ON]
+                  lexer.FORMAT_ON,
+                  lexer.VERBATIM]
 
 
 class TokenSequence(object):
@@ -31,6 +34,8 @@ class TokenSequence(object):
   3. some whitespace
   """
 
+  __slots__ = ('type', 'tokens')
+
   def __init__(self, seq_type, tokens):
     self.type = seq_type
     self.tokens = tokens
@@ -41,82 +46,145 @@ class TokenSequence(object):
                     self.tokens[0].line, self.tokens[0].col))
 
 
-def consume_whitespace(tokens):
+class TokenStream(object):
   """
-  Consume sequential whitespace, removing tokens from the iniput list and
-  returning a whitespace TokenSequence
+  A cursor over a stream of tokens with bounded lookahead. Tokens are pulled
+  from the underlying iterable only as they are needed, so the stream may be a
+  list or a lazy generator (e.g. lexer.tokenize_stream).
+  """
+
+  def __init__(self, tokens):
+    self._tokens = iter(tokens)
+    self._lookahead = collections.deque()
+
+  def peek(self, offset=0):
+    """
+    Return the token ``offset`` positions past the cursor without consuming
+    it, or None if the stream ends before then.
+    """
+    lookahead = self._lookahead
+    while len(lookahead) <= offset:
+      token = next(self._tokens, None)
+      if token is None:
+        return None
+      lookahead.append(token)
+    return lookahead[offset]
+
+  def pop(self):
+    """
+    Consume and return the token at the cursor.
+    """
+    if self._lookahead:
+      return self._lookahead.popleft()
+    return next(self._tokens)
+
+
+def consume_whitespace(stream):
+  """
+  Consume sequential whitespace from the token stream, returning a whitespace
+  TokenSequence
   """
 
   whitespace_tokens = []
-  while tokens and tokens[0].type in WHITESPACE_TOKENS:
-    whitespace_tokens.append(tokens.pop(0))
+  token = stream.peek()
+  while token is not None and token.type in WHITESPACE_TOKENS:
+    whitespace_tokens.append(stream.pop())
+    token = stream.peek()
   return TokenSequence(WHITESPACE, whitespace_tokens)
 
 
-def consume_comment(tokens):
+def consume_comment(stream):
   """
-  Consume sequential comment lines, removing tokens from the input list and
-  returning a comment TokenSequence
+  Consume sequential comment lines from the token stream, returning a comment
+  TokenSequence
   """
 
   comment_tokens = []
-  while tokens and tokens[0].type in COMMENT_TOKENS:
-    comment_tokens.append(tokens.pop(0))
+  token = stream.peek()
+  while token is not None and token.type in COMMENT_TOKENS:
+    comment_tokens.append(stream.pop())
     # pylint: disable=bad-continuation
-    if (len(tokens) > 2
-            and tokens[0].type == lexer.NEWLINE
-            and tokens[1].type in COMMENT_TOKENS
+    if (stream.peek(2) is not None
+            and stream.peek(0).type == lexer.NEWLINE
+            and stream.peek(1).type in COMMENT_TOKENS
         ):
-      comment_tokens.append(tokens.pop(0))
+      comment_tokens.append(stream.pop())
+    token = stream.peek()
   return TokenSequence(COMMENT, comment_tokens)
 
 
-def consume_statement(tokens):
+def consume_statement(stream):
   """
-  Consume a complete statement, removint tokens from the input list and
-  returning a statement TokenSequence
+  Consume a complete statement from the token stream, returning a statement
+  TokenSequence
   """
-  stmt_tokens = [tokens.pop(0)]
-  while tokens[0].type in WHITESPACE_TOKENS:
-    stmt_tokens.append(tokens.pop(0))
-
-  assert tokens[0].type == lexer.LEFT_PAREN, \
-      ("Unexpected {} token at {}:{}, expecting l-paren, got {}"
-       .format(lexer.token_type_to_str(tokens[0].type), tokens[0].line,
-               tokens[0].col, tokens[0].content))
-
-  stmt_tokens.append(tokens.pop(0))
+  stmt_tokens = [stream.pop()]
+  token = stream.peek()
+  while token is not None and token.type in WHITESPACE_TOKENS:
+    stmt_tokens.append(stream.pop())
+    token = stream.peek()
+
+  assert token is not None and token.type == lexer.LEFT_PAREN, \
+      ("Unexpected token at {}:{}, expecting l-paren after {}"
+       .format(stmt_tokens[0].line, stmt_tokens[0].col,
+               stmt_tokens[0].content))
+
+  stmt_tokens.append(stream.pop())
   paren_count = 1
 
-  while tokens and paren_count > 0:
-    if tokens[0].type == lexer.LEFT_PAREN:
+  while paren_count > 0 and stream.peek() is not None:
+    token = stream.pop()
+    if token.type == lexer.LEFT_PAREN:
       paren_count += 1
-    elif tokens[0].type == lexer.RIGHT_PAREN:
+    elif token.type == lexer.RIGHT_PAREN:
       paren_count -= 1
-    stmt_tokens.append(tokens.pop(0))
+    stmt_tokens.append(token)
 
   assert paren_count == 0, \
       ("Missing terminating r-paren for statement starting at {}:{}\n"
        .format(stmt_tokens[0].line, stmt_tokens[0].col))
 
-  while tokens:
-    if tokens[0].type in [lexer.COMMENT,
-                          lexer.WHITESPACE]:
-      stmt_tokens.append(tokens.pop(0))
-    else:
-      break
+  token = stream.peek()
+  while token is not None and token.type in [lexer.COMMENT,
+                                             lexer.WHITESPACE]:
+    stmt_tokens.append(stream.pop())
+    token = stream.peek()
 
-  while (len(tokens) > 2
-         and tokens[0].type == lexer.NEWLINE
-         and tokens[1].type == lexer.WHITESPACE
-         and tokens[2].type == lexer.COMMENT):
-    stmt_tokens.append(tokens.pop(0))
-    stmt_tokens.append(tokens.pop(0))
-    stmt_tokens.append(tokens.pop(0))
+  while (stream.peek(2) is not None
+         and stream.peek(0).type == lexer.NEWLINE
+         and stream.peek(1).type == lexer.WHITESPACE
+         and stream.peek(2).type == lexer.COMMENT):
+    stmt_tokens.append(stream.pop())
+    stmt_tokens.append(stream.pop())
+    stmt_tokens.append(stream.pop())
 
   return TokenSequence(STATEMENT, stmt_tokens)
 
 
+def iter_digest(tokens):
+  """
+  Generate the token sequences of ``digest_tokens`` one at a time, so that a
+  consumer can process each sequence without the full list of sequences ever
+  being built. ``tokens`` may be any iterable of tokens; it is consumed once,
+  front to back, with a few tokens of lookahead.
+  """
+
+  stream = TokenStream(tokens)
+  token = stream.peek()
+  while token is not None:
+    if token.type in WHITESPACE_TOKENS:
+      yield consume_whitespace(stream)
+    elif token.type in COMMENT_TOKENS:
+      yield consume_comment(stream)
+    elif token.type == lexer.WORD:
+      yield consume_statement(stream)
+    else:
+      assert False, ("Unexpected token of type {} at {}:{}"
+                     .format(lexer.token_type_to_str(token.type),
+                             token.line, token.col))
+    token = stream.peek()
+
+
 def digest_tokens(tokens):
   """
   Consume tokens and output collections of tokens (as TokenSequence) objects
@@ -127,22 +195,7 @@ def digest_tokens(tokens):
   3. statement
   """
 
-  tokens = list(tokens)
-  tok_seqs = []
-
-  while tokens:
-    if tokens[0].type in WHITESPACE_TOKENS:
-      tok_seqs.append(consume_whitespace(tokens))
-    elif tokens[0].type in COMMENT_TOKENS:
-      tok_seqs.append(consume_comment(tokens))
-    elif tokens[0].type == lexer.WORD:
-      tok_seqs.append(consume_statement(tokens))
-    else:
-      assert False, ("Unexpected token of type {} at {}:{}"
-                     .format(lexer.token_type_to_str(tokens[0].type),
-                             tokens[0].line, tokens[0].col))
-
-  return tok_seqs
+  return list(iter_digest(tokens))
 
 
 def dump_digest(tok_seqs):
@@ -174,25 +227,29 @@ kBlockTypeToStr = make_enum_map(["ROOT", "IF_BLOCK", "WHILE", "FOREACH",
                                  "FUNCTION_DEF", "MACRO_DEF"])
 
 
+# Shared, immutable stand-ins for empty lists, so that the many nodes and
+# arguments which never populate them don't each allocate one.
+NO_CHILDREN = ()
+NO_TOKENS = ()
+NO_COMMENTS = ()
+
+
 class TreeNode(object):
   """
-  A node in the full-syntax-tree.
+  A node in the full-syntax-tree. Node classes use ``__slots__`` because a
+  large listfile has a very large number of them.
   """
 
-  def __init__(self, node_type):
-    self.node_type = node_type
+  __slots__ = ()
+
+  # Overridden by each node class
+  node_type = None
 
   def get_location(self):
     """
     Return the (line, col) of the first token in the subtree rooted at this
     node.
     """
-    if hasattr(self, 'content'):
-      token = getattr(self, 'content').tokens[0]
-      return token.line, token.col
-    elif hasattr(self, 'children') and getattr(self, 'children'):
-      return getattr(self, 'children')[0].get_location()
-
     return -1, -1
 
   def __repr__(self):
@@ -210,19 +267,41 @@ class Block(TreeNode):
   else, endif) and not the statements within the body of the scope.
   """
 
+  __slots__ = ('block_type', 'children')
+  node_type = BLOCK_NODE
+
   def __init__(self, block_type, children=None):
-    super(Block, self).__init__(BLOCK_NODE)
     self.block_type = block_type
     self.children = children if children else []
 
+  def get_location(self):
+    if self.children:
+      return self.children[0].get_location()
+    return -1, -1
+
   def __repr__(self):
     line, col = self.get_location()
+    # Blocks declared in the configuration use the name of their opening
+    # statement as their block_type
     return '{}({}):{}:{}'.format(kNodeTypeToStr.get(self.node_type),
-                                 kBlockTypeToStr.get(self.block_type),
+                                 kBlockTypeToStr.get(self.block_type,
+                                                     self.block_type),
                                  line, col)
 
 
-class Comment(TreeNode):
+class SequenceNode(TreeNode):
+  """
+  A node whose ``content`` is a single TokenSequence.
+  """
+
+  __slots__ = ('content',)
+
+  def get_location(self):
+    token = self.content.tokens[0]
+    return token.line, token.col
+
+
+class Comment(SequenceNode):
   """
   Has a ``content`` field containing a TokenSequence of comment tokens.
   Represents a continuous sequence of comment lines up to the first blank line
@@ -230,12 +309,14 @@ class Comment(TreeNode):
   lexer.NEWLINE objects between each comment line.
   """
 
+  __slots__ = ()
+  node_type = COMMENT_NODE
+
   def __init__(self, content=None):
-    super(Comment, self).__init__(COMMENT_NODE)
     self.content = content
 
 
-class Whitespace(TreeNode):
+class Whitespace(SequenceNode):
   """
   Has a ``content`` field containing a TokenSequence of whitespace tokens.
   Represents a continuous sequence of whitespace (either lexer.Newline or
@@ -244,8 +325,10 @@ class Whitespace(TreeNode):
   or multiple newlines.
   """
 
+  __slots__ = ()
+  node_type = WHITESPACE_NODE
+
   def __init__(self, content=None):
-    super(Whitespace, self).__init__(WHITESPACE_NODE)
     self.content = content
 
   def count_newlines(self):
@@ -260,15 +343,47 @@ class Argument(object):
   A single semantic argument of a cmake statement (command/function-call). It
   is composed of nominally one token, but may also be associated with a list
   of comment strings which are digested stripped out of comment tokens.
+  Trailing whitespace and comment tokens are kept in ``trailing_tokens``.
+  Arguments without any share the empty NO_TOKENS and NO_COMMENTS.
+  ``role`` is the commands.PARG, FLAG or KWARG role of the argument in its
+  statement, or None until the formatter classifies it.
   """
 
+  __slots__ = ('token', 'contents', 'trailing_tokens', 'comments', 'role')
+
   def __init__(self, token, comments=None):
-    self.tokens = [token]
-    self.comments = comments if comments else []
+    self.token = token
     self.contents = token.content
+    self.trailing_tokens = NO_TOKENS
+    self.comments = list(comments) if comments else NO_COMMENTS
+    self.role = None
+
+  @property
+  def tokens(self):
+    """
+    All of the tokens composing this argument, in order.
+    """
+    return [self.token] + list(self.trailing_tokens)
+
+  def add_token(self, token):
+    """
+    Append a whitespace or comment token which trails this argument.
+    """
+    if self.trailing_tokens is NO_TOKENS:
+      self.trailing_tokens = []
+    self.trailing_tokens.append(token)
+
+  def add_comment(self, token):
+    """
+    Append a comment token which trails this argument.
+    """
+    self.add_token(token)
+    if self.comments is NO_COMMENTS:
+      self.comments = []
+    self.comments.append(token.content)
 
 
-class Statement(TreeNode):
+class Statement(SequenceNode):
   """
   A single cmake statement. A statement has at most one child (stored in
   ``children``). Note that some statements are "simple" function calls
@@ -276,187 +391,399 @@ class Statement(TreeNode):
   Simple statements have no children and logical block statements have one
   child.
 
-  The arguments of a statement are stored in the ``content`` list of this
-  node as a sequence of ``Argument`` objects.
+  The arguments of a statement are available from the ``body`` list of this
+  node as a sequence of ``Argument`` objects. They are split out of
+  ``content`` the first time they are accessed.
   """
 
+  __slots__ = ('children', 'name', '_prefix_tokens', '_body',
+               '_postfix_tokens', '_comment')
+  node_type = STATEMENT_NODE
+
   def __init__(self, content=None, child=None):
-    super(Statement, self).__init__(STATEMENT_NODE)
     self.content = content
-    self.children = list(child) if child else []
-    self.prefix_tokens = []
-    self.postfix_tokens = []
-
-    tokens = list(content.tokens)
-    assert tokens[0].type == lexer.WORD
-    self.prefix_tokens.append(tokens.pop(0))
-    self.name = self.prefix_tokens[0].content
-    self.body = []
-    while tokens and tokens[0].type != lexer.LEFT_PAREN:
-      self.prefix_tokens.append(tokens.pop(0))
-    assert tokens
-    self.prefix_tokens.append(tokens.pop(0))
+    self.children = list(child) if child is not None else NO_CHILDREN
+    assert content.tokens[0].type == lexer.WORD
+    self.name = content.tokens[0].content
+
+    # The statement is split into prefix tokens, arguments and postfix tokens
+    # on first access to any of them (see decompose()). Many statements are
+    # never looked at that closely (e.g. within a format-off region).
+    self._prefix_tokens = None
+    self._body = None
+    self._postfix_tokens = None
+    self._comment = None
+
+  @property
+  def prefix_tokens(self):
+    """
+    The tokens from the statement name up to and including the opening
+    parenthesis, along with any whitespace before the first argument.
+    """
+    if self._body is None:
+      self.decompose()
+    return self._prefix_tokens
+
+  @property
+  def body(self):
+    """
+    The list of ``Argument`` objects of this statement.
+    """
+    if self._body is None:
+      self.decompose()
+    return self._body
+
+  @property
+  def postfix_tokens(self):
+    """
+    The closing parenthesis and any trailing tokens of this statement.
+    """
+    if self._body is None:
+      self.decompose()
+    return self._postfix_tokens
+
+  @property
+  def comment(self):
+    """
+    The text of any comments trailing the closing parenthesis, one line per
+    comment.
+    """
+    if self._body is None:
+      self.decompose()
+    return self._comment
+
+  def decompose(self):
+    """
+    Split the token sequence of this statement into prefix tokens, arguments,
+    and postfix tokens.
+    """
+    prefix_tokens = []
+    postfix_tokens = []
+    body = []
+
+    tokens = self.content.tokens
+    ntokens = len(tokens)
+    prefix_tokens.append(tokens[0])
+    tok_idx = 1
+    while tok_idx < ntokens and tokens[tok_idx].type != lexer.LEFT_PAREN:
+      prefix_tokens.append(tokens[tok_idx])
+      tok_idx += 1
+    assert tok_idx < ntokens
+    prefix_tokens.append(tokens[tok_idx])
+    tok_idx += 1
 
     paren_count = 1
 
-    while tokens and paren_count > 0:
-      token = tokens.pop(0)
+    while tok_idx < ntokens and paren_count > 0:
+      token = tokens[tok_idx]
+      tok_idx += 1
       if token.type in WHITESPACE_TOKENS:
-        if self.body:
-          self.body[-1].tokens.append(token)
+        if body:
+          body[-1].add_token(token)
         else:
-          self.prefix_tokens.append(token)
+          prefix_tokens.append(token)
       elif token.type == lexer.COMMENT:
-        assert self.body
-        self.body[-1].tokens.append(token)
-        self.body[-1].comments.append(token.content)
+        assert body
+        body[-1].add_comment(token)
       elif token.type == lexer.LEFT_PAREN:
         paren_count += 1
-        self.body.append(Argument(token))
+        body.append(Argument(token))
       elif token.type == lexer.RIGHT_PAREN:
         paren_count -= 1
         if paren_count > 0:
-          self.body.append(Argument(token))
+          body.append(Argument(token))
         else:
-          self.postfix_tokens.append(token)
+          postfix_tokens.append(token)
       else:
-        self.body.append(Argument(token))
-    self.comment = ""
-    while tokens:
-      self.postfix_tokens.append(tokens.pop(0))
-      if self.postfix_tokens[-1].type == lexer.COMMENT:
-        if self.comment:
-          self.comment += "\n"
-        self.comment += self.postfix_tokens[-1].content.strip()[1:]
+        body.append(Argument(token))
+    comment = ""
+    while tok_idx < ntokens:
+      token = tokens[tok_idx]
+      tok_idx += 1
+      postfix_tokens.append(token)
+      if token.type == lexer.COMMENT:
+        if comment:
+          comment += "\n"
+        comment += token.content.strip()[1:]
+
+    self._prefix_tokens = prefix_tokens
+    self._body = body
+    self._postfix_tokens = postfix_tokens
+    self._comment = comment
+
+
+# Roles that a statement may play in the structure of a block
+BLOCK_OPENER = 0
+BLOCK_MIDDLE = 1
+BLOCK_CLOSER = 2
+
+kBlockRoleToStr = make_enum_map(["BLOCK_OPENER", "BLOCK_MIDDLE",
+                                 "BLOCK_CLOSER"])
+
+
+def decl_block(block_spec, block_type, opener, closer, middles=None):
+  """
+  Register the names of the statements which open, continue, and close a block
+  of type ``block_type``. ``block_spec`` maps statement names to a
+  (role, block_type) tuple.
+  """
+  if middles is None:
+    middles = []
+
+  block_spec[opener] = (BLOCK_OPENER, block_type)
+  for middle in middles:
+    block_spec[middle] = (BLOCK_MIDDLE, block_type)
+  block_spec[closer] = (BLOCK_CLOSER, block_type)
 
 
-def construct_fst(token_seqs):
+def get_block_spec():
   """
-  Given a list of token sequences (the output of digest_tokens), construct the
-  Full Syntax Tree
+  Return a dictionary mapping the names of cmake's block-structure statements
+  to their (role, block_type).
   """
 
-  # TODO(josh): figure out a cleaner way to deal with this switch/case logic
-  # pylint: disable=too-many-statements
-  block_stack = [Block(ROOT)]
-  token_seqs = list(token_seqs)
-  while token_seqs:
-    tok_seq = token_seqs.pop(0)
+  block_spec = {}
+  decl_block(block_spec, IF_BLOCK, 'if', 'endif', middles=['elseif', 'else'])
+  decl_block(block_spec, WHILE, 'while', 'endwhile')
+  decl_block(block_spec, FOREACH, 'foreach', 'endforeach')
+  decl_block(block_spec, FUNCTION_DEF, 'function', 'endfunction')
+  decl_block(block_spec, MACRO_DEF, 'macro', 'endmacro')
+  return block_spec
+
+
+def blocks_are_balanced(block_spec, statement_names):
+  """
+  Return true if every block opened by a sequence of statements is closed
+  within the same sequence, and no statement continues or closes a block
+  opened outside of it.
+  """
+  type_stack = []
+  for name in statement_names:
+    role_and_type = block_spec.get(name)
+    if role_and_type is None:
+      continue
+    role, block_type = role_and_type
+    if role == BLOCK_OPENER:
+      type_stack.append(block_type)
+    elif not type_stack or type_stack[-1] != block_type:
+      return False
+    elif role == BLOCK_CLOSER:
+      type_stack.pop(-1)
+  return not type_stack
+
+
+# Parse event types
+START_BLOCK_EVENT = 0
+END_BLOCK_EVENT = 1
+START_BODY_EVENT = 2
+END_BODY_EVENT = 3
+STATEMENT_EVENT = 4
+COMMENT_EVENT = 5
+WHITESPACE_EVENT = 6
+
+kEventTypeToStr = make_enum_map(["START_BLOCK_EVENT", "END_BLOCK_EVENT",
+                                 "START_BODY_EVENT", "END_BODY_EVENT",
+                                 "STATEMENT_EVENT", "COMMENT_EVENT",
+                                 "WHITESPACE_EVENT"])
+
+
+def iter_events(token_seqs, block_spec=None):
+  """
+  Given an iterable of token sequences (the output of digest_tokens or
+  iter_digest), generate (event_type, node) pairs in the order of a
+  depth-first traversal of the Full Syntax Tree, without building the tree.
+  ``block_spec`` maps the names of statements which open, continue, or close
+  a block to their role and block type (see get_block_spec()).
+
+  A Block is bracketed by START_BLOCK_EVENT and END_BLOCK_EVENT. The statements
+  nested in the body of a statement which opens or continues a block follow
+  its STATEMENT_EVENT, bracketed by START_BODY_EVENT and END_BODY_EVENT. The
+  ``children`` of yielded nodes are left empty, so only the currently open
+  blocks and statements are held in memory.
+  """
+
+  if block_spec is None:
+    block_spec = get_block_spec()
+
+  # The stack alternates between a Block and the Statement within that block
+  # whose body is currently open.
+  root = Block(ROOT)
+  block_stack = [root]
+  yield START_BLOCK_EVENT, root
+  for tok_seq in token_seqs:
     if tok_seq.type == COMMENT:
-      block_stack[-1].children.append(Comment(tok_seq))
+      yield COMMENT_EVENT, Comment(tok_seq)
     elif tok_seq.type == WHITESPACE:
-      block_stack[-1].children.append(Whitespace(tok_seq))
+      yield WHITESPACE_EVENT, Whitespace(tok_seq)
     elif tok_seq.type == STATEMENT:
-      if tok_seq.tokens[0].content == 'if':
-        block = Block(IF_BLOCK)
-        stmt = Statement(tok_seq)
-        block_stack[-1].children.append(block)
-        block.children.append(stmt)
+      name_token = tok_seq.tokens[0]
+      role_and_type = block_spec.get(name_token.content)
+      if role_and_type is None:
+        yield STATEMENT_EVENT, Statement(tok_seq)
+        continue
+
+      role, block_type = role_and_type
+      if role == BLOCK_OPENER:
+        block = Block(block_type)
+        stmt = Statement(tok_seq, [])
         block_stack.append(block)
         block_stack.append(stmt)
-      elif tok_seq.tokens[0].content in ['elseif', 'else']:
-        assert block_stack and block_stack.pop(-1)
-        assert block_stack and block_stack[-1].block_type == IF_BLOCK
-        stmt = Statement(tok_seq)
-        block_stack[-1].children.append(stmt)
-        block_stack.append(stmt)
-      elif tok_seq.tokens[0].content == 'endif':
-        assert block_stack and block_stack.pop(-1)
-        assert block_stack and block_stack[-1].block_type == IF_BLOCK
-        stmt = Statement(tok_seq)
-        block_stack[-1].children.append(stmt)
-        block_stack.pop(-1)
-      elif tok_seq.tokens[0].content == 'while':
-        block = Block(WHILE)
-        stmt = Statement(tok_seq)
-        block.children.append(stmt)
-        block_stack.append(block)
+        yield START_BLOCK_EVENT, block
+        yield STATEMENT_EVENT, stmt
+        yield START_BODY_EVENT, stmt
+        continue
+
+      assert (len(block_stack) > 1
+              and block_stack[-2].block_type == block_type), \
+          ("Unexpected {} at {}:{}"
+           .format(name_token.content, name_token.line, name_token.col))
+      yield END_BODY_EVENT, block_stack.pop(-1)
+      if role == BLOCK_MIDDLE:
+        stmt = Statement(tok_seq, [])
         block_stack.append(stmt)
-      elif tok_seq.tokens[0].content == 'endwhile':
-        assert block_stack and block_stack.pop(-1)
-        assert block_stack and block_stack[-1].block_type == WHILE
-        stmt = Statement(tok_seq)
-        block_stack[-1].children.append(stmt)
-        block_stack.pop(-1)
-      elif tok_seq.tokens[0].content == 'foreach':
-        block = Block(FOREACH)
-        stmt = Statement(tok_seq)
-        block_stack[-1].children.append(block)
-        block.children.append(stmt)
-        block_stack.append(block)
-        block_stack.append(stmt)
-      elif tok_seq.tokens[0].content == 'endforeach':
-        assert block_stack and block_stack.pop(-1)
-        assert block_stack and block_stack[-1].block_type == FOREACH
-        stmt = Statement(tok_seq)
-        block_stack[-1].children.append(stmt)
-        block_stack.pop(-1)
-      elif tok_seq.tokens[0].content == 'function':
-        block = Block(FUNCTION_DEF)
-        stmt = Statement(tok_seq)
-        block_stack[-1].children.append(block)
-        block.children.append(stmt)
-        block_stack.append(block)
-        block_stack.append(stmt)
-      elif tok_seq.tokens[0].content == 'endfunction':
-        assert block_stack and block_stack.pop(-1)
-        assert block_stack and block_stack[-1].block_type == FUNCTION_DEF
-        stmt = Statement(tok_seq)
-        block_stack[-1].children.append(stmt)
-        block_stack.pop(-1)
-      elif tok_seq.tokens[0].content == 'macro':
-        block = Block(MACRO_DEF)
-        stmt = Statement(tok_seq)
-        block_stack[-1].children.append(block)
-        block.children.append(stmt)
-        block_stack.append(block)
-        block_stack.append(stmt)
-      elif tok_seq.tokens[0].content == 'endmacro':
-        assert block_stack and block_stack.pop(-1)
-        assert block_stack and block_stack[-1].block_type == MACRO_DEF
-        stmt = Statement(tok_seq)
-        block_stack[-1].children.append(stmt)
-        block_stack.pop(-1)
+        yield STATEMENT_EVENT, stmt
+        yield START_BODY_EVENT, stmt
       else:
-        block_stack[-1].children.append(Statement(tok_seq))
+        yield STATEMENT_EVENT, Statement(tok_seq)
+        yield END_BLOCK_EVENT, block_stack.pop(-1)
 
   assert len(block_stack) == 1, \
-      ("Unclosed block of type: {} opened at {}:{}"
-       .format(kBlockTypeToStr.get(block_stack[-1].block_type),
-               block_stack[-1].children[0].line,
-               block_stack[-1].children[0].col))
+      ("Unclosed block opened at {}:{}"
+       .format(*block_stack[-1].get_location()))
+  yield END_BLOCK_EVENT, root
+
 
-  return block_stack[0]
+def construct_fst(token_seqs, block_spec=None):
+  """
+  Given an iterable of token sequences (the output of digest_tokens or
+  iter_digest), construct the Full Syntax Tree from the events of
+  iter_events().
+  """
+
+  root = None
+  node_stack = []
+  for event_type, node in iter_events(token_seqs, block_spec):
+    if event_type == START_BLOCK_EVENT:
+      if node_stack:
+        node_stack[-1].children.append(node)
+      node_stack.append(node)
+    elif event_type == START_BODY_EVENT:
+      node_stack.append(node)
+    elif event_type == END_BODY_EVENT or event_type == END_BLOCK_EVENT:
+      root = node_stack.pop(-1)
+    else:
+      node_stack[-1].children.append(node)
+
+  return root
+
+
+def parse(tokens, block_spec=None):
+  """
+  Construct the Full Syntax Tree directly from a list of tokens. Token
+  sequences are digested and consumed one at a time, so no intermediate list
+  of sequences is built.
+  """
+  return construct_fst(iter_digest(tokens), block_spec)
+
+
+def parse_events(tokens, block_spec=None):
+  """
+  Generate the parse events (see iter_events()) for an iterable of tokens,
+  consuming the tokens as the events are consumed.
+  """
+  return iter_events(iter_digest(tokens), block_spec)
+
+
+def iter_fst_events(node):
+  """
+  Generate the parse events (see iter_events()) of a depth-first traversal of
+  the Full Syntax Tree rooted at ``node``. The traversal keeps an explicit
+  stack rather than recursing, so the depth of the tree is not limited by the
+  depth of the python stack.
+  """
+
+  # Each entry is the (event_type, node) to yield once the iterator over the
+  # remaining children of that node is exhausted.
+  stack = [(None, None, iter([node]))]
+  while stack:
+    end_event_type, parent, children = stack[-1]
+    child = next(children, None)
+    if child is None:
+      stack.pop(-1)
+      if end_event_type is not None:
+        yield end_event_type, parent
+      continue
+
+    node_type = child.node_type
+    if node_type == STATEMENT_NODE:
+      yield STATEMENT_EVENT, child
+      if child.children is not NO_CHILDREN:
+        yield START_BODY_EVENT, child
+        stack.append((END_BODY_EVENT, child, iter(child.children)))
+    elif node_type == COMMENT_NODE:
+      yield COMMENT_EVENT, child
+    elif node_type == WHITESPACE_NODE:
+      yield WHITESPACE_EVENT, child
+    elif node_type == BLOCK_NODE:
+      yield START_BLOCK_EVENT, child
+      stack.append((END_BLOCK_EVENT, child, iter(child.children)))
+    else:
+      assert False, ("Unrecognized node type: {} ({})"
+                     .format(kNodeTypeToStr.get(node_type), node_type))
 
 
 def dump_fst(node, depth=0):
-  print '{}{}'.format('  ' * depth, node)
-  for child in getattr(node, 'children', []):
-    dump_fst(child, depth + 1)
+  """
+  Print the Full Syntax Tree rooted at ``node`` for debugging purposes, one
+  node per line, indented by its depth in the tree.
+  """
+  for event_type, event_node in iter_fst_events(node):
+    if event_type == END_BLOCK_EVENT or event_type == END_BODY_EVENT:
+      depth -= 1
+      continue
+    if event_type != START_BODY_EVENT:
+      print '{}{}'.format('  ' * depth, event_node)
+    if event_type == START_BLOCK_EVENT or event_type == START_BODY_EVENT:
+      depth += 1
+
+
+def dump_events(events):
+  """
+  Print a series of parse events for debugging purposes, indented by the depth
+  of the open blocks and bodies.
+  """
+  depth = 0
+  for event_type, node in events:
+    if event_type == END_BLOCK_EVENT or event_type == END_BODY_EVENT:
+      depth -= 1
+    print '{}{} {}'.format('  ' * depth, kEventTypeToStr[event_type], node)
+    if event_type == START_BLOCK_EVENT or event_type == START_BODY_EVENT:
+      depth += 1
 
 
 def main():
   """
-  Dump digested tokens or full-syntax-tree to stdout for debugging purposes.
+  Dump digested tokens, parse events or full-syntax-tree to stdout for
+  debugging purposes.
   """
   import argparse
   parser = argparse.ArgumentParser(description=__doc__)
   parser.add_argument('infile')
   subparsers = parser.add_subparsers(dest='command')
   subparsers.add_parser('dump-digest')
+  subparsers.add_parser('dump-events')
   subparsers.add_parser('dump-tree')
 
   args = parser.parse_args()
   with open(args.infile, 'r') as infile:
     tokens = lexer.tokenize(infile.read())
-    tok_seqs = digest_tokens(tokens)
-    fst = construct_fst(tok_seqs)
 
   if args.command == 'dump-digest':
-    for seq in tok_seqs:
-      print seq
+    dump_digest(iter_digest(tokens))
+  elif args.command == 'dump-events':
+    dump_events(parse_events(tokens))
   elif args.command == 'dump-tree':
-    dump_fst(fst)
+    dump_fst(parse(tokens))
   else:
     assert False, "Unkown command {}".format(args.command)
 
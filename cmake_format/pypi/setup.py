@@ -1,18 +1,27 @@
+import re
+
 from setuptools import setup
 
 with open('README.rst') as infile:
   long_description = infile.read()
 
+# The version is defined once, in the package, which also uses it to
+# invalidate the caches of formatted files
+with open('cmake_format/__init__.py') as infile:
+  version = re.search(r"^__version__ = '([^']+)'$", infile.read(),
+                      re.MULTILINE).group(1)
+
 setup(
     name='cmake_format',
     packages=['cmake_format'],
-    version='0.2.0',
+    version=version,
     description="Can format your listfiles so they don't look like crap",
     long_description=long_description,
     author='Josh Bialkowski',
     author_email='josh.bialkowski@gmail.com',
     url='https://github.com/cheshirekow/cmake_format',
-    download_url='https://github.com/cheshirekow/cmake_format/archive/0.2.0.tar.gz',
+    download_url=('https://github.com/cheshirekow/cmake_format/archive/'
+                  '{}.tar.gz'.format(version)),
     keywords=['cmake', 'format'],
     classifiers=[],
     entry_points={
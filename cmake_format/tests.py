@@ -1,10 +1,27 @@
 # -*- coding: utf-8 -*-
+import argparse
+import errno
+import functools
+import os
+import random
+import re
+import shutil
+import tempfile
+import textwrap
+import timeit
 import unittest
 import StringIO
+import sys
 
+import cmake_format
 from cmake_format import __main__
+from cmake_format import cache
 from cmake_format import commands
+from cmake_format import discover
 from cmake_format import formatter
+from cmake_format import layout
+from cmake_format import lexer
+from cmake_format import parser
 
 
 class TestCanonicalFormatting(unittest.TestCase):
@@ -182,6 +199,25 @@ set(HEADERS
 # 　　 c( uu}
 # cmake-format: on
 # while this part should be formatted again
+""")
+
+  def test_nested_format_off(self):
+    self.do_format_test("""\
+# cmake-format: off
+# This   region is already off so the next marker
+# cmake-format: off
+# is   passed through without a blank line before it
+set(foo   bar)
+# cmake-format: on
+set(foo   bar)
+""", """\
+# cmake-format: off
+# This   region is already off so the next marker
+# cmake-format: off
+# is   passed through without a blank line before it
+set(foo   bar)
+# cmake-format: on
+set(foo bar)
 """)
 
   def test_paragraphs_preserved(self):
@@ -263,6 +299,23 @@ foo(nonkwarg_a nonkwarg_b
     DEPENDS foo bar baz)
 """)
 
+  def test_additional_block(self):
+    parser.decl_block(self.config.block_spec, 'my_if', 'my_if', 'my_endif',
+                      middles=['my_else'])
+    self.do_format_test("""\
+my_if(FOO)
+message(foo)
+my_else()
+message(bar)
+my_endif()
+""", """\
+my_if(FOO)
+  message(foo)
+my_else()
+  message(bar)
+my_endif()
+""")
+
   def test_some_string_stuff(self):
     self.do_format_test("""\
 # This command uses a string with escaped quote chars
@@ -360,5 +413,1140 @@ foreach(forbarbaz arg1 arg2, arg3)
 endforeach()
 """)
 
+
+class TestPacking(unittest.TestCase):
+
+  def check_packing(self, contents, line_width):
+    config = formatter.Configuration()
+    args = [parser.Argument(lexer.Token(lexer.WORD, content, 0, 0, None))
+            for content in contents]
+    self.assertEqual(formatter.pack_args(config, line_width, args),
+                     formatter.pack_arg_contents(contents, line_width))
+
+  def test_packing_matches_greedy(self):
+    rng = random.Random(1234)
+    for num_args in [1, 2, 3, 10, 100, 1000]:
+      for line_width in [3, 10, 40, 80]:
+        contents = ['x' * rng.randint(1, 30) for _ in range(num_args)]
+        self.check_packing(contents, line_width)
+        self.check_packing(['x' * (line_width - 2)] + contents, line_width)
+        self.check_packing(['x' * (line_width - 3)] + contents, line_width)
+
+  def test_packing_without_numpy(self):
+    numpy = formatter.numpy
+    formatter.numpy = None
+    try:
+      self.test_packing_matches_greedy()
+    finally:
+      formatter.numpy = numpy
+
+
+class TestCommentReflow(unittest.TestCase):
+
+  words = ['a', 'bb', 'foo', 'end.', 'foo-bar', 'self-contained', 'ab--cd',
+           '${VAR}', 'averyveryverylongwordindeed']
+
+  def get_random_paragraph(self, rng, separators):
+    parts = []
+    for _ in range(rng.randint(1, 30)):
+      parts.append(rng.choice(self.words))
+      parts.append(rng.choice(separators))
+    return ''.join(parts[:-1])
+
+  def test_matches_textwrap(self):
+    rng = random.Random(1234)
+    for _ in range(500):
+      # textwrap may leave trailing whitespace after breaking a
+      # word that is wider than the line, so only words that fit are used.
+      paragraph_text = self.get_random_paragraph(rng, [' ', '\n'])
+      line_width = rng.randint(30, 60)
+      wrapper = textwrap.TextWrapper(width=line_width,
+                                     initial_indent='# ',
+                                     subsequent_indent='# ')
+      self.assertEqual(wrapper.wrap(paragraph_text),
+                       formatter.wrap_paragraph(paragraph_text, line_width))
+
+  def test_empty_line_in_paragraph(self):
+    for layout_engine in ['heuristic', 'optimal']:
+      config = formatter.Configuration(layout_engine=layout_engine)
+      self.assertEqual('foo(a) # first   second\n', formatter.format_string(
+          'foo(a) # first\n  #\n  # second\n', config))
+      self.assertFalse(formatter.paragraph_conforms('first\n\nsecond', 80))
+
+  def test_single_pass_stable(self):
+    rng = random.Random(1234)
+    for _ in range(500):
+      paragraph_text = self.get_random_paragraph(
+          rng, [' ', '  ', '   ', '\n', '\n ', '\t'])
+      line_width = rng.randint(3, 60)
+      lines = formatter.wrap_paragraph(paragraph_text, line_width)
+      for line in lines:
+        self.assertLessEqual(len(line), max(line_width, 3))
+      rewrapped_text = '\n'.join(line[2:] for line in lines)
+      self.assertEqual(lines,
+                       formatter.wrap_paragraph(rewrapped_text, line_width))
+
+  def test_conforming_paragraph_unchanged(self):
+    paragraph_text = 'This paragraph is\nalready wrapped.  It\nis kept as is.'
+    self.assertTrue(formatter.paragraph_conforms(paragraph_text, 20))
+    self.assertEqual(['# This paragraph is', '# already wrapped.  It',
+                      '# is kept as is.'],
+                     formatter.wrap_paragraph(paragraph_text, 22))
+    self.assertFalse(formatter.paragraph_conforms(paragraph_text, 30))
+    self.assertFalse(formatter.paragraph_conforms(' leading space', 30))
+
+  def test_reflow_cache(self):
+    paragraph_text = 'Licensed under the Apache License, Version 2.0'
+    lines = formatter.reflow_paragraph(paragraph_text, 20)
+    hits = formatter.kReflowCache.hits
+    self.assertIs(lines, formatter.reflow_paragraph(paragraph_text, 20))
+    self.assertEqual(hits + 1, formatter.kReflowCache.hits)
+    self.assertNotEqual(lines, formatter.reflow_paragraph(paragraph_text, 40))
+
+
+class TestOptimalLayout(unittest.TestCase):
+
+  def do_format_test(self, input_str, output_str):
+    config = formatter.Configuration(layout_engine='optimal')
+    outfile = StringIO.StringIO()
+    __main__.process_file(config, StringIO.StringIO(input_str), outfile)
+    self.assertEqual(output_str, outfile.getvalue())
+
+  def test_solver(self):
+    doc = layout.Concat([layout.Text('foo('), layout.Align(layout.Concat(
+        [layout.Text('bar'), layout.LINE, layout.Text('baz')])),
+                         layout.Text(')')])
+    self.assertEqual(['foo(bar', '    baz)'], layout.layout_doc(doc, 80))
+    self.assertEqual(['foo(bar baz)'],
+                     layout.layout_doc(layout.group(doc), 80))
+    self.assertEqual(['foo(bar', '    baz)'],
+                     layout.layout_doc(layout.group(doc), 10))
+
+  def test_one_arg_per_line(self):
+    self.do_format_test("""\
+add_library(foo_bar_baz_qux_quux_with_a_very_long_name SHARED alpha.cc beta.cc gamma.cc delta.cc)
+""", """\
+add_library(foo_bar_baz_qux_quux_with_a_very_long_name
+            SHARED
+            alpha.cc
+            beta.cc
+            gamma.cc
+            delta.cc)
+""")
+
+  def test_kwargs_and_comments(self):
+    self.do_format_test("""\
+install(TARGETS foo DESTINATION lib/with/a/very/long/path/that/goes/on COMPONENT development)
+other_command(some_long_argument some_long_argument) # this comment is very long and gets split across some lines
+""", """\
+install(TARGETS foo DESTINATION lib/with/a/very/long/path/that/goes/on
+        COMPONENT development)
+other_command(some_long_argument
+              some_long_argument) # this comment is very long and gets split
+                                  # across some lines
+""")
+
+  def test_idempotent(self):
+    contents = """\
+if(foo)
+  set(HEADERS header_a.h header_b.h # This comment should be preserved, moreover it should be split across two lines.
+      header_c.h header_d.h)
+  foo(nonkwarg_a nonkwarg_b HEADERS a.h b.h c.h d.h e.h f.h SOURCES a.cc b.cc d.cc DEPENDS foo bar baz)
+  add_custom_command(OUTPUT foo.stamp COMMAND some_long_program --with --many --flags and some long arguments too)
+endif()
+"""
+    config = formatter.Configuration(layout_engine='optimal')
+    outfile = StringIO.StringIO()
+    __main__.process_file(config, StringIO.StringIO(contents), outfile)
+    formatted = outfile.getvalue()
+    outfile = StringIO.StringIO()
+    __main__.process_file(config, StringIO.StringIO(formatted), outfile)
+    self.assertEqual(formatted, outfile.getvalue())
+
+  def test_many_arguments(self):
+    config = formatter.Configuration(layout_engine='optimal',
+                                     max_subargs_per_line=1000)
+    args = ['a{}'.format(idx) for idx in range(500)]
+    for contents in [
+        'add_custom_command(OUTPUT x COMMAND {})\n'.format(' '.join(args)),
+        'set(foo {})\n'.format(' '.join(args))]:
+      lines = formatter.format_string(contents, config).splitlines()
+      self.assertTrue(all(len(line) <= config.line_width for line in lines))
+      self.assertTrue(' '.join(' '.join(lines).split()).endswith(
+          ' '.join(args) + ')'))
+
+  def test_unknown_layout_engine(self):
+    tempdir = tempfile.mkdtemp()
+    try:
+      configpath = os.path.join(tempdir, '.cmake-format')
+      with open(configpath, 'w') as config_file:
+        config_file.write('layout_engine: optimum\n')
+      with self.assertRaises(ValueError) as context:
+        __main__.load_config(configpath)
+      self.assertIn(configpath, str(context.exception))
+      self.assertIn('optimum', str(context.exception))
+    finally:
+      shutil.rmtree(tempdir)
+
+    config = formatter.Configuration(layout_engine='optimum')
+    with self.assertRaises(ValueError):
+      formatter.format_string('set(foo bar)\n', config)
+
+
+class TestConfigResolver(unittest.TestCase):
+
+  def setUp(self):
+    self.tempdir = os.path.realpath(tempfile.mkdtemp())
+    self.subdir = os.path.join(self.tempdir, 'a', 'b')
+    os.makedirs(self.subdir)
+    self.configpath = os.path.join(self.tempdir, 'a', '.cmake-format')
+    with open(self.configpath, 'w') as config_file:
+      config_file.write('line_width: 100\n')
+
+  def tearDown(self):
+    shutil.rmtree(self.tempdir)
+
+  def test_directories_are_searched_once(self):
+    resolver = __main__.ConfigResolver()
+    config = resolver.get_config(os.path.join(self.subdir, 'x.cmake'))
+    self.assertEqual(100, config.line_width)
+    self.assertIs(config, resolver.get_config(
+        os.path.join(self.subdir, 'y.cmake')))
+    self.assertIs(config, resolver.get_config(
+        os.path.join(self.tempdir, 'a', 'z.cmake')))
+    self.assertEqual(set([self.subdir, os.path.dirname(self.subdir)]),
+                     set(resolver.directory_configs))
+
+    # Not noticed without check_mtime
+    os.remove(self.configpath)
+    self.assertIs(config, resolver.get_config(
+        os.path.join(self.subdir, 'x.cmake')))
+
+  def test_check_mtime(self):
+    resolver = __main__.ConfigResolver(check_mtime=True)
+    infile_path = os.path.join(self.subdir, 'x.cmake')
+    config = resolver.get_config(infile_path)
+    self.assertIs(config, resolver.get_config(infile_path))
+
+    with open(self.configpath, 'w') as config_file:
+      config_file.write('line_width: 90\n')
+    mtime = os.stat(self.configpath).st_mtime + 10
+    os.utime(self.configpath, (mtime, mtime))
+    self.assertEqual(90, resolver.get_config(infile_path).line_width)
+
+    subconfig_path = os.path.join(self.subdir, 'cmake-format.json')
+    with open(subconfig_path, 'w') as config_file:
+      config_file.write('{"line_width": 70}')
+    os.utime(self.subdir, (mtime, mtime))
+    self.assertEqual(subconfig_path, resolver.find_config_file(infile_path))
+    self.assertEqual(70, resolver.get_config(infile_path).line_width)
+
+
+class FakeDirEntry(object):
+  """
+  Stands in for the entries generated by scandir, failing to stat any file
+  in ``vanished_paths`` as if it was removed after the directory was listed.
+  """
+
+  vanished_paths = set()
+
+  def __init__(self, directory, name):
+    self.name = name
+    self.path = os.path.join(directory, name)
+
+  def is_dir(self, follow_symlinks=True):
+    return os.path.isdir(self.path) and (follow_symlinks
+                                         or not os.path.islink(self.path))
+
+  def is_file(self):
+    return os.path.isfile(self.path)
+
+  def stat(self):
+    if self.path in self.vanished_paths:
+      raise OSError(errno.ENOENT, 'No such file or directory', self.path)
+    return os.stat(self.path)
+
+
+class TestDiscover(unittest.TestCase):
+
+  def setUp(self):
+    self.tempdir = tempfile.mkdtemp()
+    for relpath, contents in [
+        ('CMakeLists.txt', ''),
+        ('notes.txt', ''),
+        ('.gitignore', '# comment\nbuild/\n*.gen.cmake\n!keep.gen.cmake\n'),
+        ('a.cmake', ''),
+        ('a.gen.cmake', ''),
+        ('keep.gen.cmake', ''),
+        ('build/CMakeLists.txt', ''),
+        ('src/CMakeLists.txt', ''),
+        ('src/.cmake-format-ignore', '/x.cmake\n'),
+        ('src/x.cmake', ''),
+        ('src/y/x.cmake', ''),
+        ('third_party/CMakeLists.txt', '')]:
+      path = os.path.join(self.tempdir, relpath)
+      if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+      with open(path, 'w') as outfile:
+        outfile.write(contents)
+
+  def tearDown(self):
+    shutil.rmtree(self.tempdir)
+
+  def get_listfiles(self, excludes):
+    return [os.path.relpath(path, self.tempdir) for path, _ in
+            discover.iter_listfiles([self.tempdir], excludes)]
+
+  def test_iter_listfiles(self):
+    expected = ['CMakeLists.txt', 'a.cmake', 'keep.gen.cmake',
+                'src/CMakeLists.txt', 'src/y/x.cmake']
+    self.assertEqual(expected, self.get_listfiles(['third_party']))
+
+    scandir = discover.scandir
+    discover.scandir = None
+    try:
+      self.assertEqual(expected, self.get_listfiles(['third_*']))
+    finally:
+      discover.scandir = scandir
+
+  def test_unreadable_entries_are_skipped(self):
+    src_path = os.path.join(self.tempdir, 'src')
+    vanished_path = os.path.join(self.tempdir, 'a.cmake')
+    listdir = os.listdir
+
+    def fake_listdir(directory):
+      if directory == src_path:
+        raise OSError(errno.EACCES, 'Permission denied', directory)
+      return listdir(directory)
+
+    def fake_scandir(directory):
+      return [FakeDirEntry(directory, name)
+              for name in fake_listdir(directory)]
+
+    scandir = discover.scandir
+    stderr = sys.stderr
+    FakeDirEntry.vanished_paths = set([vanished_path])
+    os.listdir = fake_listdir
+    try:
+      sys.stderr = StringIO.StringIO()
+      discover.scandir = None
+      self.assertEqual(['CMakeLists.txt', 'a.cmake', 'keep.gen.cmake'],
+                       self.get_listfiles(['third_party']))
+      self.assertEqual('Skipping {}: Permission denied\n'.format(src_path),
+                       sys.stderr.getvalue())
+
+      sys.stderr = StringIO.StringIO()
+      discover.scandir = fake_scandir
+      self.assertEqual(['CMakeLists.txt', 'keep.gen.cmake'],
+                       self.get_listfiles(['third_party']))
+      self.assertIn(vanished_path, sys.stderr.getvalue())
+      self.assertIn(src_path, sys.stderr.getvalue())
+    finally:
+      os.listdir = listdir
+      sys.stderr = stderr
+      discover.scandir = scandir
+
+  def test_translate_glob(self):
+    for pattern, path, matches in [
+        ('*.cmake', 'a.cmake', True),
+        ('*.cmake', 'a/b.cmake', False),
+        ('**/b.cmake', 'a/c/b.cmake', True),
+        ('**/b.cmake', 'b.cmake', True),
+        ('a/**', 'a/c/b.cmake', True),
+        ('a?[!b]', 'axc', True),
+        ('a?[!b]', 'axb', False)]:
+      self.assertEqual(matches, bool(re.match(discover.translate_glob(pattern),
+                                              path)), pattern)
+
+
+class TestFileCache(unittest.TestCase):
+
+  def setUp(self):
+    self.tempdir = tempfile.mkdtemp()
+    self.cache_path = os.path.join(self.tempdir, 'cache')
+    self.infile_path = os.path.join(self.tempdir, 'CMakeLists.txt')
+    self.configfile_path = os.path.join(self.tempdir, '.cmake-format')
+    self.write(self.infile_path, 'foo(bar)\n')
+    self.write(self.configfile_path, 'line_width: 100\n')
+
+  def tearDown(self):
+    shutil.rmtree(self.tempdir)
+
+  def write(self, path, contents, mtime_offset=0):
+    with open(path, 'w') as outfile:
+      outfile.write(contents)
+    mtime = os.stat(path).st_mtime + mtime_offset
+    os.utime(path, (mtime, mtime))
+
+  def test_unchanged_files_are_current(self):
+    file_cache = cache.FileCache(self.cache_path)
+    self.assertFalse(file_cache.is_current(self.infile_path, None))
+    file_cache.update(self.infile_path, None)
+    self.assertTrue(file_cache.is_current(self.infile_path, None))
+    self.assertFalse(file_cache.is_current(self.infile_path,
+                                           self.configfile_path))
+    file_cache.close()
+
+    file_cache = cache.FileCache(self.cache_path)
+    self.assertTrue(file_cache.is_current(self.infile_path, None))
+    # Touched, but not changed
+    self.write(self.infile_path, 'foo(bar)\n', mtime_offset=10)
+    self.assertTrue(file_cache.is_current(self.infile_path, None))
+    # Changed, with the same size
+    self.write(self.infile_path, 'foo(baz)\n', mtime_offset=20)
+    self.assertFalse(file_cache.is_current(self.infile_path, None))
+    file_cache.close()
+
+  def test_version_change(self):
+    file_cache = cache.FileCache(self.cache_path)
+    file_cache.update(self.infile_path, self.configfile_path)
+    version = cmake_format.__version__
+    cmake_format.__version__ = version + '.dev'
+    try:
+      self.assertFalse(file_cache.is_current(self.infile_path,
+                                             self.configfile_path))
+    finally:
+      cmake_format.__version__ = version
+    self.assertTrue(file_cache.is_current(self.infile_path,
+                                          self.configfile_path))
+    file_cache.close()
+
+
+class TestOutputCache(unittest.TestCase):
+
+  def setUp(self):
+    self.tempdir = tempfile.mkdtemp()
+
+  def tearDown(self):
+    shutil.rmtree(self.tempdir)
+
+  def list_files(self):
+    return sorted(name for _, _, names in os.walk(self.tempdir)
+                  for name in names)
+
+  def test_entries_are_keyed_by_config(self):
+    output_cache = cache.OutputCache(self.tempdir)
+    config = formatter.Configuration()
+    key = output_cache.get_key('foo( bar )\n', config)
+    self.assertEqual(key, output_cache.get_key('foo( bar )\n',
+                                               config.clone()))
+    self.assertIsNone(output_cache.get(key))
+
+    outfile = StringIO.StringIO()
+    __main__.process_file(config, StringIO.StringIO('foo( bar )\n'), outfile,
+                          output_cache)
+    self.assertEqual('foo(bar)\n', outfile.getvalue())
+    self.assertEqual('foo(bar)\n', output_cache.get(key))
+    # Only the entry remains, not the temporary file it was written to
+    self.assertEqual([key[2:]], self.list_files())
+
+    narrow_config = formatter.Configuration(line_width=40)
+    self.assertNotEqual(key, output_cache.get_key('foo( bar )\n',
+                                                  narrow_config))
+    custom_config = formatter.Configuration()
+    commands.decl_command(custom_config.fn_spec, 'foo', flags=['bar'])
+    self.assertNotEqual(key, output_cache.get_key('foo( bar )\n',
+                                                  custom_config))
+
+  def test_least_recently_used_are_evicted(self):
+    output_cache = cache.OutputCache(self.tempdir)
+    config = formatter.Configuration()
+    keys = [output_cache.get_key(str(idx), config) for idx in range(3)]
+    for idx, key in enumerate(keys):
+      output_cache.put(key, 'x' * 100)
+      mtime = 1000 + idx
+      os.utime(output_cache.get_path(key), (mtime, mtime))
+    # Reading the oldest entry makes it the most recently used
+    self.assertIsNotNone(output_cache.get(keys[0]))
+    output_cache.max_size = 250
+    output_cache.close()
+    self.assertIsNotNone(output_cache.get(keys[0]))
+    self.assertIsNone(output_cache.get(keys[1]))
+    self.assertIsNotNone(output_cache.get(keys[2]))
+
+  def test_entries_are_created_with_umask(self):
+    umask = os.umask(0o027)
+    try:
+      output_cache = cache.OutputCache(self.tempdir)
+    finally:
+      os.umask(umask)
+    key = output_cache.get_key('foo(bar)\n', formatter.Configuration())
+    output_cache.put(key, 'foo(bar)\n')
+    self.assertEqual(0o640,
+                     os.stat(output_cache.get_path(key)).st_mode & 0o777)
+
+
+class TestParallel(unittest.TestCase):
+
+  def setUp(self):
+    self.tempdir = tempfile.mkdtemp()
+    self.infilepaths = []
+    for idx in range(6):
+      infile_path = os.path.join(self.tempdir, '{}.cmake'.format(idx))
+      with open(infile_path, 'w') as infile:
+        infile.write('foo( bar_{} )\n'.format(idx) * (1 + idx % 3))
+      self.infilepaths.append(infile_path)
+
+  def tearDown(self):
+    shutil.rmtree(self.tempdir)
+
+  def test_chunks_are_size_aware(self):
+    jobs = ['a', 'b', 'c', 'd', 'e']
+    chunks = __main__.get_chunks(jobs, [1, 100, 2, 50, 49], 4)
+    self.assertEqual([['b'], ['d'], ['e', 'c'], ['a']], chunks)
+
+  def test_parallel_matches_serial(self):
+    expected = ''.join(formatter.format_string(open(infile_path).read())
+                       for infile_path in self.infilepaths)
+    args = argparse.Namespace(infilepaths=self.infilepaths, config_file=None,
+                              in_place=False, recursive=False)
+    stdout = sys.stdout
+    sys.stdout = outfile = StringIO.StringIO()
+    try:
+      self.assertEqual(0, __main__.format_files_parallel(
+          __main__.get_parallel_chunks(args, 3), 3, False))
+    finally:
+      sys.stdout = stdout
+    self.assertEqual(expected, outfile.getvalue())
+
+    args.in_place = True
+    self.assertEqual(0, __main__.format_files_parallel(
+        __main__.get_parallel_chunks(args, 3), 3, True))
+    self.assertEqual(expected, ''.join(open(infile_path).read()
+                                       for infile_path in self.infilepaths))
+
+  def test_no_files_started_after_failure(self):
+    contents = [open(infile_path).read() for infile_path in self.infilepaths]
+    missing_path = os.path.join(self.tempdir, 'missing.cmake')
+    jobs = [(index, infile_path, None, True, None) for index, infile_path
+            in enumerate(self.infilepaths[:2] + [missing_path]
+                         + self.infilepaths[2:])]
+    stderr = sys.stderr
+    sys.stderr = StringIO.StringIO()
+    try:
+      self.assertEqual(1, __main__.format_files_parallel(
+          [jobs[:2], jobs[2:3], jobs[3:]], 1, True))
+    finally:
+      sys.stderr = stderr
+    for infile_path, original in zip(self.infilepaths, contents)[:2]:
+      self.assertEqual(formatter.format_string(original),
+                       open(infile_path).read())
+    for infile_path, original in zip(self.infilepaths, contents)[2:]:
+      self.assertEqual(original, open(infile_path).read())
+
+
+class TestOutput(unittest.TestCase):
+
+  def test_output_buffer(self):
+    outfile = StringIO.StringIO()
+    output = formatter.OutputBuffer(outfile)
+    output.write('foo(\n')
+    output.write_lines('  ', ['bar  ', 'baz)'])
+    self.assertEqual('', outfile.getvalue())
+    output.flush()
+    self.assertEqual('foo(\n  bar\n  baz)', outfile.getvalue())
+    self.assertEqual('', output.getvalue())
+
+  def test_format_string(self):
+    with open(os.path.join(os.path.dirname(__file__),
+                           'test', 'test_in.cmake')) as infile:
+      contents = infile.read()
+    config = formatter.Configuration()
+    outfile = StringIO.StringIO()
+    __main__.process_file(config, StringIO.StringIO(contents), outfile)
+    self.assertEqual(outfile.getvalue(),
+                     formatter.format_string(contents, config))
+    self.assertEqual('foo(bar)\n', formatter.format_string('foo( bar )\n'))
+
+  def test_large_files_are_streamed(self):
+    contents = (make_listfile(50) + '# cmake-format: off\nfoo( a )\n'
+                '# cmake-format: on\n' + make_listfile(50))
+    config = formatter.Configuration()
+    read_sizes = []
+
+    class RecordingFile(StringIO.StringIO):
+      def read(self, size=-1):
+        read_sizes.append(size)
+        return StringIO.StringIO.read(self, size)
+
+    stream_threshold = __main__.kStreamThreshold
+    __main__.kStreamThreshold = 1024
+    try:
+      outfile = StringIO.StringIO()
+      __main__.process_file(config, RecordingFile(contents), outfile)
+    finally:
+      __main__.kStreamThreshold = stream_threshold
+    self.assertEqual(formatter.format_string(contents, config),
+                     outfile.getvalue())
+    self.assertNotIn(-1, read_sizes)
+    self.assertGreater(len(read_sizes), 2)
+
+  def test_print_node_flushes(self):
+    outfile = StringIO.StringIO()
+    formatter.TreePrinter(formatter.Configuration(), outfile).print_node(
+        parser.parse(lexer.tokenize('if(foo)\nbar()\nendif()\n')))
+    self.assertEqual('if(foo)\n  bar()\nendif()\n', outfile.getvalue())
+
+    # Nodes other than the root are flushed too, one at a time
+    tree = parser.parse(lexer.tokenize('foo( a )\nbar( b )\n'))
+    outfile = StringIO.StringIO()
+    printer = formatter.TreePrinter(formatter.Configuration(), outfile)
+    printer.print_node(tree.children[0])
+    self.assertEqual('foo(a)', outfile.getvalue())
+    for child in tree.children[1:]:
+      printer.print_node(child)
+    self.assertEqual('foo(a)\nbar(b)\n', outfile.getvalue())
+
+
+class TestInactiveRegions(unittest.TestCase):
+
+  def format_both_ways(self, source):
+    """
+    Format ``source`` with its inactive regions sliced from the source and
+    with them printed token by token, check that the results match and
+    return the result.
+    """
+    config = formatter.Configuration()
+    printer = formatter.TreePrinter(config)
+    printer.print_events(parser.parse_events(lexer.tokenize_compact(source),
+                                             config.block_spec))
+    formatted = formatter.format_string(source, config)
+    self.assertEqual(printer.outfile.getvalue(), formatted)
+    return formatted
+
+  def test_region_is_one_token(self):
+    source = ('foo( a )\n# cmake-format: off\nif(x)\nbar( "(" )\nendif()\n'
+              '  # cmake-format: on\nbaz( b )\n')
+    tokens = formatter.tokenize_source(formatter.Configuration(), source)
+    self.assertEqual(1, list(tokens.types).count(lexer.VERBATIM))
+    self.assertEqual(
+        'foo(a)\n# cmake-format: off\nif(x)\nbar( "(" )\nendif()\n'
+        '  # cmake-format: on\nbaz(b)\n',
+        self.format_both_ways(source))
+
+  def test_region_extends_to_end(self):
+    source = 'foo( a )\n# cmake-format: off\nbar( b )\n\n\n'
+    tokens = formatter.tokenize_source(formatter.Configuration(), source)
+    self.assertIn(lexer.VERBATIM, tokens.types)
+    self.assertEqual('foo(a)\n# cmake-format: off\nbar( b )\n\n\n',
+                     self.format_both_ways(source))
+
+  def test_nested_markers_are_not_region_ends(self):
+    source = ('# cmake-format: off\nfoo( "# cmake-format: on" a\n'
+              '# cmake-format: on\n)\n# cmake-format: on\nbar( b )\n')
+    self.assertEqual(
+        '# cmake-format: off\nfoo( "# cmake-format: on" a\n'
+        '# cmake-format: on\n)\n# cmake-format: on\nbar(b)\n',
+        self.format_both_ways(source))
+
+  def test_straddling_block_is_tokenized(self):
+    source = ('if(x)\n# cmake-format: off\nfoo( a )\nendif()\n'
+              '# cmake-format: on\nbar( b )\n')
+    tokens = formatter.tokenize_source(formatter.Configuration(), source)
+    self.assertNotIn(lexer.VERBATIM, tokens.types)
+    self.assertEqual(
+        'if(x)\n# cmake-format: off\nfoo( a )\nendif()\n'
+        '# cmake-format: on\nbar(b)\n',
+        self.format_both_ways(source))
+
+  def test_stream_collapses_regions(self):
+    collapse_inactive = functools.partial(parser.blocks_are_balanced,
+                                          parser.get_block_spec())
+    for source in [
+        'foo( a )\n# cmake-format: off\nif(x)\nbar( "(" )\nendif()\n'
+        '  # cmake-format: on\nbaz( b )\n',
+        'foo( a )\n# cmake-format: off\nbar( b )\n\n\n',
+        # A marker within a string that only the whole input shows
+        '# cmake-format: off\nfoo( "a\n# cmake-format: on\n" b )\n'
+        '# cmake-format: on\nbar( b )\n',
+        'if(x)\n# cmake-format: off\nfoo( a )\nendif()\n'
+        '# cmake-format: on\nbar( b )\n']:
+      expected = [(token.type, token.content, token.offset) for token in
+                  lexer.tokenize_compact(
+                      source, collapse_inactive=collapse_inactive)]
+      for chunk_size in [1, 7, 4096]:
+        self.assertEqual(expected, [
+            (token.type, token.content, token.offset) for token in
+            lexer.tokenize_stream(StringIO.StringIO(source),
+                                  chunk_size=chunk_size,
+                                  collapse_inactive=collapse_inactive)])
+
+  def test_invalid_region_fails_the_same_way(self):
+    for source in ['# cmake-format: off\nfoo( a ))\n',
+                   '# cmake-format: off\nfoo bar( a )\n',
+                   '# cmake-format: off\nfoo( a )bar( b )\n']:
+      with self.assertRaises(AssertionError):
+        formatter.format_string(source)
+
+
+class TestCommandSpecs(unittest.TestCase):
+
+  def get_role(self, fn_spec, command_name, arg):
+    return fn_spec.get_classifier(command_name).classify(arg)
+
+  def test_builtin_specs_are_shared_and_frozen(self):
+    fn_spec = formatter.Configuration().fn_spec
+    self.assertIs(fn_spec.get('add_library'),
+                  formatter.Configuration().fn_spec.get('add_library'))
+    self.assertEqual(0, fn_spec['add_library']['SHARED'])
+    with self.assertRaises(TypeError):
+      fn_spec['add_library']['SHARED'] = 1
+    with self.assertRaises(TypeError):
+      commands.kBuiltinFnSpec['foo'] = {}
+
+  def test_declared_commands_are_overlaid(self):
+    config = formatter.Configuration()
+    commands.decl_command(config.fn_spec, 'foo', flags=['BAR'],
+                          kwargs={'SOURCES': '*'})
+    commands.decl_command(config.fn_spec, 'add_library', flags=['BAZ'])
+    self.assertIn('foo', config.fn_spec)
+    self.assertEqual(commands.KWARG,
+                     self.get_role(config.fn_spec, 'foo', 'SOURCES'))
+    self.assertEqual(commands.FLAG,
+                     self.get_role(config.fn_spec, 'add_library', 'BAZ'))
+    self.assertEqual(commands.PARG,
+                     self.get_role(config.fn_spec, 'add_library', 'SHARED'))
+    self.assertEqual(len(commands.kBuiltinFnSpec) + 1, len(config.fn_spec))
+
+    other_config = formatter.Configuration()
+    self.assertNotIn('foo', other_config.fn_spec)
+    self.assertEqual(commands.FLAG, self.get_role(other_config.fn_spec,
+                                                  'add_library', 'SHARED'))
+
+  def test_clone_keeps_declared_commands(self):
+    config = formatter.Configuration()
+    commands.decl_command(config.fn_spec, 'foo', flags=['BAR'])
+    clone = config.clone()
+    self.assertEqual(commands.FLAG,
+                     self.get_role(clone.fn_spec, 'foo', 'BAR'))
+    commands.decl_command(clone.fn_spec, 'baz')
+    self.assertNotIn('baz', config.fn_spec)
+
+  def test_classifier(self):
+    classifier = commands.kBuiltinClassifiers['add_custom_target']
+    self.assertEqual(frozenset(['ALL', 'VERBATIM']), classifier.flags)
+    self.assertEqual('*', classifier.kwargs['COMMAND'])
+    self.assertEqual(0, classifier.pargs)
+    self.assertEqual(commands.FLAG, classifier.classify('ALL'))
+    self.assertEqual(commands.KWARG, classifier.classify('COMMAND'))
+    self.assertEqual(commands.PARG, classifier.classify('foo'))
+    self.assertEqual(commands.PARG, classifier.classify('pargs'))
+
+    config = formatter.Configuration()
+    commands.decl_command(config.fn_spec, 'foo', flags=['BAR'])
+    self.assertEqual(commands.FLAG,
+                     config.fn_spec.get_classifier('foo').classify('BAR'))
+    commands.decl_command(config.fn_spec, 'foo', kwargs={'BAR': '*'})
+    self.assertEqual(commands.KWARG,
+                     config.fn_spec.get_classifier('foo').classify('BAR'))
+    self.assertIs(commands.kEmptyClassifier,
+                  config.fn_spec.get_classifier('not_a_command'))
+
+  def test_args_are_tagged_with_roles(self):
+    config = formatter.Configuration()
+    fst = parser.parse(lexer.tokenize(
+        'add_custom_target(foo ALL COMMAND echo VERBATIM)\n'))
+    statement = fst.children[0]
+    sublists = formatter.split_args_by_kwargs(config.fn_spec, statement.name,
+                                              statement.body)
+    self.assertEqual([['foo'], ['ALL'], ['COMMAND', 'echo'], ['VERBATIM']],
+                     [[arg.contents for arg in sublist]
+                      for sublist in sublists])
+    self.assertEqual([commands.PARG, commands.FLAG, commands.KWARG,
+                      commands.PARG, commands.FLAG],
+                     [arg.role for arg in statement.body])
+
+
+class TestLayoutCache(unittest.TestCase):
+
+  def test_lru_cache(self):
+    cache = formatter.LRUCache(4)
+    for key in range(4):
+      cache.put(key, str(key))
+    self.assertEqual('0', cache.get(0))
+    cache.put(4, '4')
+    # 0 was used more recently than 1, so 1 is evicted first
+    self.assertEqual('0', cache.get(0))
+    self.assertIsNone(cache.get(1))
+    self.assertEqual('4', cache.get(4))
+    self.assertLessEqual(len(cache), 4)
+    self.assertEqual(3, cache.hits)
+    self.assertEqual(1, cache.misses)
+
+  def test_repeated_layout_is_cached(self):
+    config = formatter.Configuration()
+    statement = ('set_target_properties(foo PROPERTIES '
+                 'INTERFACE_INCLUDE_DIRECTORIES "${_IMPORT_PREFIX}/include" '
+                 'INTERFACE_LINK_LIBRARIES "bar;baz")\n')
+    outfile = StringIO.StringIO()
+    __main__.process_file(config, StringIO.StringIO(statement), outfile)
+    misses = config.layout_cache.misses
+    self.assertEqual(0, config.layout_cache.hits)
+
+    repeated_outfile = StringIO.StringIO()
+    __main__.process_file(config, StringIO.StringIO(statement * 2),
+                          repeated_outfile)
+    self.assertEqual(outfile.getvalue() * 2, repeated_outfile.getvalue())
+    self.assertGreater(config.layout_cache.hits, 0)
+    self.assertEqual(misses, config.layout_cache.misses)
+
+  def test_merge_ignores_internal_state(self):
+    config = formatter.Configuration()
+    layout_cache = config.layout_cache
+    block_spec = config.block_spec
+    fn_spec = config.fn_spec
+    config.merge({'layout_cache': 1, 'block_spec': 2, 'fn_spec': 3,
+                  'line_width': 100})
+    self.assertIs(layout_cache, config.layout_cache)
+    self.assertIs(block_spec, config.block_spec)
+    self.assertIs(fn_spec, config.fn_spec)
+    self.assertEqual(100, config.line_width)
+
+
+class TestLexer(unittest.TestCase):
+
+  def test_token_types(self):
+    tokens = lexer.tokenize('foo(bar 12 ${baz} "a \\"b\\"" x.y) # c\n')
+    self.assertEqual([(lexer.token_type_to_str(token.type), token.content)
+                      for token in tokens],
+                     [('WORD', 'foo'),
+                      ('LEFT_PAREN', '('),
+                      ('WORD', 'bar'),
+                      ('WHITESPACE', ' '),
+                      ('NUMBER', '12'),
+                      ('WHITESPACE', ' '),
+                      ('DEREF', '${baz}'),
+                      ('WHITESPACE', ' '),
+                      ('QUOTED_LITERAL', '"a \\"b\\""'),
+                      ('WHITESPACE', ' '),
+                      ('UNQUOTED_LITERAL', 'x.y'),
+                      ('RIGHT_PAREN', ')'),
+                      ('WHITESPACE', ' '),
+                      ('COMMENT', '# c'),
+                      ('NEWLINE', '\n')])
+
+  def test_tokens_cover_input(self):
+    with open(os.path.join(os.path.dirname(__file__),
+                           'test', 'test_in.cmake')) as infile:
+      contents = infile.read()
+    tokens = lexer.tokenize(contents)
+    self.assertEqual(''.join(token.content for token in tokens), contents)
+    self.assertEqual([token.index for token in tokens], range(len(tokens)))
+    offset = 0
+    for token in tokens:
+      self.assertEqual(token.line, contents.count('\n', 0, offset) + 1)
+      self.assertEqual(token.col, offset - contents.rfind('\n', 0, offset) - 1)
+      offset += len(token.content)
+
+  def test_stream_matches_tokenize(self):
+    with open(os.path.join(os.path.dirname(__file__),
+                           'test', 'test_in.cmake')) as infile:
+      contents = infile.read()
+
+    def as_tuples(tokens):
+      return [(token.type, token.content, token.line, token.col, token.index)
+              for token in tokens]
+
+    expected = as_tuples(lexer.tokenize(contents))
+    for chunk_size in [1, 7, 4096]:
+      actual = as_tuples(lexer.tokenize_stream(StringIO.StringIO(contents),
+                                               chunk_size=chunk_size))
+      self.assertEqual(actual, expected)
+
+  def test_compact_matches_tokenize(self):
+    with open(os.path.join(os.path.dirname(__file__),
+                           'test', 'test_in.cmake')) as infile:
+      contents = infile.read()
+
+    def as_tuples(tokens):
+      return [(token.type, token.content, token.line, token.col, token.index)
+              for token in tokens]
+
+    store = lexer.tokenize_compact(contents)
+    self.assertEqual(as_tuples(store), as_tuples(lexer.tokenize(contents)))
+    self.assertEqual(store[-1].index, len(store) - 1)
+    self.assertEqual(store.get_buffer(0).tobytes(), store[0].content)
+
+  def test_line_index(self):
+    contents = 'ab\n\ncd\nef'
+    numpy = lexer.numpy
+    try:
+      for use_numpy in set([numpy is not None, False]):
+        lexer.numpy = numpy if use_numpy else None
+        line_index = lexer.LineIndex(contents)
+        self.assertEqual(list(line_index.line_starts), [0, 3, 4, 7])
+        self.assertEqual([line_index.get_location(offset)
+                          for offset in range(len(contents))],
+                         [(1, 0), (1, 1), (1, 2), (2, 0), (3, 0), (3, 1),
+                          (3, 2), (4, 0), (4, 1)])
+    finally:
+      lexer.numpy = numpy
+
+  def test_stream_is_lazy(self):
+    infile = StringIO.StringIO(make_listfile(1000))
+    tokens = lexer.tokenize_stream(infile, chunk_size=64)
+    self.assertEqual(next(tokens).content, '# Comment for statement 0')
+    self.assertLess(infile.tell(), 256)
+
+
+class TestParser(unittest.TestCase):
+
+  def test_argument_tokens(self):
+    fst = parser.parse(lexer.tokenize(
+        'foo(bar # comment\n    "baz" )\n'))
+    statement = fst.children[0]
+    self.assertEqual(['bar', '"baz"'],
+                     [arg.contents for arg in statement.body])
+    self.assertEqual(['bar', ' ', '# comment', '\n', '    '],
+                     [tok.content for tok in statement.body[0].tokens])
+    self.assertEqual(['# comment'], statement.body[0].comments)
+    self.assertEqual(['"baz"', ' '],
+                     [tok.content for tok in statement.body[1].tokens])
+    self.assertEqual([], list(statement.body[1].comments))
+
+  def test_block_structure(self):
+    fst = parser.parse(lexer.tokenize(
+        'while(foo)\n  if(bar)\n  else()\n  endif()\nendwhile()\n'))
+    self.assertEqual(parser.WHILE, fst.children[0].block_type)
+    while_stmt = fst.children[0].children[0]
+    if_block = while_stmt.children[1]
+    self.assertEqual(parser.IF_BLOCK, if_block.block_type)
+    self.assertEqual(['if', 'else', 'endif'],
+                     [child.name for child in if_block.children])
+
+  def test_additional_block(self):
+    block_spec = parser.get_block_spec()
+    parser.decl_block(block_spec, 'my_if', 'my_if', 'my_endif',
+                      middles=['my_else'])
+    fst = parser.parse(lexer.tokenize(
+        'my_if(foo)\n  bar()\nmy_else()\nmy_endif()\n'), block_spec)
+    block = fst.children[0]
+    self.assertEqual('my_if', block.block_type)
+    self.assertEqual(['my_if', 'my_else', 'my_endif'],
+                     [child.name for child in block.children])
+
+  def test_mismatched_block(self):
+    with self.assertRaises(AssertionError):
+      parser.parse(lexer.tokenize('if(foo)\nendwhile()\n'))
+    with self.assertRaises(AssertionError):
+      parser.parse(lexer.tokenize('endif()\n'))
+    with self.assertRaises(AssertionError):
+      parser.parse(lexer.tokenize('if(foo)\n'))
+
+  def test_statement_is_decomposed_lazily(self):
+    fst = parser.parse(lexer.tokenize('foo(bar baz) # comment\n'))
+    statement = fst.children[0]
+    self.assertEqual('foo', statement.name)
+    self.assertIsNone(statement._body)  # pylint: disable=protected-access
+    self.assertEqual(' comment', statement.comment)
+    self.assertEqual(['bar', 'baz'],
+                     [arg.contents for arg in statement.body])
+    self.assertEqual(['foo', '('],
+                     [tok.content for tok in statement.prefix_tokens])
+    self.assertEqual([')', ' ', '# comment'],
+                     [tok.content for tok in statement.postfix_tokens])
+
+  def test_events_match_tree(self):
+    with open(os.path.join(os.path.dirname(__file__),
+                           'test', 'test_in.cmake')) as infile:
+      contents = infile.read()
+    contents += ('while(foo)\n  # cmake-format: off\n  bar( baz )\n'
+                 '  # cmake-format: on\nendwhile()\n')
+    config = formatter.Configuration()
+
+    tree_outfile = StringIO.StringIO()
+    formatter.TreePrinter(config, tree_outfile).print_node(
+        parser.parse(lexer.tokenize(contents)))
+    event_outfile = StringIO.StringIO()
+    formatter.TreePrinter(config, event_outfile).print_events(
+        parser.parse_events(lexer.tokenize_stream(
+            StringIO.StringIO(contents))))
+    self.assertEqual(tree_outfile.getvalue(), event_outfile.getvalue())
+
+  def test_events_hold_no_children(self):
+    events = list(parser.parse_events(lexer.tokenize(
+        'if(foo)\n  bar()\nendif()\n')))
+    self.assertEqual(
+        [parser.START_BLOCK_EVENT, parser.START_BLOCK_EVENT,
+         parser.STATEMENT_EVENT, parser.START_BODY_EVENT,
+         parser.WHITESPACE_EVENT, parser.STATEMENT_EVENT,
+         parser.WHITESPACE_EVENT, parser.END_BODY_EVENT,
+         parser.STATEMENT_EVENT, parser.END_BLOCK_EVENT,
+         parser.WHITESPACE_EVENT, parser.END_BLOCK_EVENT],
+        [event_type for event_type, _ in events])
+    for _, node in events:
+      self.assertFalse(getattr(node, 'children', None))
+
+  def test_tree_events_match_stream(self):
+    contents = 'if(foo)\n  bar()\nelse()\n  # baz\nendif()\nfoo()\n'
+    self.assertEqual(
+        [(event_type, node.node_type) for event_type, node
+         in parser.parse_events(lexer.tokenize(contents))],
+        [(event_type, node.node_type) for event_type, node
+         in parser.iter_fst_events(parser.parse(lexer.tokenize(contents)))])
+
+  def test_deep_nesting(self):
+    depth = sys.getrecursionlimit() + 100
+    contents = 'if(foo)\n' * depth + 'bar()\n' + 'endif()\n' * depth
+    root = parser.parse(lexer.tokenize_compact(contents))
+
+    outfile = StringIO.StringIO()
+    config = formatter.Configuration(line_width=2 * depth + 80)
+    formatter.TreePrinter(config, outfile).print_node(root)
+    lines = outfile.getvalue().split('\n')
+    self.assertEqual(2 * depth + 2, len(lines))
+    self.assertEqual('  ' * depth + 'bar()', lines[depth])
+
+    stdout = sys.stdout
+    sys.stdout = dumpfile = StringIO.StringIO()
+    try:
+      parser.dump_fst(root)
+    finally:
+      sys.stdout = stdout
+    self.assertEqual(5 * depth + 4, len(dumpfile.getvalue().split('\n')))
+
+  def test_nodes_have_no_instance_dict(self):
+    fst = parser.parse(lexer.tokenize(
+        '# comment\nif(foo)\n  bar(baz)\nendif()\n'))
+    nodes = [fst]
+    while nodes:
+      node = nodes.pop()
+      self.assertFalse(hasattr(node, '__dict__'), type(node).__name__)
+      for arg in getattr(node, 'body', []):
+        self.assertFalse(hasattr(arg, '__dict__'))
+      nodes.extend(getattr(node, 'children', []))
+
+
+def make_listfile(num_statements):
+  """
+  Return the text of a synthetic listfile with ``num_statements`` top level
+  statements (and some comments and whitespace between them).
+  """
+  chunks = []
+  for idx in range(num_statements):
+    chunks.append('# Comment for statement {0}\n'
+                  'set_property(TARGET foo_{0} APPEND PROPERTY\n'
+                  '             INTERFACE_LINK_LIBRARIES "bar_{0}" ${{BAZ}})\n'
+                  '\n'.format(idx))
+  return ''.join(chunks)
+
+
+class CountingTokenStream(parser.TokenStream):
+  """
+  A TokenStream which counts the operations done on it, and the longest
+  lookahead it holds, across all instances.
+  """
+
+  num_operations = 0
+  max_lookahead = 0
+
+  def peek(self, offset=0):
+    CountingTokenStream.num_operations += 1
+    token = super(CountingTokenStream, self).peek(offset)
+    CountingTokenStream.max_lookahead = max(CountingTokenStream.max_lookahead,
+                                            len(self._lookahead))
+    return token
+
+  def pop(self):
+    CountingTokenStream.num_operations += 1
+    return super(CountingTokenStream, self).pop()
+
+
+class TestScaling(unittest.TestCase):
+
+  def count_digest_operations(self, tokens):
+    """
+    Digest ``tokens`` and return the number of operations done on the token
+    stream and the longest lookahead it held.
+    """
+    CountingTokenStream.num_operations = 0
+    CountingTokenStream.max_lookahead = 0
+    token_stream = parser.TokenStream
+    parser.TokenStream = CountingTokenStream
+    try:
+      parser.digest_tokens(tokens)
+    finally:
+      parser.TokenStream = token_stream
+    return (CountingTokenStream.num_operations,
+            CountingTokenStream.max_lookahead)
+
+  def test_digest_tokens_is_linear(self):
+    small_tokens = lexer.tokenize(make_listfile(500))
+    large_tokens = lexer.tokenize(make_listfile(8 * 500))
+    small_operations, small_lookahead = self.count_digest_operations(
+        small_tokens)
+    large_operations, large_lookahead = self.count_digest_operations(
+        large_tokens)
+
+    # A bounded number of operations per token, each of which is constant
+    # time because the lookahead doesn't grow with the input. The input is
+    # not consumed by popping from the front of the list.
+    self.assertLessEqual(small_operations, 3 * len(small_tokens))
+    self.assertLessEqual(large_operations, 3 * len(large_tokens))
+    self.assertEqual(small_lookahead, large_lookahead)
+    self.assertEqual(len(lexer.tokenize(make_listfile(500))),
+                     len(small_tokens))
+
+
+class TestPathologicalLexing(unittest.TestCase):
+  """
+  Inputs that are known to be expensive for backtracking regexes. The linear
+  lexer must get through each of them within a generous time budget, and the
+  time must grow roughly linearly with the input size. Each size is timed a
+  few times and the best time is used, so that a loaded machine doesn't fail
+  the test.
+  """
+
+  # Seconds allowed to lex the largest input in each case. A backtracking
+  # lexer takes minutes.
+  time_budget = 10.0
+
+  # Number of times each input is lexed
+  num_repeats = 3
+
+  def time_lex(self, contents):
+    """
+    Return the best time out of num_repeats to lex ``contents``.
+    """
+    timer = timeit.default_timer
+    best = None
+    for _ in range(self.num_repeats):
+      start = timer()
+      tokens = lexer.tokenize(contents, linear=True)
+      duration = timer() - start
+      if best is None or duration < best:
+        best = duration
+    self.assertEqual(''.join(token.content for token in tokens), contents)
+    return best
+
+  def assert_linear_lex(self, make_input):
+    small_time = self.time_lex(make_input(5000))
+    large_time = self.time_lex(make_input(8 * 5000))
+
+    # Eight times the input should take about eight times as long, a
+    # quadratic lexer would take about sixty-four times as long
+    self.assertLess(large_time, self.time_budget)
+    self.assertLess(large_time, 32 * max(small_time, 1e-3))
+
+  def test_long_unterminated_quote(self):
+    self.assert_linear_lex(lambda size: 'set(x "' + 'a b\n' * size + ')')
+
+  def test_many_unterminated_quotes(self):
+    self.assert_linear_lex(lambda size: 'set(x' + ' "a' * size + ')')
+
+  def test_long_unquoted_literal(self):
+    self.assert_linear_lex(lambda size: 'set(x ' + 'a.' * size + '")')
+
+  def test_many_backslashes(self):
+    self.assert_linear_lex(lambda size: 'set(x "' + '\\' * size + ')')
+
+  def test_many_escaped_quotes(self):
+    self.assert_linear_lex(lambda size: 'set(x "' + '\\" ' * size + ')')
+
+  def test_escaped_quote_in_string(self):
+    tokens = lexer.tokenize('set(x "a \\"b\\" c")', linear=True)
+    self.assertEqual(tokens[4].type, lexer.QUOTED_LITERAL)
+    self.assertEqual(tokens[4].content, '"a \\"b\\" c"')
+
 if __name__ == '__main__':
   unittest.main()